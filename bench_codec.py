@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+テレメトリ画像の JPEG エンコード・デコード処理時間のベンチマーク。
+従来の donkeycar.util.img(PIL, 画像ごとにバッファを確保)と、
+バッファを再利用する iotf.jpeg.JpegCodec の1画像あたりの処理時間・確保メモリ量を比較する。
+
+Usage:
+    bench_codec.py [--tub=<tub1,tub2,..tubn>] [--count=<num>] [--repeat=<num>] [--quality=<num>] [--backend=<name>]
+
+Options:
+    --tub TUBPATHS   画像を読み込む tub ディレクトリ(カンマ区切り、ワイルドカード指定可能)。
+                     指定しない場合は乱数で作成した画像を使用する。
+    --count NUM      使用する画像数。[default: 100]
+    --repeat NUM     画像群を処理する回数。[default: 10]
+    --quality NUM    JPEG品質。[default: 75]
+    --backend NAME   JpegCodec の JPEG ライブラリ(simplejpeg, turbojpeg, cv2, pil)。デフォルトは使用可能な最速のもの。
+"""
+import time
+import base64
+import tracemalloc
+import numpy as np
+from docopt import docopt
+
+import donkeycar as dk
+
+from iotf.jpeg import JpegCodec, get_jpeg_backend
+
+
+def make_images(count, shape=(120, 160, 3), seed=0):
+    """
+    カメラ画像に近い(なめらかな濃淡にノイズを加えた)画像を作成する。
+
+    引数
+        count       画像数
+        shape       画像の形状
+        seed        乱数シード
+    戻り値
+        画像配列(N, height, width, channel)
+    """
+    rng = np.random.RandomState(seed)
+    height, width, channel = shape
+    y, x = np.mgrid[0:height, 0:width]
+    images = np.empty((count,) + shape, dtype=np.uint8)
+    for i in range(count):
+        base = (np.sin(x / rng.uniform(5, 30) + rng.uniform(0, 6)) +
+                np.cos(y / rng.uniform(5, 30) + rng.uniform(0, 6)))
+        base = (base + 2.0) * 60.0
+        noise = rng.normal(0, 8, shape)
+        images[i] = np.clip(base[:, :, None] + noise + rng.uniform(0, 30, channel), 0, 255)
+    return images
+
+
+def load_images(tub_names, count):
+    """
+    tub データから画像を先頭から読み込む。
+
+    引数
+        tub_names   tub ディレクトリのパス
+        count       読み込む件数
+    戻り値
+        画像配列(N, height, width, channel)
+    """
+    from tubdata.catalog import CatalogDataset
+    from tubdata.dataset import TubGroupDataset
+    if CatalogDataset.is_catalog_dir(tub_names):
+        dataset = CatalogDataset(tub_names)
+    else:
+        from donkeycar.parts.datastore import TubGroup
+        dataset = TubGroupDataset(TubGroup(tub_names))
+    positions = np.arange(min(count, len(dataset)))
+    return dataset.get_batch(positions, ['cam/image_array'])[0]
+
+
+def bench(name, func, items, repeat):
+    """
+    items の各要素について func を呼び出し、1件あたりの処理時間と確保メモリ量を表示する。
+
+    引数
+        name        表示名
+        func        1件を処理する関数
+        items       処理対象のリスト
+        repeat      items を処理する回数
+    戻り値
+        最後に処理した結果のリスト
+    """
+    results = [func(item) for item in items]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            func(item)
+    elapsed = time.perf_counter() - start
+    calls = repeat * len(items)
+    # 1件の処理中に確保されたメモリの最大量を処理時間とは別に計測する(tracemalloc 有効時は遅くなるため)
+    peaks = []
+    for item in items:
+        tracemalloc.start()
+        func(item)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    print('{:<24} {:>8.1f}us/image {:>8.0f} bytes/image'.format(
+        name, 1e6 * elapsed / calls, np.mean(peaks)))
+    return results
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    count = int(args['--count'])
+    repeat = int(args['--repeat'])
+    quality = int(args['--quality'])
+
+    if args['--tub']:
+        images = load_images(args['--tub'], count)
+    else:
+        images = make_images(count)
+    backend = args['--backend'] or get_jpeg_backend()
+    print('{} images {}, backend {}'.format(len(images), images.shape[1:], backend))
+    codec = JpegCodec(shape=images.shape[1:], quality=quality, backend=backend)
+
+    # エンコード
+    jpegs = bench('encode current', dk.util.img.arr_to_binary, list(images), repeat)
+    bench('encode codec', codec.encode, list(images), repeat)
+    # デコード(従来は受信側で base64 文字列へ変換された後に画像へ戻す)
+    texts = [base64.b64encode(jpeg).decode('utf-8') for jpeg in jpegs]
+
+    def decode_current(text):
+        data = base64.b64decode(text.encode())
+        return dk.util.img.img_to_arr(dk.util.img.binary_to_img(data))
+
+    decoded = bench('decode current (base64)', decode_current, texts, repeat)
+    bench('decode current (bytes)',
+          lambda data: dk.util.img.img_to_arr(dk.util.img.binary_to_img(data)), jpegs, repeat)
+    bench('decode codec', codec.decode, jpegs, repeat)
+
+    # 従来処理と同じ画像に復元できることを確認する
+    diff = max(np.abs(codec.decode(jpeg).astype(np.int16) - arr).max()
+               for jpeg, arr in zip(jpegs, decoded))
+    print('max pixel difference vs current decode: {}'.format(diff))
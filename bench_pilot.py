@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Keras モデルと量子化済み TensorFlow Lite モデルの推論時間・ステアリング誤差を比較するベンチマーク。
+tub データの画像を1件ずつ推論し、1フレームあたりの推論時間と、
+手動操作値(user/angle)および Keras モデルの出力との差を表示する。
+
+Usage:
+    bench_pilot.py --model=<model> [--tflite=<tflite_path>] [--tub=<tub1,tub2,..tubn>] [--count=<num>] [--threads=<num>]
+
+Options:
+    --model MODEL        Keras モデルファイル。
+    --tflite TFLITE      .tflite ファイル。デフォルトはモデルファイルと並んで存在する .tflite 。
+    --tub TUBPATHS       画像を読み込む tub ディレクトリ(カンマ区切り、ワイルドカード指定可能)。
+                         tubarrange.py --catalog で作成したdataディレクトリも指定可能。デフォルトは config.py の DATA_PATH 配下。
+    --count NUM          推論するフレーム数。[default: 500]
+    --threads NUM        TensorFlow Lite の推論スレッド数。デフォルトは config.py の TFLITE_THREADS 。
+"""
+import os
+import time
+import numpy as np
+from docopt import docopt
+
+import donkeycar as dk
+from donkeycar.parts.keras import KerasLinear
+from donkeycar.parts.datastore import TubGroup
+
+from pilot.tflite import TFLitePilot, get_tflite_path
+from tubdata.catalog import CatalogDataset
+from tubdata.dataset import TubGroupDataset
+
+
+def load_frames(tub_names, count):
+    """
+    tub データから画像と手動操作によるステアリング値を先頭から読み込む。
+
+    引数
+        tub_names   tub ディレクトリのパス
+        count       読み込む件数
+    戻り値
+        images      画像配列(N, height, width, channel)
+        angles      user/angle 配列(N,)
+    """
+    if CatalogDataset.is_catalog_dir(tub_names):
+        dataset = CatalogDataset(tub_names)
+    else:
+        dataset = TubGroupDataset(TubGroup(tub_names))
+    positions = np.arange(min(count, len(dataset)))
+    images, angles = dataset.get_batch(positions, ['cam/image_array', 'user/angle'])
+    return images, angles
+
+
+def bench(name, pilot, images, warmup=5):
+    """
+    1フレームずつ推論し、推論時間を計測する。
+
+    引数
+        name        表示名
+        pilot       run(img_arr) で (angle, throttle) を返却するオブジェクト
+        images      画像配列
+        warmup      計測前に推論する回数
+    戻り値
+        outputs     推論結果配列(N, 2)
+    """
+    for img in images[:warmup]:
+        pilot.run(img)
+    latencies = np.zeros(len(images))
+    outputs = np.zeros((len(images), 2))
+    for i, img in enumerate(images):
+        start = time.perf_counter()
+        outputs[i] = pilot.run(img)
+        latencies[i] = time.perf_counter() - start
+    latencies = latencies * 1000.0
+    print('{:<8} mean {:.2f}ms p50 {:.2f}ms p95 {:.2f}ms max {:.2f}ms ({:.1f} frames/sec)'.format(
+        name, latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 95),
+        latencies.max(), 1000.0 / latencies.mean()))
+    return outputs
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    cfg = dk.load_config()
+
+    model_path = os.path.expanduser(args['--model'])
+    tflite_path = os.path.expanduser(args['--tflite'] or get_tflite_path(model_path))
+    tub_names = args['--tub'] or os.path.join(cfg.DATA_PATH, '*')
+    threads = int(args['--threads']) if args['--threads'] else cfg.TFLITE_THREADS
+
+    images, angles = load_frames(tub_names, int(args['--count']))
+    print('{} frames'.format(len(images)))
+
+    kl = KerasLinear()
+    kl.load(model_path)
+    keras_outputs = bench('keras', kl, images)
+
+    tl = TFLitePilot(num_threads=threads)
+    tl.load(tflite_path)
+    tflite_outputs = bench('tflite', tl, images)
+
+    print('steering MAE vs user/angle: keras {:.4f} tflite {:.4f}'.format(
+        np.abs(keras_outputs[:, 0] - angles).mean(),
+        np.abs(tflite_outputs[:, 0] - angles).mean()))
+    diff = np.abs(tflite_outputs - keras_outputs)
+    print('tflite vs keras: angle MAE {:.4f} max {:.4f}, throttle MAE {:.4f} max {:.4f}'.format(
+        diff[:, 0].mean(), diff[:, 0].max(), diff[:, 1].mean(), diff[:, 1].max()))
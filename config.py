@@ -25,6 +25,41 @@ MODELS_PATH = os.path.join(CAR_PATH, 'models')
 #VEHICLE
 DRIVE_LOOP_HZ = 20
 MAX_LOOPS = 100000
+SCHEDULER_MAX_DEFER = 10 # 優先度 BEST_EFFORT の part を連続して先送りできる最大周回数(0:先送りしない)
+LOG_PATH = os.path.join(CAR_PATH, 'drive.log') # 運転時ログファイル(非同期書き込み)
+LOG_LEVEL = 'INFO' # 運転時ログレベル、DEBUG 指定時は各 part の詳細ログも出力
+INSTRUMENT = False # part ごとの処理時間を計測するかどうか(drive --instrument でも有効化)
+INSTRUMENT_CAPACITY = 6000 # 計測値を保持する周回数(20Hzで5分)
+INSTRUMENT_CSV_PATH = os.path.join(CAR_PATH, 'loop_stats.csv') # 計測サマリ出力先(None:出力しない)
+
+#MULTIPROCESS
+DRIVE_MULTIPROCESS = False # カメラ・オートパイロット・tub書き込みを別プロセスで実行するかどうか
+SHM_RING_SLOTS = 16 # プロセス間で画像を受け渡す共有メモリのスロット数
+
+#PILOT
+PILOT_ASYNC = False # オートパイロットの推論を別スレッドで実行するかどうか
+PILOT_MAX_AGE = 0.25 # 推論結果をこの秒数より古い画像から得た場合は手動操作値へフォールバック
+PILOT_DEDUPE = True # 直前と同じカメラ画像の場合は推論を省略するかどうか
+
+#TFLITE
+TFLITE_QUANTIZE = None # train 時に作成する .tflite の量子化方式(None:作成しない,'dynamic','float16','int8')
+TFLITE_SAMPLES = 200 # int8 量子化の値域推定に使用する画像数
+USE_TFLITE = True # drive --model 指定時、モデルファイルと並んで .tflite があれば使用する
+TFLITE_THREADS = 4 # TensorFlow Lite の推論スレッド数
+
+#TELEMETRY
+TELEMETRY = False # IBM Watson IoT Platform へテレメトリを送信するかどうか(送信は別スレッド)
+TELEMETRY_CONF_PATH = os.path.join(CAR_PATH, 'iotf', 'emperor.ini') # デバイス設定ファイル
+TELEMETRY_PUB_COUNT = 20 * 5 # 送信間隔(ループ周回数)
+TELEMETRY_QUEUE_SIZE = 2 # 送信待ちの最大件数(超えた場合は古いものから破棄)
+TELEMETRY_WIFI_INTERVAL = 2.0 # WiFi リンク品質の読み込み間隔(秒)
+TELEMETRY_ADAPTIVE = True # 送信処理時間・送信待ち件数・WiFi リンク品質に応じて送信間隔・画質を調整するかどうか
+TELEMETRY_MIN_PUB_COUNT = 5 # 送信間隔(ループ周回数)の下限
+TELEMETRY_MAX_PUB_COUNT = 20 * 10 # 送信間隔(ループ周回数)の上限
+TELEMETRY_JPEG_QUALITY = (30, 85) # JPEG品質の(下限, 上限)
+TELEMETRY_MAX_SCALE = 2 # 画像縮小率の上限(1:縮小しない、2:1/2)
+TELEMETRY_TARGET_LATENCY = 0.2 # 送信処理時間(秒)の目標値
+TELEMETRY_WIFI_LOW = 0.4 # WiFi リンク品質(0.0~1.0)がこの値未満の場合は送信間隔・画質を下げる
 
 #CAMERA
 CAMERA_RESOLUTION = (120, 160) #(height, width)
@@ -44,6 +79,18 @@ THROTTLE_REVERSE_PWM = 330 # calib 360 #310
 #TRAINING
 BATCH_SIZE = 128
 TRAIN_TEST_SPLIT = 0.8
+TRAIN_SPLIT_SEED = 200 # トレーニング/評価データ分割の乱数シード
+TRAIN_SPLIT_BINS = 0 # 分割時にuser/angleで層化するビン数(0:層化しない)
+CACHE_PATH = os.path.join(CAR_PATH, 'cache') # デコード済み画像キャッシュ
+CACHE_MAX_BYTES = 2 * 1024 ** 3 # キャッシュファイル最大サイズ(2GB)
+LOADER_WORKERS = 2 # Generatorごとのデコード用ワーカープロセス数(0:逐次デコード)
+LOADER_PREFETCH = 4 # Generatorごとの先読みバッチ数
+AUGMENT = False # トレーニングデータをデータ拡張するかどうか
+AUGMENT_FLIP_PROB = 0.5 # 左右反転(user/angle符号反転)する確率
+AUGMENT_BRIGHTNESS = 0.2 # 明るさの揺らぎ幅(±)
+AUGMENT_CONTRAST = 0.2 # コントラストの揺らぎ幅(±)
+AUGMENT_MAX_SHIFT = 4 # 平行移動の最大ピクセル数(±)
+AUGMENT_SEED = 0 # データ拡張の乱数シード
 
 
 #JOYSTICK
@@ -55,6 +102,9 @@ AUTO_RECORD_ON_THROTTLE = True
 
 
 TUB_PATH = os.path.join(CAR_PATH, 'tub') # if using a single tub
+TUB_WRITER_ASYNC = True # tub への書き込みをバックグラウンドスレッドで行うかどうか
+TUB_WRITER_QUEUE_SIZE = 100 # 書き込み待ちレコードの最大数(超えた分は破棄)
+TUB_WRITER_SYNC_INTERVAL = 5.0 # 書き込んだファイルをディスクへ同期する間隔(秒)
 
 #ROPE.DONKEYCAR.COM
 ROPE_TOKEN="GET A TOKEN AT ROPE.DONKEYCAR.COM"
@@ -1,2 +1,7 @@
 # -*- coding: utf-8 -*-
-from .part import PubTelemetry, SubTelemetry
\ No newline at end of file
+from .part import PubTelemetry, SubTelemetry
+from .wifi import WifiSampler, read_wireless
+from .publisher import AsyncPublisher
+from .img import ImageCodec, FrameCodec, encode_frame, decode_frame, encode_jpeg, upscale_arr
+from .adaptive import AdaptiveTelemetry
+from .jpeg import JpegCodec, get_codec, get_jpeg_backend
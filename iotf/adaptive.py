@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+回線状況に応じてテレメトリの送信間隔・JPEG品質・縮小率を調整するモジュール。
+"""
+
+
+def build_levels(max_quality=85, min_quality=30, quality_step=15, max_scale=2):
+    """
+    画質の段階(JPEG品質, 縮小率)のリストを高画質な順に作成する。
+    縮小率ごとに JPEG 品質を max_quality から min_quality まで下げる。
+
+    引数
+        max_quality     JPEG品質の上限
+        min_quality     JPEG品質の下限
+        quality_step    JPEG品質の刻み
+        max_scale       縮小率の上限(1:縮小しない、2:1/2、4:1/4)
+    戻り値
+        (JPEG品質, 縮小率) のリスト
+    """
+    levels = []
+    scale = 1
+    while scale <= max_scale:
+        quality = max_quality
+        while quality > min_quality:
+            levels.append((quality, scale))
+            quality -= quality_step
+        levels.append((min_quality, scale))
+        scale *= 2
+    return levels
+
+
+class AdaptiveTelemetry:
+    """
+    送信処理時間・送信待ち件数・破棄件数・WiFi リンク品質から回線の混雑を判定し、
+    混雑時は送信間隔を2倍にして画質を1段階下げ、
+    混雑していない状態が recover 回続いた場合は送信間隔、次に画質の順に1段階戻すクラス。
+    """
+
+    def __init__(self, min_count=5, max_count=100, count=None, max_quality=85, min_quality=30,
+                 quality_step=15, max_scale=2, target_latency=0.2, wifi_low=0.4, recover=3):
+        """
+        引数
+            min_count       送信間隔(ループ周回数)の下限
+            max_count       送信間隔(ループ周回数)の上限
+            count           送信間隔の初期値(Noneの場合は min_count)
+            max_quality     JPEG品質の上限
+            min_quality     JPEG品質の下限
+            quality_step    JPEG品質の刻み
+            max_scale       縮小率の上限
+            target_latency  送信処理時間(秒)の目標値、超えた場合は混雑と判定する
+            wifi_low        WiFi リンク品質(0.0~1.0)がこの値未満の場合は混雑と判定する
+            recover         送信間隔・画質を1段階戻すまでに必要な、混雑していない判定の連続回数
+        戻り値
+            なし
+        """
+        self.min_count = min_count
+        self.max_count = max_count
+        self.count = min(max(count or min_count, min_count), max_count)
+        self.levels = build_levels(max_quality, min_quality, quality_step, max_scale)
+        self.level = 0
+        self.target_latency = target_latency
+        self.wifi_low = wifi_low
+        self.recover = recover
+        self.good = 0
+        self.last_dropped = 0
+        self.congested = 0
+        self.updates = 0
+
+    def update(self, latency, backlog, dropped, wifi=None):
+        """
+        直近の送信状況から、次の送信間隔・JPEG品質・縮小率を決定する。
+
+        引数
+            latency     直近の送信処理時間(秒)
+            backlog     送信待ちの件数
+            dropped     送信せずに破棄した累計件数
+            wifi        WiFi リンク品質(0.0~1.0、不明の場合はNone)
+        戻り値
+            count       送信間隔(ループ周回数)
+            quality     JPEG品質
+            scale       縮小率
+        """
+        self.updates += 1
+        congested = (backlog > 0 or dropped > self.last_dropped or
+                     latency > self.target_latency or
+                     (wifi is not None and wifi < self.wifi_low))
+        self.last_dropped = dropped
+        if congested:
+            self.congested += 1
+            self.good = 0
+            self.count = min(self.count * 2, self.max_count)
+            self.level = min(self.level + 1, len(self.levels) - 1)
+        else:
+            self.good += 1
+            if self.good >= self.recover:
+                self.good = 0
+                if self.count > self.min_count:
+                    self.count = max(self.count - max(self.count // 4, 1), self.min_count)
+                elif self.level > 0:
+                    self.level -= 1
+        quality, scale = self.levels[self.level]
+        return self.count, quality, scale
+
+    def report(self):
+        """
+        混雑判定の回数と現在の送信間隔・画質を表示する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        quality, scale = self.levels[self.level]
+        print('adaptive telemetry: {} updates, {} congested, interval {} loops, quality {}, scale 1/{}'.format(
+            self.updates, self.congested, self.count, quality, scale))
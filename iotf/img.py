@@ -6,19 +6,35 @@ donkeycarのvehicleフレームワークで取り扱う、画像イメージデ
 """
 from datetime import datetime
 import pytz
+import time
+import struct
 import base64
 import numpy as np
 from ibmiotf import Message
-import donkeycar as dk
+from .jpeg import get_codec
 
 from logging import getLogger
 logger = getLogger(__name__)
 
+# テレメトリフレームのヘッダ(リトルエンディアン、41バイト)
+#   識別子(2バイト) バージョン(uint8) モード(uint8) シーケンス番号(uint32) 時刻(float64)
+#   user/angle user/throttle pilot/angle pilot/throttle angle throttle(float32 x 6)
+#   WiFi リンク品質(uint8、0~100、不明時は255)
+# ヘッダの直後に JPEG 画像が続く
+FRAME_HEADER = struct.Struct('<2sBBId6fB')
+FRAME_MAGIC = b'EF'
+FRAME_VERSION = 1
+# 運転モードの番号(リスト外のモードは255)
+FRAME_MODES = ['user', 'local_angle', 'local']
+# float32 で送信する値のキー
+FRAME_KEYS = ['user/angle', 'user/throttle', 'pilot/angle', 'pilot/throttle', 'angle', 'throttle']
+UNKNOWN = 255
+
 class ImageCodec:
     @staticmethod
     def encode(data=None, timestamp=None):
         '''
-        np.ndarray形式の場合はdonkeycar.util.imgを使ってバイナリへ変換する。
+        np.ndarray形式の場合は JpegCodec(iotf.jpeg) を使ってバイナリへ変換する。
         文字列型の場合は、encode()後、base64でdecodeしてバイナリへ変換する。
         その他はそのまま送信する。
 
@@ -30,11 +46,12 @@ class ImageCodec:
         '''
         if type(data) is np.ndarray:
             logger.debug('encode: data is np.ndarray')
-            return dk.util.img.arr_to_binary(data)
+            # paho-mqtt は memoryview を受け付けないため、送信データとしてのみ複製する
+            return bytes(encode_jpeg(data))
         if type(data) is str:
             logger.debug('encode: data is str')
             return base64.b64decode(data.encode())
-        logger.debug('encode: data is {}'.format(str(type(data))))
+        logger.debug('encode: data is %s', type(data))
         return data
 
     @staticmethod
@@ -60,6 +77,8 @@ class ImageCodec:
     def encode_to_arr(data=None, timestamp=None):
         '''
         data をnd.array型式(120,160,3)型のuint8配列に変換する。
+        JPEG のデコード先は JpegCodec が保持する配列であり、一定回数後のデコードで上書きされる。
+        戻り値を保持する呼び出し元は複製すること。
     
         引数
             data        送信データ
@@ -72,19 +91,158 @@ class ImageCodec:
             data = base64.b64decode(data.encode())
         if type(data) is bytes:
             logger.debug('encode_to_arr: data is bytes')
-            data = dk.util.img.binary_to_img(data)
-            data = dk.util.img.img_to_arr(data)
-        logger.debug('encode_to_arr: data is converted to {}'.format(str(type(data))))
+            data = get_codec().decode(data)
+        logger.debug('encode_to_arr: data is converted to %s', type(data))
         return data
 
     @staticmethod
-    def get_now_str():
+    def get_now_str(timestamp=None):
         '''
         現在時刻文字列を取得する。
 
         引数
-            なし
+            timestamp   時刻(time.time()、Noneの場合は現在時刻)
         戻り値
             現在時刻文字列
         '''
+        if timestamp is not None:
+            return str(datetime.fromtimestamp(timestamp, pytz.timezone('UTC')))
         return str(datetime.now(pytz.timezone('UTC')))
+
+
+def encode_jpeg(image_array, quality=75, scale=1):
+    '''
+    画像を縦横 1/scale に間引いて JPEG バイト列へ変換する。
+    戻り値は JpegCodec が保持するバイト列であり、同じスレッドの次のエンコードで上書きされる。
+
+    引数
+        image_array     画像(np.ndarray)
+        quality         JPEG品質
+        scale           縮小率(1:縮小しない)
+    戻り値
+        JPEG バイト列の memoryview
+    '''
+    return get_codec().encode(image_array, quality=quality, scale=scale)
+
+
+def upscale_arr(image_array, shape, out=None):
+    '''
+    縮小して送信された画像を画素の複製で shape へ拡大し、out へ書き込む。
+    同じ形状の場合も out へ複製するため、デコード先のバッファを参照し続けることはない。
+
+    引数
+        image_array     画像(np.ndarray)
+        shape           拡大後の形状 (height, width, channel)
+        out             書き込み先の画像配列(Noneの場合は新たに確保する)
+    戻り値
+        画像(np.ndarray)
+    '''
+    if out is None:
+        out = np.zeros(shape, dtype=image_array.dtype)
+    if image_array.shape == out.shape:
+        np.copyto(out, image_array)
+        return out
+    scale = max(out.shape[0] // image_array.shape[0], 1)
+    for dy in range(scale):
+        for dx in range(scale):
+            dst = out[dy::scale, dx::scale]
+            height = min(dst.shape[0], image_array.shape[0])
+            width = min(dst.shape[1], image_array.shape[1])
+            dst[:height, :width] = image_array[:height, :width]
+    return out
+
+
+def encode_frame(message):
+    '''
+    ステータスと画像を1件のテレメトリフレーム(固定長ヘッダ + JPEG)へ変換する。
+
+    引数
+        message     'seq', 'timestamp', 'user/mode', FRAME_KEYS の各値, 'wifi',
+                    'image_array'(np.ndarray もしくは JPEG バイト列) を持つ辞書
+                    'jpeg_quality', 'scale' がある場合は JPEG品質・縮小率として使用する
+    戻り値
+        フレームのバイト列(画像が np.ndarray の場合は JpegCodec が保持するバイト列の memoryview で、
+        同じスレッドの次のエンコードで上書きされる)
+    '''
+    mode = message.get('user/mode')
+    mode = FRAME_MODES.index(mode) if mode in FRAME_MODES else UNKNOWN
+    # 未推論などで値がない場合は NaN とする
+    values = [float('nan') if message.get(key) is None else message[key] for key in FRAME_KEYS]
+    wifi = message.get('wifi')
+    if isinstance(wifi, dict):
+        wifi = max(wifi.values()) if len(wifi) > 0 else None
+    wifi = UNKNOWN if wifi is None else int(round(100 * min(max(wifi, 0.0), 1.0)))
+    timestamp = message.get('timestamp')
+    header = (FRAME_MAGIC, FRAME_VERSION, mode,
+              message.get('seq', 0) & 0xffffffff,
+              time.time() if timestamp is None else timestamp)
+    image = message.get('image_array')
+    if type(image) is np.ndarray:
+        # ヘッダ分を空けて JPEG を書き込み、同じバッファの先頭へヘッダを書き込む
+        codec = get_codec()
+        view = codec.encode(image, quality=message.get('jpeg_quality'),
+                            scale=message.get('scale', 1), offset=FRAME_HEADER.size)
+        FRAME_HEADER.pack_into(codec.out, 0, *(header + tuple(values) + (wifi,)))
+        return view
+    return FRAME_HEADER.pack(*(header + tuple(values) + (wifi,))) + (image or b'')
+
+
+def decode_frame(data):
+    '''
+    テレメトリフレームをステータス辞書へ変換する。画像は JPEG バイト列のまま返却する。
+
+    引数
+        data        フレームのバイト列
+    戻り値
+        'seq', 'timestamp', 'user/mode', FRAME_KEYS の各値, 'wifi', 'image' を持つ辞書
+    例外
+        Exception   フレームの識別子・バージョンが一致しない場合
+    '''
+    fields = FRAME_HEADER.unpack_from(data)
+    if fields[0] != FRAME_MAGIC or fields[1] != FRAME_VERSION:
+        raise Exception('unknown telemetry frame: magic={} version={}'.format(fields[0], fields[1]))
+    mode = fields[2]
+    message = {
+        'seq':          fields[3],
+        'timestamp':    fields[4],
+        'user/mode':    FRAME_MODES[mode] if mode < len(FRAME_MODES) else 'n/a',
+        'wifi':         None if fields[11] == UNKNOWN else fields[11] / 100.0,
+        'image':        bytes(data[FRAME_HEADER.size:]),
+    }
+    for key, value in zip(FRAME_KEYS, fields[5:11]):
+        message[key] = value
+    return message
+
+
+class FrameCodec:
+    '''
+    テレメトリフレーム用の ibmiotf カスタムコーデック。
+    ImageCodec と異なり、受信側で base64 変換しない。
+    '''
+    @staticmethod
+    def encode(data=None, timestamp=None):
+        '''
+        ステータス辞書をフレームのバイト列へ変換する。
+
+        引数
+            data        encode_frame() の引数と同じ辞書(バイト列の場合はそのまま送信する)
+            timestamp   時刻（使用されない）
+        戻り値
+            実際に送信される送信データ
+        '''
+        if isinstance(data, dict):
+            # paho-mqtt は memoryview を受け付けないため、送信データとしてのみ複製する
+            return bytes(encode_frame(data))
+        return data
+
+    @staticmethod
+    def decode(message):
+        '''
+        受信したフレームをステータス辞書として Message オブジェクトへ格納、返却する。
+
+        引数
+            message     受信データ
+        戻り値
+            ibmiotfパッケージとして取扱可能なMessageオブジェクト
+        '''
+        return Message(decode_frame(message.payload), datetime.now(pytz.timezone('UTC')))
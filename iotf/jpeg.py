@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+事前に確保したバッファを再利用して JPEG エンコード・デコードを行うモジュール。
+使用可能なライブラリのうち最も速いもの(simplejpeg, turbojpeg, cv2, PIL の順)を使用する。
+バッファはスレッドごとに保持するため、送信スレッドと受信スレッドで同時に使用できる。
+"""
+import io
+import threading
+import numpy as np
+from PIL import Image
+
+# 優先順の JPEG ライブラリ名
+BACKENDS = ['simplejpeg', 'turbojpeg', 'cv2', 'pil']
+
+
+def get_jpeg_backend():
+    """
+    使用可能な JPEG ライブラリのうち最も優先度の高いものの名前を返却する。
+
+    引数
+        なし
+    戻り値
+        BACKENDS のいずれか
+    """
+    for name in BACKENDS[:-1]:
+        try:
+            __import__(name)
+            return name
+        except ImportError:
+            continue
+    return 'pil'
+
+
+class BufferWriter:
+    """
+    PIL の save() の出力先として、bytearray の offset 以降へ書き込むファイル代替クラス。
+    容量が不足した場合のみ新しい bytearray を確保する。
+    """
+
+    def __init__(self, buf, offset=0):
+        self.buf = buf
+        self.pos = offset
+
+    def write(self, data):
+        end = self.pos + len(data)
+        if end > len(self.buf):
+            # 返却済みの memoryview があると拡張できないため作り直す
+            buf = bytearray(max(end, 2 * len(self.buf)))
+            buf[:self.pos] = self.buf[:self.pos]
+            self.buf = buf
+        self.buf[self.pos:end] = data
+        self.pos = end
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class JpegCodec:
+    """
+    デコード先の画像配列とエンコード先のバイト列を再利用する JPEG コーデッククラス。
+    decode() の戻り値は buffers 回後の decode() で上書きされ、
+    encode() の戻り値は次の encode() で上書きされる。
+    戻り値を保持する呼び出し元は複製すること。
+    """
+
+    def __init__(self, shape=(120, 160, 3), quality=75, backend=None, buffers=3):
+        """
+        バッファを確保し、JPEG ライブラリを読み込む。
+
+        引数
+            shape       デコードする画像の形状 (height, width, channel)
+            quality     エンコード時のデフォルト JPEG品質
+            backend     JPEG ライブラリ名(Noneの場合は get_jpeg_backend())
+            buffers     デコード先として順に使用する画像配列の数
+        戻り値
+            なし
+        """
+        self.shape = tuple(shape)
+        self.quality = quality
+        self.backend = backend or get_jpeg_backend()
+        self.buffers = [np.empty(self.shape, dtype=np.uint8) for _ in range(buffers)]
+        self.index = 0
+        # shape と異なる大きさの画像のデコード先 {shape: 画像配列}
+        self.sized = {}
+        # PIL のデコード先 {shape: (RGBX 画像配列, 配列とメモリを共有する PIL 画像)}
+        self.pil_targets = {}
+        # 無圧縮より大きくなることはほぼないため画像1件分を確保する
+        self.out = bytearray(int(np.prod(self.shape)) + 4096)
+        self.bgr = None
+        self.pil_image = None
+        if self.backend == 'simplejpeg':
+            import simplejpeg
+            self.lib = simplejpeg
+        elif self.backend == 'turbojpeg':
+            import turbojpeg
+            self.lib = turbojpeg
+            self.jpeg = turbojpeg.TurboJPEG()
+        elif self.backend == 'cv2':
+            import cv2
+            self.lib = cv2
+            self.bgr = np.empty(self.shape, dtype=np.uint8)
+        else:
+            # 画像の内容を書き換えて再利用する PIL 画像
+            self.pil_image = Image.new('RGB', (self.shape[1], self.shape[0]))
+
+    def next_buffer(self):
+        """
+        次のデコード先の画像配列を返却する。
+
+        引数
+            なし
+        戻り値
+            画像配列(np.ndarray)
+        """
+        buf = self.buffers[self.index]
+        self.index = (self.index + 1) % len(self.buffers)
+        return buf
+
+    def get_buffer(self, shape, out=None):
+        """
+        指定した形状の画像のデコード先を返却する。
+        shape と異なる大きさの画像は形状ごとに1つ確保した配列を使用し、
+        同じ形状の次の decode() で上書きされる。
+
+        引数
+            shape       画像の形状 (height, width, channel)
+            out         呼び出し元が指定したデコード先の画像配列(Noneの場合は保持しているバッファ)
+        戻り値
+            画像配列(np.ndarray)
+        """
+        shape = tuple(shape)
+        if out is not None and out.shape == shape:
+            return out
+        if shape == self.shape:
+            return self.next_buffer()
+        buf = self.sized.get(shape)
+        if buf is None:
+            buf = np.empty(shape, dtype=np.uint8)
+            self.sized[shape] = buf
+        return buf
+
+    def get_pil_target(self, shape):
+        """
+        PIL のデコード先として、numpy 配列とメモリを共有する RGBX 画像を返却する。
+        PIL の RGB 画像は1画素4バイトで保持されるため、RGB 配列とは直接共有できない。
+
+        引数
+            shape       画像の形状 (height, width, channel)
+        戻り値
+            rgbx        RGBX 画像配列(np.ndarray、(height, width, 4))
+            img         rgbx とメモリを共有する PIL 画像
+        """
+        target = self.pil_targets.get(shape)
+        if target is None:
+            rgbx = np.empty((shape[0], shape[1], 4), dtype=np.uint8)
+            img = Image.frombuffer('RGBX', (shape[1], shape[0]), rgbx, 'raw', 'RGBX', 0, 1)
+            target = (rgbx, img)
+            self.pil_targets[shape] = target
+        return target
+
+    def decode(self, data, out=None):
+        """
+        JPEG バイト列を画像配列へデコードする。
+        戻り値は保持しているバッファのため、呼び出し元で保持する場合は複製すること。
+
+        引数
+            data        JPEG バイト列
+            out         デコード先の画像配列(Noneの場合は保持しているバッファ)
+        戻り値
+            画像配列(np.ndarray、out と異なる大きさの画像の場合は get_buffer() の配列)
+        """
+        if self.backend == 'simplejpeg':
+            height, width = self.lib.decode_jpeg_header(data)[:2]
+            out = self.get_buffer((height, width, 3), out)
+            try:
+                return self.lib.decode_jpeg(data, colorspace='RGB', buffer=out)
+            except TypeError:
+                # buffer 引数のない旧バージョン
+                arr = self.lib.decode_jpeg(data, colorspace='RGB')
+        elif self.backend == 'turbojpeg':
+            arr = self.jpeg.decode(data, pixel_format=self.lib.TJPF_RGB)
+        elif self.backend == 'cv2':
+            bgr = self.lib.imdecode(np.frombuffer(data, dtype=np.uint8), self.lib.IMREAD_COLOR)
+            out = self.get_buffer(bgr.shape, out)
+            return self.lib.cvtColor(bgr, self.lib.COLOR_BGR2RGB, dst=out)
+        else:
+            # ヘッダのみ読み込み、画素は再利用する PIL 画像へ直接デコードする
+            img = Image.open(io.BytesIO(data))
+            shape = (img.size[1], img.size[0], 3)
+            out = self.get_buffer(shape, out)
+            if img.mode == 'RGB':
+                rgbx, target = self.get_pil_target(shape)
+                target.frombytes(data, 'jpeg', ('RGBX', ''))
+                np.copyto(out, rgbx[:, :, :3])
+                return out
+            # グレースケール・CMYK の JPEG
+            arr = np.asarray(img.convert('RGB'))
+        out = self.get_buffer(arr.shape, out)
+        np.copyto(out, arr)
+        return out
+
+    def encode(self, image_array, quality=None, scale=1, offset=0):
+        """
+        画像配列を JPEG へエンコードし、保持しているバイト列の offset 以降へ書き込む。
+        offset より前はヘッダ用に呼び出し元が使用できる(self.out)。
+
+        引数
+            image_array     画像配列(np.ndarray、uint8)
+            quality         JPEG品質(Noneの場合はコンストラクタ指定値)
+            scale           縮小率(1:縮小しない、間引きで縮小する)
+            offset          書き込み開始位置
+        戻り値
+            self.out の先頭から JPEG の末尾までの memoryview
+        """
+        quality = self.quality if quality is None else quality
+        if scale > 1:
+            image_array = image_array[::scale, ::scale]
+        if self.backend == 'pil':
+            if image_array.shape == self.shape:
+                self.pil_image.frombytes(np.ascontiguousarray(image_array))
+                img = self.pil_image
+            else:
+                img = Image.fromarray(np.ascontiguousarray(image_array))
+            writer = BufferWriter(self.out, offset)
+            img.save(writer, format='jpeg', quality=quality)
+            self.out = writer.buf
+            return memoryview(self.out)[:writer.pos]
+        if self.backend == 'simplejpeg':
+            jpeg = self.lib.encode_jpeg(np.ascontiguousarray(image_array), quality=quality,
+                                        colorspace='RGB')
+        elif self.backend == 'turbojpeg':
+            jpeg = self.jpeg.encode(np.ascontiguousarray(image_array), quality=quality,
+                                    pixel_format=self.lib.TJPF_RGB)
+        else:
+            bgr = self.bgr if image_array.shape == self.bgr.shape else None
+            bgr = self.lib.cvtColor(image_array, self.lib.COLOR_RGB2BGR, dst=bgr)
+            jpeg = self.lib.imencode('.jpg', bgr, [self.lib.IMWRITE_JPEG_QUALITY, quality])[1]
+        writer = BufferWriter(self.out, offset)
+        writer.write(jpeg)
+        self.out = writer.buf
+        return memoryview(self.out)[:writer.pos]
+
+
+# スレッドごとの JpegCodec
+_local = threading.local()
+
+
+def get_codec(shape=(120, 160, 3)):
+    """
+    呼び出し元スレッド用の JpegCodec を返却する。
+
+    引数
+        shape       デコードする画像の形状(初回呼び出し時のみ使用)
+    戻り値
+        JpegCodec オブジェクト
+    """
+    codec = getattr(_local, 'codec', None)
+    if codec is None:
+        codec = _local.codec = JpegCodec(shape=shape)
+    return codec
@@ -1,26 +1,40 @@
 # -*- coding: utf-8 -*-
+import time
 import numpy as np
-import subprocess as spc
 import ibmiotf.device
 import ibmiotf.application
-from .img import ImageCodec
+from .img import ImageCodec, FrameCodec
+from .wifi import WifiSampler
+from .publisher import AsyncPublisher
+from .img import upscale_arr
 
-from logging import getLogger, basicConfig, DEBUG
-basicConfig(filename='donkeypart_telemetry_iotf.log', filemode='w', level=DEBUG)
+# ログ出力先・レベルは呼び出し元で設定する(manage.py では loop.start_logging)
+from logging import getLogger
 logger = getLogger(__name__)
 
 class PubTelemetry:
-    def __init__(self, dev_conf_path, pub_count=20):
+    def __init__(self, dev_conf_path, pub_count=20, wifi_interval=2.0, queue_size=2, adaptive=None):
         self.count = 0
         self.pub_count = pub_count
+        # 送信したフレームのシーケンス番号
+        self.seq = 0
+        # 送信間隔・画質を調整する AdaptiveTelemetry オブジェクト(Noneの場合は固定)
+        self.adaptive = adaptive
+        self.jpeg_quality = None
+        self.scale = 1
         try:
             options = ibmiotf.device.ParseConfigFile(dev_conf_path)
             self.client = ibmiotf.device.Client(options)
             self.client.setMessageEncoderModule('image', ImageCodec)
+            self.client.setMessageEncoderModule('frame', FrameCodec)
             self.client.connect()
         except ibmiotf.ConnectionException  as e:
             logger.error('error at PubTelemetry __init__', exc_info=True)
             raise e
+        # WiFi リンク品質はバックグラウンドスレッドで読み込む
+        self.wifi = WifiSampler(interval=wifi_interval, ttl=5 * wifi_interval)
+        # JPEGエンコード・送信は送信スレッドで行う
+        self.publisher = AsyncPublisher(self.publish, queue_size=queue_size, name='telemetry')
 
     def run(self, image_array, user_mode, user_angle, user_throttle, pilot_angle, pilot_throttle, angle, throttle):
         # pub_count数に達したら実行
@@ -31,7 +45,18 @@ class PubTelemetry:
         else:
             self.count = 0
 
+        wifi = self.get_wifi_quality()
+        if self.adaptive is not None:
+            # 直近の送信状況から次の送信間隔・画質を決定する
+            self.pub_count, self.jpeg_quality, self.scale = self.adaptive.update(
+                self.publisher.last_latency, self.publisher.backlog(), self.publisher.dropped,
+                max(wifi.values()) if len(wifi) > 0 else None)
+
+        # 画像は参照のみ投入する(カメラ part は画像ごとに新しい配列を返却する)
+        self.seq += 1
         message = {
+            "seq":              self.seq,
+            "image_array":      image_array,
             "user/mode":        user_mode,
             "user/angle":       user_angle,
             "user/throttle":    user_throttle,
@@ -39,54 +64,56 @@ class PubTelemetry:
             "pilot/throttle":   pilot_throttle,
             "angle":            angle,
             "throttle":         throttle,
-            "wifi":             self.get_wifi_quality(),
-            "timestamp":        ImageCodec.get_now_str()
+            "wifi":             wifi,
+            "timestamp":        time.time()
         }
+        if self.jpeg_quality is not None:
+            message["jpeg_quality"] = self.jpeg_quality
+            message["scale"] = self.scale
+        self.publisher.put(message)
 
+    def publish(self, message):
+        '''
+        画像とステータスを1件のテレメトリフレーム(iotf.img.encode_frame)として送信する。
+        送信スレッドから呼び出される。
+
+        引数
+            message     ステータス辞書('image_array' に画像を含む)
+        戻り値
+            なし
+        '''
         success = self.client.publishEvent(
             event='status', 
-            msgFormat='image', 
-            data=image_array, 
-            qos=0, 
-            on_publish=self.on_publish_image)
-        logger.debug('publish image result={}'.format(str(success)))
-        success = self.client.publishEvent(
-            event='status', 
-            msgFormat='json', 
+            msgFormat='frame', 
             data=message, 
             qos=0, 
-            on_publish=self.on_publish_json)
-        logger.debug('publish json result={}'.format(str(success)))
+            on_publish=self.on_publish_frame)
+        logger.debug('publish frame result=%s', success)
 
-    def on_publish_image(self):
-        logger.debug('on_publish_image called')
-    def on_publish_json(self):
-        logger.debug('on_publish_json called')
+    def on_publish_frame(self):
+        logger.debug('on_publish_frame called')
     def shutdown(self):
         logger.debug('shutdown called')
+        self.publisher.shutdown()
+        if self.adaptive is not None:
+            self.adaptive.report()
+        self.wifi.shutdown()
         self.client.disconnect()
     
     def get_wifi_quality(self):
-        res = spc.check_output('getsi')
-        bytewords = res.split()
-        total = len(bytewords)
-        data = {}
-        i=0
-        while(i<total):
-            word = str(bytewords[i]).split('\'')[1]
-            if word.startswith('Address'):
-                key = str(bytewords[i+1]).split('\'')[1]
-                value = str(bytewords[i+2])
-                value = value.split('=')[1]
-                value = value.split('/')[0]
-                value = 70.0 /float(value)
-                data[key] = value
-                i = i + 2
-            i = i + 1
-        return data
+        '''
+        WifiSampler が保持している最新の WiFi リンク品質を返却する。
+        外部コマンドは起動しない。
+
+        引数
+            なし
+        戻り値
+            {インタフェース名: リンク品質(0.0~1.0)} 辞書(未計測・計測値が古い場合は空辞書)
+        '''
+        return self.wifi.get()
 
 class PubImage:
-    def __init__(self, dev_conf_path, pub_count=20):
+    def __init__(self, dev_conf_path, pub_count=20, queue_size=2):
         self.count = 0
         self.pub_count = pub_count
         try:
@@ -97,6 +124,8 @@ class PubImage:
         except ibmiotf.ConnectionException  as e:
             logger.error('connecttion exception', exc_info=True)
             raise e
+        # JPEGエンコード・送信は送信スレッドで行う
+        self.publisher = AsyncPublisher(self.publish, queue_size=queue_size, name='image')
 
     def run(self, image_array):
         # pub_count数に達したら実行
@@ -106,16 +135,27 @@ class PubImage:
             return
         else:
             self.count = 0
+        self.publisher.put(image_array)
+
+    def publish(self, image_array):
+        '''
+        画像を送信する。送信スレッドから呼び出される。
 
+        引数
+            image_array     カメラ画像イメージデータ(np.ndarray)
+        戻り値
+            なし
+        '''
         success = self.client.publishEvent(
             event='pilot', 
             msgFormat='image', 
             data=image_array, 
             qos=0)
-        logger.debug('publish image result={}'.format(str(success)))
+        logger.debug('publish image result=%s', success)
 
     def shutdown(self):
         logger.debug('shutdown called')
+        self.publisher.shutdown()
         self.client.disconnect()
 
 class SubTelemetry:
@@ -140,6 +180,7 @@ class SubTelemetry:
             app_options = ibmiotf.application.ParseConfigFile(app_conf_path)
             self.client = ibmiotf.application.Client(app_options)
             self.client.setMessageEncoderModule('image', ImageCodec)
+            self.client.setMessageEncoderModule('frame', FrameCodec)
             self.client.connect()
 
             self.client.deviceEventCallback = self.on_subscribe
@@ -148,17 +189,32 @@ class SubTelemetry:
                     deviceType=self.dev_type, 
                     deviceId=self.dev_id, 
                     event='status')
-            logger.debug('subscribe start devType:{} devId:{} event:status'.format(self.dev_type, self.dev_id))
+            logger.debug('subscribe start devType:%s devId:%s event:status', self.dev_type, self.dev_id)
         except ibmiotf.ConnectionException  as e:
             logger.error('error at SubTelemetry __init__', exc_info=True)
             raise e
     
     def on_subscribe(self, event):
         data = event.data
-        logger.debug('on_subscribe: data is {}'.format(str(type(data))))
-        if event.format == 'image':
+        logger.debug('on_subscribe: data is %s', type(data))
+        if event.format == 'frame':
+            # FrameCodec.decode でステータス辞書へ変換済み
+            logger.debug('frame data seq=%s', data['seq'])
+            # 縮小して送信された画像は元の大きさへ戻す
+            # デコード先は共有バッファのため、保持する画像は複製する
+            self.image_array = upscale_arr(ImageCodec.encode_to_arr(data['image']),
+                                           self.image_array.shape)
+            self.user_mode = data['user/mode']
+            self.user_angle = data['user/angle']
+            self.user_throttle = data['user/throttle']
+            self.pilot_angle = data['pilot/angle']
+            self.pilot_throttle = data['pilot/throttle']
+            self.angle = data['angle']
+            self.throttle = data['throttle']
+            self.timestamp = ImageCodec.get_now_str(data['timestamp'])
+        elif event.format == 'image':
             logger.debug('image data')
-            self.image_array = ImageCodec.encode_to_arr(data)
+            self.image_array = np.array(ImageCodec.encode_to_arr(data))
         elif event.format == 'json':
             logger.debug('json data')
             self.user_mode = data.get('user/mode', self.user_mode)
@@ -218,19 +274,19 @@ class SubPilot:
                     deviceType=self.dev_type, 
                     deviceId=self.dev_id, 
                     event='pilot')
-            logger.debug('subscribe start devType:{} devId:{} event:pilot'.format(self.dev_type, self.dev_id))
+            logger.debug('subscribe start devType:%s devId:%s event:pilot', self.dev_type, self.dev_id)
         except ibmiotf.ConnectionException  as e:
             logger.error('connection exception', exc_info=True)
             raise e
     
     def on_subscribe(self, event):
         data = event.data
-        logger.debug('on_subscribe: data is {}'.format(str(type(data))))
+        logger.debug('on_subscribe: data is %s', type(data))
         if event.format == 'image':
             logger.debug('update image_array')
-            self.image_array = ImageCodec.encode_to_arr(data)
+            self.image_array = np.array(ImageCodec.encode_to_arr(data))
         else:
-            logger.debug('ignore data: format {}'.format(event.format))
+            logger.debug('ignore data: format %s', event.format)
 
     def run(self):
         """
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+テレメトリの送信を Vehicle ループとは別のスレッドで行うモジュール。
+Vehicle ループは送信データの参照をキューへ投入するだけで、
+JPEGエンコード・MQTT送信は送信スレッドが行う。
+"""
+import time
+import threading
+from collections import deque
+
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+class AsyncPublisher:
+    """
+    上限付きキューと送信スレッドを持つクラス。
+    キューが満杯の場合は最も古いデータを破棄し、常に新しいデータを送信する。
+    """
+
+    def __init__(self, send, queue_size=2, name='publisher'):
+        """
+        送信スレッドを開始する。
+
+        引数
+            send        送信データを1件受け取り送信する関数(送信スレッドで呼び出す)
+            queue_size  キューに保持する最大件数
+            name        スレッド名・表示名
+        戻り値
+            なし
+        """
+        self.send = send
+        self.name = name
+        self.queue = deque(maxlen=queue_size)
+        self.cond = threading.Condition()
+        self.enqueued = 0
+        self.dropped = 0
+        self.published = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        # 直近の送信処理時間(秒)
+        self.last_latency = 0.0
+        self.on = True
+        self.thread = threading.Thread(target=self.update, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, item):
+        """
+        送信データをキューへ投入する。満杯の場合は最も古いデータを破棄する。
+
+        引数
+            item        送信データ
+        戻り値
+            なし
+        """
+        with self.cond:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append((time.time(), item))
+            self.enqueued += 1
+            self.cond.notify()
+
+    def backlog(self):
+        """
+        送信待ちの件数を返却する。
+
+        引数
+            なし
+        戻り値
+            キュー内の件数
+        """
+        return len(self.queue)
+
+    def update(self):
+        """
+        送信スレッドの処理。キューからデータを取り出して送信する。
+        停止後もキューに残っているデータは送信する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        while True:
+            with self.cond:
+                while self.on and len(self.queue) == 0:
+                    self.cond.wait(0.5)
+                if len(self.queue) == 0:
+                    break
+                queued_time, item = self.queue.popleft()
+            start = time.time()
+            try:
+                self.send(item)
+                self.published += 1
+            except Exception:
+                self.failed += 1
+                logger.warning('%s: failed to publish', self.name, exc_info=True)
+            now = time.time()
+            self.last_latency = now - start
+            # キュー投入から送信完了までの時間
+            latency = now - queued_time
+            self.latency_total += latency
+            if latency > self.latency_max:
+                self.latency_max = latency
+
+    def shutdown(self, timeout=2.0):
+        """
+        送信スレッドを停止し、件数・送信時間を表示する。
+
+        引数
+            timeout     送信待ちデータの送信を待つ最大秒数
+        戻り値
+            なし
+        """
+        with self.cond:
+            self.on = False
+            self.cond.notify()
+        self.thread.join(timeout)
+        print('{}: {} enqueued, {} published, {} dropped, {} failed, latency mean {:.1f}ms max {:.1f}ms'.format(
+            self.name, self.enqueued, self.published, self.dropped, self.failed,
+            1000.0 * self.latency_total / max(self.published + self.failed, 1),
+            1000.0 * self.latency_max))
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+WiFi リンク品質をバックグラウンドスレッドで /proc/net/wireless から読み込むモジュール。
+外部コマンド(getsi/iwlist)を起動しないため、Vehicle ループから読み出す際の処理は
+保持済みの値を返却するのみとなる。
+"""
+import time
+import threading
+
+from logging import getLogger
+logger = getLogger(__name__)
+
+# Raspberry Pi(brcmfmac) のリンク品質の最大値
+MAX_QUALITY = 70.0
+
+
+def read_wireless(path='/proc/net/wireless'):
+    """
+    /proc/net/wireless を読み込み、インタフェースごとのリンク品質・信号強度・ノイズを返却する。
+
+    引数
+        path        読み込むファイルのパス
+    戻り値
+        {インタフェース名: (link, level, noise)} 辞書(読み込めない場合は空辞書)
+    """
+    data = {}
+    try:
+        with open(path, 'r') as f:
+            # 先頭2行はヘッダ
+            lines = f.readlines()[2:]
+    except (IOError, OSError):
+        return data
+    for line in lines:
+        if ':' not in line:
+            continue
+        iface, values = line.split(':', 1)
+        words = values.split()
+        if len(words) < 4:
+            continue
+        try:
+            link, level, noise = [float(w.rstrip('.')) for w in words[1:4]]
+        except ValueError:
+            continue
+        data[iface.strip()] = (link, level, noise)
+    return data
+
+
+class WifiSampler:
+    """
+    一定間隔で WiFi リンク品質を読み込み、最新値を保持するクラス。
+    get() は保持済みの値を返却するだけで、ファイル読み込みは行わない。
+    """
+
+    def __init__(self, interval=2.0, ttl=10.0, path='/proc/net/wireless', max_quality=MAX_QUALITY):
+        """
+        読み込みスレッドを開始する。
+
+        引数
+            interval        読み込み間隔(秒)
+            ttl             保持値の有効期間(秒)、超えた場合は get() で空辞書を返却する
+            path            読み込むファイルのパス
+            max_quality     リンク品質の最大値(0.0~1.0 へ正規化するため)
+        戻り値
+            なし
+        """
+        self.interval = interval
+        self.ttl = ttl
+        self.path = path
+        self.max_quality = max_quality
+        # (読み込み時刻, {インタフェース名: リンク品質}) を1つの参照として差し替える
+        self.snapshot = (0.0, {})
+        self.samples = 0
+        self.on = True
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.update, name='wifi sampler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def sample(self):
+        """
+        リンク品質を1回読み込み、保持値を更新する。
+
+        引数
+            なし
+        戻り値
+            {インタフェース名: リンク品質(0.0~1.0)} 辞書
+        """
+        quality = dict((iface, values[0] / self.max_quality)
+                       for iface, values in read_wireless(self.path).items())
+        self.snapshot = (time.time(), quality)
+        self.samples += 1
+        return quality
+
+    def update(self):
+        """
+        読み込みスレッドの処理。interval 秒ごとに読み込む。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        while self.on:
+            try:
+                self.sample()
+            except Exception:
+                logger.warning('failed to read %s', self.path, exc_info=True)
+            self.stop_event.wait(self.interval)
+
+    def get(self):
+        """
+        保持している最新のリンク品質を返却する。
+
+        引数
+            なし
+        戻り値
+            {インタフェース名: リンク品質(0.0~1.0)} 辞書(ttl 秒より古い場合は空辞書)
+        """
+        stamp, quality = self.snapshot
+        if time.time() - stamp > self.ttl:
+            return {}
+        return quality
+
+    def shutdown(self):
+        """
+        読み込みスレッドを停止する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        self.on = False
+        self.stop_event.set()
+        self.thread.join(timeout=1.0)
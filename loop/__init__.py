@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+# 読み込み時間を抑えるため、part クラスは各サブモジュール(loop.scheduler, loop.process など)から読み込む
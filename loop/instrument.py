@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+Vehicleループの計測モジュール。
+part ごとの処理時間のヒストグラム、ループ周期のジッタ、デッドライン超過回数を記録し、
+シャットダウン時にサマリを表示、CSVとして出力する。
+"""
+import os
+import csv
+import numpy as np
+from .scheduler import PriorityVehicle
+
+
+def get_part_name(part, names):
+    """
+    サマリ表示用の part 名を返却する。Lambda part はラップした関数名を使用し、
+    同名の part が既にある場合は連番を付与する。
+
+    引数
+        part    part オブジェクト
+        names   既に付与済みの part 名のリスト
+    戻り値
+        part 名
+    """
+    f = getattr(part, 'f', None)
+    name = f.__name__ if callable(f) else part.__class__.__name__
+    if name not in names:
+        return name
+    i = 2
+    while '{}#{}'.format(name, i) in names:
+        i = i + 1
+    return '{}#{}'.format(name, i)
+
+
+class LoopStats:
+    """
+    ループ1周ごとの計測値を保持するクラス。
+    直近 capacity 周分の part 処理時間・周期・所要時間をリングバッファへ、
+    全期間分の処理時間ヒストグラム・デッドライン超過回数を累積値として保持する。
+    書き込みはVehicleループのスレッドのみが行い、行を書き終えてから周回数を進めるため、
+    ロックなしで他スレッドから参照できる。
+    """
+    # ヒストグラムのバケット上限(ミリ秒)、最後のバケットはそれ以上
+    BOUNDS_MS = [0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0, 500.0]
+
+    def __init__(self, names, rate_hz, capacity=6000):
+        """
+        リングバッファとヒストグラムを確保する。
+
+        引数
+            names       part 名のリスト(Vehicleループの実行順)
+            rate_hz     ループ周波数(1周のデッドラインは 1/rate_hz 秒)
+            capacity    リングバッファに保持する周回数
+        戻り値
+            なし
+        """
+        self.names = list(names)
+        self.rate_hz = rate_hz
+        self.budget = 1.0 / rate_hz
+        self.capacity = capacity
+        # 実行されなかった part は NaN
+        self.latencies = np.full((capacity, len(self.names)), np.nan)
+        self.starts = np.zeros(capacity)
+        self.periods = np.full(capacity, np.nan)
+        self.durations = np.zeros(capacity)
+        self.bounds = np.array(self.BOUNDS_MS) / 1000.0
+        self.hist = np.zeros((len(self.names), len(self.BOUNDS_MS) + 1), dtype=np.int64)
+        self.calls = np.zeros(len(self.names), dtype=np.int64)
+        self.totals = np.zeros(len(self.names))
+        self.maxes = np.zeros(len(self.names))
+        # デッドライン超過した周で最も時間を要した part ごとの回数
+        self.culprits = np.zeros(len(self.names), dtype=np.int64)
+        # 優先度により先送りした回数
+        self.deferred = np.zeros(len(self.names), dtype=np.int64)
+        self.missed = 0
+        self.ticks = 0
+        self.last_start = None
+        self.cols = np.arange(len(self.names))
+
+    def begin(self, start):
+        """
+        1周の計測を開始し、part 処理時間を書き込む行を返却する。
+
+        引数
+            start   周の開始時刻(time.perf_counter())
+        戻り値
+            part 処理時間(秒)を書き込む np.ndarray 行
+        """
+        pos = self.ticks % self.capacity
+        row = self.latencies[pos]
+        row.fill(np.nan)
+        self.starts[pos] = start
+        self.periods[pos] = np.nan if self.last_start is None else start - self.last_start
+        self.last_start = start
+        return row
+
+    def end(self, row, end):
+        """
+        1周の計測を終了し、累積値を更新したうえで周回数を進める。
+
+        引数
+            row     begin() で返却した行
+            end     周の終了時刻(time.perf_counter())
+        戻り値
+            なし
+        """
+        pos = self.ticks % self.capacity
+        duration = end - self.starts[pos]
+        self.durations[pos] = duration
+        ran = ~np.isnan(row)
+        values = row[ran]
+        self.hist[self.cols[ran], np.searchsorted(self.bounds, values)] += 1
+        self.calls[ran] += 1
+        self.totals[ran] += values
+        np.maximum(self.maxes, np.where(ran, row, 0.0), out=self.maxes)
+        if duration > self.budget:
+            self.missed += 1
+            if values.size > 0:
+                self.culprits[np.nanargmax(row)] += 1
+        self.ticks += 1
+
+    def window(self):
+        """
+        リングバッファに保持されている周の位置を古い順に返却する。
+
+        引数
+            なし
+        戻り値
+            位置の np.ndarray
+        """
+        ticks = self.ticks
+        if ticks <= self.capacity:
+            return np.arange(ticks)
+        return (np.arange(self.capacity) + ticks) % self.capacity
+
+    def get_summary(self):
+        """
+        part ごとのサマリを返却する。パーセンタイルはリングバッファ内の直近の周から算出する。
+
+        引数
+            なし
+        戻り値
+            part ごとの辞書のリスト
+        """
+        window = self.latencies[self.window()]
+        rows = []
+        for i, name in enumerate(self.names):
+            values = window[:, i]
+            values = values[~np.isnan(values)] * 1000.0
+            calls = int(self.calls[i])
+            row = {
+                'part':         name,
+                'calls':        calls,
+                'mean_ms':      1000.0 * self.totals[i] / calls if calls > 0 else 0.0,
+                'p50_ms':       np.percentile(values, 50) if values.size > 0 else 0.0,
+                'p95_ms':       np.percentile(values, 95) if values.size > 0 else 0.0,
+                'p99_ms':       np.percentile(values, 99) if values.size > 0 else 0.0,
+                'max_ms':       1000.0 * self.maxes[i],
+                'overruns':     int(self.culprits[i]),
+                'deferred':     int(self.deferred[i]),
+            }
+            for j, count in enumerate(self.hist[i]):
+                row[self.get_bucket_name(j)] = int(count)
+            rows.append(row)
+        return rows
+
+    def get_bucket_name(self, j):
+        """
+        ヒストグラムのバケット名を返却する。
+
+        引数
+            j       バケット番号
+        戻り値
+            バケット名
+        """
+        if j < len(self.BOUNDS_MS):
+            return 'le_{:g}ms'.format(self.BOUNDS_MS[j])
+        return 'gt_{:g}ms'.format(self.BOUNDS_MS[-1])
+
+    def get_loop_summary(self):
+        """
+        ループ周期・所要時間のサマリを返却する。
+
+        引数
+            なし
+        戻り値
+            サマリ辞書
+        """
+        window = self.window()
+        periods = self.periods[window]
+        periods = periods[~np.isnan(periods)]
+        jitter = periods - self.budget
+        durations = self.durations[window]
+        return {
+            'ticks':            self.ticks,
+            'missed':           self.missed,
+            'budget_ms':        1000.0 * self.budget,
+            'period_ms':        1000.0 * periods.mean() if periods.size > 0 else 0.0,
+            'jitter_std_ms':    1000.0 * jitter.std() if jitter.size > 0 else 0.0,
+            'jitter_max_ms':    1000.0 * np.abs(jitter).max() if jitter.size > 0 else 0.0,
+            'duration_p99_ms':  1000.0 * np.percentile(durations, 99) if durations.size > 0 else 0.0,
+        }
+
+    def report(self):
+        """
+        サマリを表示する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        loop = self.get_loop_summary()
+        print('loop: {} ticks, missed {} ({:.1f}%), budget {:.1f}ms, period {:.1f}ms, '
+              'jitter std {:.2f}ms max {:.2f}ms, duration p99 {:.1f}ms'.format(
+                  loop['ticks'], loop['missed'],
+                  100.0 * loop['missed'] / max(loop['ticks'], 1),
+                  loop['budget_ms'], loop['period_ms'],
+                  loop['jitter_std_ms'], loop['jitter_max_ms'], loop['duration_p99_ms']))
+        print('{:<24} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+            'part', 'calls', 'mean', 'p50', 'p95', 'p99', 'max', 'overrun', 'deferred'))
+        for row in self.get_summary():
+            print('{:<24} {:>8} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f} {:>8} {:>8}'.format(
+                row['part'], row['calls'], row['mean_ms'], row['p50_ms'],
+                row['p95_ms'], row['p99_ms'], row['max_ms'], row['overruns'], row['deferred']))
+
+    def save_csv(self, path):
+        """
+        part ごとのサマリ(ヒストグラムを含む)をCSVファイルへ出力する。
+
+        引数
+            path    出力先CSVファイルパス
+        戻り値
+            なし
+        """
+        rows = self.get_summary()
+        fields = ['part', 'calls', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'overruns', 'deferred'] + \
+            [self.get_bucket_name(j) for j in range(len(self.BOUNDS_MS) + 1)]
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def save_ticks_csv(self, path):
+        """
+        リングバッファ内の周ごとの計測値(ミリ秒)をCSVファイルへ出力する。
+
+        引数
+            path    出力先CSVファイルパス
+        戻り値
+            なし
+        """
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['tick', 'period_ms', 'duration_ms', 'missed'] + self.names)
+            first = max(self.ticks - self.capacity, 0)
+            for i, pos in enumerate(self.window()):
+                latencies = ['' if np.isnan(v) else '{:.3f}'.format(1000.0 * v)
+                             for v in self.latencies[pos]]
+                period = self.periods[pos]
+                writer.writerow([first + i,
+                                 '' if np.isnan(period) else '{:.3f}'.format(1000.0 * period),
+                                 '{:.3f}'.format(1000.0 * self.durations[pos]),
+                                 int(self.durations[pos] > self.budget)] + latencies)
+
+
+class InstrumentedVehicle(PriorityVehicle):
+    """
+    part ごとの処理時間を計測する Vehicle クラス。
+    part の実行順・run_condition・優先度の扱いは PriorityVehicle と同じ。
+    """
+
+    def __init__(self, rate_hz=20, capacity=6000, csv_path=None, max_defer=10, mem=None):
+        """
+        計測設定を保持する。計測用バッファは start() 時に part 数に応じて確保する。
+
+        引数
+            rate_hz     ループ周波数(デッドライン算出に使用)
+            capacity    リングバッファに保持する周回数
+            csv_path    シャットダウン時にサマリを出力するCSVファイルパス(Noneの場合は出力しない)
+                        周ごとの計測値は拡張子の前に '_ticks' を付与したファイルへ出力する
+            max_defer   連続して先送りできる最大周回数(0の場合は先送りしない)
+            mem         Memory オブジェクト
+        戻り値
+            なし
+        """
+        super(InstrumentedVehicle, self).__init__(rate_hz=rate_hz, max_defer=max_defer, mem=mem)
+        self.capacity = capacity
+        self.csv_path = csv_path
+        self.stats = None
+        self.row = None
+
+    def on_start(self):
+        """
+        part 数に応じて計測用バッファを確保する。
+        """
+        names = []
+        for entry in self.parts:
+            names.append(get_part_name(entry['part'], names))
+        self.stats = LoopStats(names, self.rate_hz, capacity=self.capacity)
+
+    def on_tick_start(self, start):
+        """
+        1周の計測を開始する。
+        """
+        self.row = self.stats.begin(start)
+
+    def on_part_done(self, i, latency):
+        """
+        part の処理時間を記録する。
+        """
+        self.row[i] = latency
+
+    def on_part_deferred(self, i):
+        """
+        part の先送りを記録する。
+        """
+        self.stats.deferred[i] += 1
+
+    def on_tick_end(self, end):
+        """
+        1周の計測を終了する。
+        """
+        self.stats.end(self.row, end)
+
+    def stop(self):
+        """
+        各 part をシャットダウンし、計測結果を表示・出力する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        super(InstrumentedVehicle, self).stop()
+        if self.stats is None or self.stats.ticks == 0:
+            return
+        self.stats.report()
+        if self.csv_path:
+            self.stats.save_csv(self.csv_path)
+            root, ext = os.path.splitext(self.csv_path)
+            self.stats.save_ticks_csv(root + '_ticks' + (ext or '.csv'))
+            print('loop stats saved to {}'.format(self.csv_path))
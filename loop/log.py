@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Vehicleループ向けの非同期ロギングモジュール。
+ログレコードはキューへ投入するだけで、書式化とファイル書き込みはバックグラウンドスレッドで行う。
+キューが満杯の場合はレコードを破棄し、ループを待たせない。
+"""
+import atexit
+import queue
+from logging import getLogger, Formatter, FileHandler, INFO
+from logging.handlers import QueueHandler, QueueListener
+
+DEFAULT_FORMAT = '%(asctime)s %(threadName)s %(name)s %(levelname)s %(message)s'
+
+# start_logging() で開始したロギングスレッド
+_writer = None
+
+
+class DropQueueHandler(QueueHandler):
+    """
+    キューが満杯の場合にレコードを破棄し、破棄件数を数える QueueHandler。
+    呼び出し元スレッドでは書式化を行わない。
+    """
+
+    def __init__(self, log_queue):
+        """
+        破棄件数を初期化する。
+
+        引数
+            log_queue   ログレコードを投入するキュー
+        戻り値
+            なし
+        """
+        super(DropQueueHandler, self).__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        """
+        書式化はバックグラウンドスレッドで行うため、レコードをそのまま返却する。
+
+        引数
+            record      ログレコード
+        戻り値
+            ログレコード
+        """
+        return record
+
+    def enqueue(self, record):
+        """
+        ブロックせずにキューへ投入する。満杯の場合は破棄する。
+
+        引数
+            record      ログレコード
+        戻り値
+            なし
+        """
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BlockingSentinelListener(QueueListener):
+    """
+    終了通知だけはキューに空きができるまで待って投入する QueueListener。
+    """
+
+    def enqueue_sentinel(self):
+        """
+        終了通知をキューへ投入する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        self.queue.put(self._sentinel)
+
+
+class AsyncLogWriter:
+    """
+    ルートロガーへ DropQueueHandler を設定し、バックグラウンドスレッドでファイルへ書き込むクラス。
+    """
+
+    def __init__(self, filename, level=INFO, filemode='a', queue_size=10000, fmt=DEFAULT_FORMAT):
+        """
+        ルートロガーのハンドラを差し替え、書き込みスレッドを開始する。
+
+        引数
+            filename    ログファイルパス
+            level       ルートロガーのログレベル(未満のレコードは書式化前に捨てられる)
+            filemode    ログファイルのオープンモード
+            queue_size  キューに保持する最大レコード数
+            fmt         ログの書式
+        戻り値
+            なし
+        """
+        self.file_handler = FileHandler(filename, mode=filemode)
+        self.file_handler.setFormatter(Formatter(fmt))
+        self.handler = DropQueueHandler(queue.Queue(maxsize=queue_size))
+        root = getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(level)
+        self.listener = BlockingSentinelListener(self.handler.queue, self.file_handler)
+        self.listener.start()
+
+    def stop(self):
+        """
+        キューに残っているレコードを書き込み、スレッドを終了する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        if self.listener is None:
+            return
+        self.listener.stop()
+        self.listener = None
+        getLogger().removeHandler(self.handler)
+        self.file_handler.close()
+        if self.handler.dropped > 0:
+            print('logging: dropped {} records'.format(self.handler.dropped))
+
+
+def start_logging(filename, level=INFO, filemode='a', queue_size=10000):
+    """
+    非同期ロギングを開始する。既に開始している場合は何もしない。
+    プロセス終了時に残りのレコードを書き込む。
+
+    引数
+        filename    ログファイルパス
+        level       ルートロガーのログレベル
+        filemode    ログファイルのオープンモード
+        queue_size  キューに保持する最大レコード数
+    戻り値
+        AsyncLogWriter オブジェクト
+    """
+    global _writer
+    if _writer is None:
+        _writer = AsyncLogWriter(filename, level=level, filemode=filemode, queue_size=queue_size)
+        atexit.register(_writer.stop)
+    return _writer
+
+
+class EdgeLogger:
+    """
+    値が変化した時だけログ出力するクラス。ループ毎に同じ値を出力しないために使用する。
+    """
+
+    def __init__(self, logger, label, level=INFO):
+        """
+        出力先ロガーとラベルを保持する。
+
+        引数
+            logger      出力先ロガー
+            label       ログに付与するラベル
+            level       ログレベル
+        戻り値
+            なし
+        """
+        self.logger = logger
+        self.label = label
+        self.level = level
+        self.value = None
+
+    def update(self, value):
+        """
+        前回と値が異なる場合のみログ出力する。
+
+        引数
+            value       現在の値
+        戻り値
+            value をそのまま返却
+        """
+        if value != self.value:
+            self.logger.log(self.level, '%s changed: %s -> %s', self.label, self.value, value)
+            self.value = value
+        return value
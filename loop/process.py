@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+カメラ撮影・オートパイロット推論・tub 書き込みを別プロセスで実行する part モジュール。
+画像は FrameRing(共有メモリ)経由で受け渡し、Vehicle ループのプロセスとは
+シーケンス番号と少数の値のみをやり取りする。
+各プロセスはGILを共有しないため、複数コアを使用できる。
+"""
+import time
+import queue
+import multiprocessing
+import numpy as np
+from .shm import FrameRing, SharedValues
+
+
+def get_context():
+    """
+    子プロセス用の multiprocessing コンテキストを返却する。
+    スレッド・TensorFlow を読み込んだプロセスの fork を避けるため forkserver を使用する。
+
+    引数
+        なし
+    戻り値
+        multiprocessing コンテキスト
+    """
+    try:
+        return multiprocessing.get_context('forkserver')
+    except ValueError:
+        return multiprocessing.get_context()
+
+
+def camera_worker(factory, ring, stop):
+    """
+    カメラプロセスの処理。撮影した画像を共有メモリへ書き込み続ける。
+
+    引数
+        factory     カメラ part を生成する関数(run() で画像を返却するもの)
+        ring        FrameRing オブジェクト
+        stop        終了通知 Event
+    戻り値
+        なし
+    """
+    cam = factory()
+    try:
+        while not stop.is_set():
+            frame = cam.run()
+            if frame is not None:
+                ring.put(frame)
+    finally:
+        cam.shutdown()
+
+
+def pilot_worker(factory, ring, request, outputs, stop, idle_timeout=0.5):
+    """
+    オートパイロットプロセスの処理。最新の画像のみを推論し、結果を共有メモリへ書き込む。
+    Vehicle ループから idle_timeout 秒以上要求がない場合(手動運転中)は推論しない。
+
+    引数
+        factory         run(img_arr) で (angle, throttle) を返却するオブジェクトを生成する関数
+        ring            FrameRing オブジェクト
+        request         最後に推論結果を要求された時刻(SharedValues)
+        outputs         推論結果 [angle, throttle, シーケンス番号, 撮影時刻, 推論時間](SharedValues)
+        stop            終了通知 Event
+        idle_timeout    推論を休止するまでの秒数
+    戻り値
+        なし
+    """
+    pilot = factory()
+    frame = np.empty(ring.shape, dtype=np.uint8)
+    last_seq = -1
+    try:
+        while not stop.is_set():
+            values = request.read()
+            if values is None or time.time() - values[0] > idle_timeout:
+                time.sleep(0.01)
+                continue
+            seq = ring.wait(last_seq, timeout=0.1)
+            if seq <= last_seq:
+                continue
+            stamp = ring.read(seq, frame)
+            if stamp is None:
+                continue
+            start = time.time()
+            angle, throttle = pilot.run(frame)
+            outputs.write([angle, throttle, seq, stamp, time.time() - start])
+            last_seq = seq
+    finally:
+        pilot.shutdown()
+
+
+def tub_worker(path, inputs, types, ring, records, queue_size, sync_interval):
+    """
+    tub 書き込みプロセスの処理。シーケンス番号で指定された画像を共有メモリから読み込み、
+    AsyncTubWriter で書き込む。None を受け取ると終了する。
+
+    引数
+        path            tub ディレクトリのパス
+        inputs          キーのリスト
+        types           型のリスト
+        ring            FrameRing オブジェクト
+        records         (シーケンス番号, 画像以外の値のリスト) を受け取るキュー
+        queue_size      AsyncTubWriter のキューサイズ
+        sync_interval   AsyncTubWriter のディスク同期間隔(秒)
+    戻り値
+        なし
+    """
+    from tubdata.writer import AsyncTubWriter
+    writer = AsyncTubWriter(path, inputs=inputs, types=types,
+                            queue_size=queue_size, sync_interval=sync_interval)
+    image_index = types.index('image_array')
+    frame = np.empty(ring.shape, dtype=np.uint8)
+    lost = 0
+    try:
+        while True:
+            item = records.get()
+            if item is None:
+                break
+            seq, values = item
+            if ring.read(seq, frame) is None:
+                # 書き込み前に上書きされた
+                lost += 1
+                continue
+            values = list(values)
+            values.insert(image_index, frame)
+            writer.run(*values)
+    finally:
+        writer.shutdown()
+        if lost > 0:
+            print('tub process: {} records lost (frame overwritten)'.format(lost))
+
+
+class ProcessPart:
+    """
+    子プロセスを管理する part 基底クラス。
+    """
+
+    def __init__(self, ctx, target, args, name):
+        """
+        子プロセスを開始する。
+
+        引数
+            ctx         multiprocessing コンテキスト
+            target      子プロセスで実行する関数
+            args        target の引数のタプル
+            name        プロセス名
+        戻り値
+            なし
+        """
+        self.process = ctx.Process(target=target, args=args, name=name)
+        self.process.daemon = True
+        self.process.start()
+
+    def join(self, timeout=5.0):
+        """
+        子プロセスの終了を待ち、終了しない場合は強制終了する。
+
+        引数
+            timeout     最大待ち時間(秒)
+        戻り値
+            なし
+        """
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class ProcessCamera(ProcessPart):
+    """
+    カメラを別プロセスで実行し、最新の画像を共有メモリから返却する part クラス。
+    """
+
+    def __init__(self, factory, shape, slots=16, ctx=None):
+        """
+        共有メモリを確保し、カメラプロセスを開始する。
+
+        引数
+            factory     カメラ part を生成する関数(子プロセスで呼び出すため pickle 可能なもの)
+            shape       画像1件の形状 (height, width, channel)
+            slots       共有メモリのスロット数
+            ctx         multiprocessing コンテキスト(Noneの場合は get_context())
+        戻り値
+            なし
+        """
+        ctx = ctx or get_context()
+        self.ring = FrameRing(ctx, shape, slots=slots)
+        self.stop_event = ctx.Event()
+        self.seq = -1
+        self.frame = None
+        super(ProcessCamera, self).__init__(ctx, camera_worker,
+                                            (factory, self.ring, self.stop_event), 'camera')
+
+    def run(self):
+        """
+        最新の画像を返却する。前回と同じ画像の場合は同じ配列を返却する。
+
+        引数
+            なし
+        戻り値
+            frame       画像(np.ndarray、未撮影の場合はNone)
+            seq         画像のシーケンス番号
+        """
+        seq = self.ring.latest_seq()
+        if seq > self.seq:
+            frame = np.empty(self.ring.shape, dtype=np.uint8)
+            if self.ring.read(seq, frame) is not None:
+                self.frame, self.seq = frame, seq
+        return self.frame, self.seq
+
+    def shutdown(self):
+        """
+        カメラプロセスを終了する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        self.stop_event.set()
+        self.join()
+
+
+class ProcessPilot(ProcessPart):
+    """
+    オートパイロットを別プロセスで実行し、直近の推論結果を返却する part クラス。
+    戻り値は AsyncPilot と同じ (angle, throttle, age) である。
+    """
+
+    def __init__(self, factory, ring, ctx=None):
+        """
+        オートパイロットプロセスを開始する。
+
+        引数
+            factory     オートパイロットを生成する関数(子プロセスで呼び出すため pickle 可能なもの)
+            ring        ProcessCamera の FrameRing オブジェクト
+            ctx         multiprocessing コンテキスト(Noneの場合は get_context())
+        戻り値
+            なし
+        """
+        ctx = ctx or get_context()
+        self.request = SharedValues(ctx, 1)
+        self.outputs = SharedValues(ctx, 5)
+        self.outputs.write([0.0, 0.0, -1, 0.0, 0.0])
+        self.stop_event = ctx.Event()
+        self.inferences = 0
+        self.infer_time = 0.0
+        self.last_seq = -1
+        super(ProcessPilot, self).__init__(ctx, pilot_worker,
+                                           (factory, ring, self.request, self.outputs,
+                                            self.stop_event), 'pilot')
+
+    def run(self):
+        """
+        推論を要求し、直近の推論結果を返却する。
+
+        引数
+            なし
+        戻り値
+            angle       直近の推論によるステアリング値
+            throttle    直近の推論によるスロットル値
+            age         推論に使用した画像の撮影からの経過秒数(未推論の場合は無限大)
+        """
+        now = time.time()
+        self.request.write([now])
+        values = self.outputs.read()
+        if values is None or values[2] < 0:
+            return 0.0, 0.0, float('inf')
+        angle, throttle, seq, stamp, infer_time = values
+        if seq != self.last_seq:
+            self.last_seq = seq
+            self.inferences += 1
+            self.infer_time += infer_time
+        return float(angle), float(throttle), now - stamp
+
+    def shutdown(self):
+        """
+        オートパイロットプロセスを終了する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        self.stop_event.set()
+        self.join()
+        if self.inferences > 0:
+            print('pilot process: {} inferences used, {:.1f}ms/inference'.format(
+                self.inferences, 1000.0 * self.infer_time / self.inferences))
+
+
+class ProcessTubWriter(ProcessPart):
+    """
+    tub 書き込みを別プロセスで実行する part クラス。
+    画像は共有メモリ上のシーケンス番号で指定し、画像以外の値のみキューで渡す。
+    """
+
+    def __init__(self, path, inputs, types, ring, queue_size=100, sync_interval=5.0, ctx=None):
+        """
+        tub 書き込みプロセスを開始する。
+
+        引数
+            path            tub ディレクトリのパス
+            inputs          キーのリスト
+            types           型のリスト('image_array' は1件のみ)
+            ring            ProcessCamera の FrameRing オブジェクト
+            queue_size      書き込み待ちレコードの最大数(超えた分は破棄)
+            sync_interval   ディスク同期間隔(秒)
+            ctx             multiprocessing コンテキスト(Noneの場合は get_context())
+        戻り値
+            なし
+        """
+        ctx = ctx or get_context()
+        self.records = ctx.Queue(maxsize=queue_size)
+        self.dropped = 0
+        super(ProcessTubWriter, self).__init__(ctx, tub_worker,
+                                               (path, inputs, types, ring, self.records,
+                                                queue_size, sync_interval), 'tub')
+
+    def run(self, seq, *args):
+        """
+        レコードを書き込みプロセスへ渡す。
+
+        引数
+            seq         画像のシーケンス番号
+            *args       画像以外の値(inputs の順)
+        戻り値
+            なし
+        """
+        if seq is None or seq < 0:
+            return
+        try:
+            self.records.put_nowait((seq, args))
+        except queue.Full:
+            self.dropped += 1
+
+    def shutdown(self):
+        """
+        書き込み待ちのレコードを書き込み、tub 書き込みプロセスを終了する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        self.records.put(None)
+        self.join(timeout=30.0)
+        if self.dropped > 0:
+            print('tub process: {} records dropped (queue full)'.format(self.dropped))
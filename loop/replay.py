@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+実車両なしで drive() と同じ part 構成の Vehicle ループを実行するための代替 part モジュール。
+カメラの代わりに tub データの画像を返却し、コントローラは tub に記録された手動操作値を返却する。
+PCA9685 の代わりに出力パルス値を記録する。
+"""
+import time
+import numpy as np
+
+
+class TubCamera:
+    """
+    読み込み済みの tub 画像を1周ごとに1件ずつ返却する PiCamera 代替 part クラス。
+    最後の画像の次は先頭へ戻る。
+    """
+
+    def __init__(self, images):
+        """
+        引数
+            images      画像配列(N, height, width, channel)
+        戻り値
+            なし
+        """
+        self.images = images
+        self.index = -1
+        self.frames = 0
+        # 最初・最後に画像を返却した時刻(ループ開始前の待ち時間を除いてループ周波数を求めるため)
+        self.first_stamp = None
+        self.last_stamp = None
+
+    def update(self):
+        """
+        別スレッドで実行される処理。画像は run_threaded() で進めるため何もしない。
+        """
+        pass
+
+    def run_threaded(self):
+        """
+        次の画像を返却する。
+
+        引数
+            なし
+        戻り値
+            画像(np.ndarray)
+        """
+        self.index = (self.index + 1) % len(self.images)
+        self.frames += 1
+        self.last_stamp = time.perf_counter()
+        if self.first_stamp is None:
+            self.first_stamp = self.last_stamp
+        return self.images[self.index]
+
+    def run(self):
+        return self.run_threaded()
+
+    def get_rate(self):
+        """
+        最初から最後の画像を返却するまでの1秒あたりの周回数を返却する。
+
+        引数
+            なし
+        戻り値
+            ループ周波数(2件未満の場合は0)
+        """
+        if self.frames < 2 or self.last_stamp <= self.first_stamp:
+            return 0.0
+        return (self.frames - 1) / (self.last_stamp - self.first_stamp)
+
+    def shutdown(self):
+        pass
+
+
+class ScriptedController:
+    """
+    TubCamera が返却中の画像に対応する手動操作値を返却するコントローラ代替 part クラス。
+    戻り値は LocalWebController と同じ (angle, throttle, mode, recording) である。
+    """
+
+    def __init__(self, camera, angles, throttles, mode='local', recording=False):
+        """
+        引数
+            camera      TubCamera オブジェクト
+            angles      user/angle 配列(N,)
+            throttles   user/throttle 配列(N,)
+            mode        運転モード('user', 'local_angle', 'local')
+            recording   tub へ書き込むかどうかの真偽値
+        戻り値
+            なし
+        """
+        self.camera = camera
+        self.angles = angles
+        self.throttles = throttles
+        self.mode = mode
+        self.recording = recording
+
+    def update(self):
+        pass
+
+    def run_threaded(self, img_arr=None):
+        """
+        現在の画像に対応する手動操作値を返却する。
+
+        引数
+            img_arr     画像(未使用)
+        戻り値
+            angle       user/angle
+            throttle    user/throttle
+            mode        運転モード
+            recording   tub へ書き込むかどうかの真偽値
+        """
+        i = max(self.camera.index, 0)
+        return float(self.angles[i]), float(self.throttles[i]), self.mode, self.recording
+
+    def run(self, img_arr=None):
+        return self.run_threaded(img_arr)
+
+    def shutdown(self):
+        pass
+
+
+class MockPCA9685:
+    """
+    PCA9685 代替クラス。set_pulse() で指定されたパルス値と時刻を記録する。
+    """
+
+    def __init__(self, channel, frequency=60):
+        """
+        引数
+            channel     チャネル番号
+            frequency   PWM周波数(未使用)
+        戻り値
+            なし
+        """
+        self.channel = channel
+        self.pulses = []
+        self.stamps = []
+
+    def set_pulse(self, pulse):
+        """
+        パルス値を記録する。
+
+        引数
+            pulse       パルス値
+        戻り値
+            なし
+        """
+        self.pulses.append(pulse)
+        self.stamps.append(time.perf_counter())
+
+    def run(self, pulse):
+        self.set_pulse(pulse)
+
+    def report(self, name):
+        """
+        記録したパルス値の件数・範囲を表示する。
+
+        引数
+            name        表示名
+        戻り値
+            なし
+        """
+        if len(self.pulses) == 0:
+            print('{}: no pulses'.format(name))
+            return
+        pulses = np.asarray(self.pulses)
+        print('{}: {} pulses, min {} max {} mean {:.1f}'.format(
+            name, len(pulses), pulses.min(), pulses.max(), pulses.mean()))
+
+
+class SteeringErrorRecorder:
+    """
+    オートパイロットのステアリング値と tub に記録された手動操作値との差を集計する part クラス。
+    drive_mode と同じく、推論結果が max_age 秒より古い(未推論・読み込み中を含む)周は集計しない。
+    """
+
+    def __init__(self, max_age=float('inf')):
+        """
+        引数
+            max_age     集計対象とする推論結果の経過秒数の上限
+        戻り値
+            なし
+        """
+        self.max_age = max_age
+        self.errors = []
+        self.skipped = 0
+
+    def run(self, pilot_angle, user_angle, pilot_age=None):
+        """
+        差を記録する。オートパイロットが推論していない周、推論結果が古い周は記録しない。
+
+        引数
+            pilot_angle     pilot/angle
+            user_angle      user/angle
+            pilot_age       pilot/age(同期推論時はNone)
+        戻り値
+            なし
+        """
+        if pilot_angle is None or user_angle is None:
+            return
+        if pilot_age is not None and (pilot_age == float('inf') or pilot_age > self.max_age):
+            self.skipped += 1
+            return
+        self.errors.append(pilot_angle - user_angle)
+
+    def report(self):
+        """
+        MAE・RMSE・最大誤差を表示する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        if len(self.errors) == 0:
+            print('steering error: no pilot outputs ({} stale frames skipped)'.format(self.skipped))
+            return
+        errors = np.abs(np.asarray(self.errors))
+        print('steering error vs user/angle: {} frames ({} stale skipped), MAE {:.4f} RMSE {:.4f} max {:.4f}'.format(
+            len(errors), self.skipped, errors.mean(), np.sqrt((errors ** 2).mean()), errors.max()))
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+part の優先度に応じて、ループ1周の残り時間が足りない場合に
+優先度の低い part の実行を先送りする Vehicle モジュール。
+"""
+import time
+import donkeycar as dk
+
+# part の優先度
+# CRITICAL      常に実行する(ステアリング・スロットル)
+# HIGH          常に実行する(オートパイロット)
+# NORMAL        常に実行する(デフォルト)
+# BEST_EFFORT   残り時間が足りない場合は先送りする(tub 書き込み・テレメトリ送信)
+CRITICAL = 0
+HIGH = 1
+NORMAL = 2
+BEST_EFFORT = 3
+
+
+class PriorityVehicle(dk.vehicle.Vehicle):
+    """
+    part ごとの優先度を持つ Vehicle クラス。
+    part の実行順は登録順のままとし、BEST_EFFORT の part は、その part と後続の
+    CRITICAL・HIGH の part の推定処理時間が1周の残り時間に収まらない場合に実行しない。
+    推定処理時間は実行した処理時間の指数移動平均である。
+    連続して max_defer 周先送りした part は、残り時間によらず実行する。
+    """
+
+    def __init__(self, rate_hz=20, max_defer=10, mem=None):
+        """
+        スケジューリング設定を保持する。
+
+        引数
+            rate_hz     ループ周波数(1周のデッドラインは 1/rate_hz 秒)
+            max_defer   連続して先送りできる最大周回数(0の場合は先送りしない)
+            mem         Memory オブジェクト
+        戻り値
+            なし
+        """
+        super(PriorityVehicle, self).__init__(mem=mem)
+        self.rate_hz = rate_hz
+        self.max_defer = max_defer
+        # 推定処理時間の指数移動平均の重み
+        self.alpha = 0.2
+
+    def add(self, part, inputs=[], outputs=[], threaded=False, run_condition=None, priority=NORMAL):
+        """
+        part を優先度付きで Vehicle ループへ追加する。
+
+        引数
+            part            part オブジェクト
+            inputs          入力キーのリスト
+            outputs         出力キーのリスト
+            threaded        別スレッドで実行するかどうか
+            run_condition   実行条件となるキー
+            priority        優先度(CRITICAL, HIGH, NORMAL, BEST_EFFORT)
+        戻り値
+            なし
+        """
+        super(PriorityVehicle, self).add(part, inputs=inputs, outputs=outputs,
+                                         threaded=threaded, run_condition=run_condition)
+        entry = self.parts[-1]
+        entry['priority'] = priority
+        entry['cost'] = 0.0
+        entry['deferred'] = 0
+        entry['defer_count'] = 0
+
+    def start(self, rate_hz=None, max_loop_count=None):
+        """
+        Vehicle ループを開始する。
+
+        引数
+            rate_hz         ループ周波数(Noneの場合はコンストラクタ指定値)
+            max_loop_count  最大ループ回数
+        戻り値
+            なし
+        """
+        if rate_hz is not None:
+            self.rate_hz = rate_hz
+        self.budget = 1.0 / self.rate_hz
+        self.on_start()
+        super(PriorityVehicle, self).start(rate_hz=self.rate_hz, max_loop_count=max_loop_count)
+
+    def should_defer(self, i, entry, now, deadline):
+        """
+        BEST_EFFORT の part を先送りするかどうかを判定する。
+
+        引数
+            i           part の位置
+            entry       part のエントリ
+            now         現在時刻(time.perf_counter())
+            deadline    1周のデッドライン(time.perf_counter())
+        戻り値
+            先送りする場合は真
+        """
+        if entry['priority'] != BEST_EFFORT or entry['deferred'] >= self.max_defer:
+            return False
+        reserve = entry['cost']
+        for later in self.parts[i + 1:]:
+            if later['priority'] <= HIGH:
+                reserve += later['cost']
+        return deadline - now < reserve
+
+    def update_parts(self):
+        """
+        各 part を登録順に実行する。残り時間が足りない BEST_EFFORT の part は先送りする。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        clock = time.perf_counter
+        start = clock()
+        deadline = start + self.budget
+        self.on_tick_start(start)
+        for i, entry in enumerate(self.parts):
+            run_condition = entry.get('run_condition')
+            if run_condition and not self.mem.get([run_condition])[0]:
+                continue
+            t = clock()
+            if self.should_defer(i, entry, t, deadline):
+                entry['deferred'] += 1
+                entry['defer_count'] += 1
+                self.on_part_deferred(i)
+                continue
+            p = entry['part']
+            inputs = self.mem.get(entry['inputs'])
+            if entry.get('thread'):
+                outputs = p.run_threaded(*inputs)
+            else:
+                outputs = p.run(*inputs)
+            latency = clock() - t
+            entry['cost'] += self.alpha * (latency - entry['cost'])
+            entry['deferred'] = 0
+            self.on_part_done(i, latency)
+            if outputs is not None:
+                self.mem.put(entry['outputs'], outputs)
+        self.on_tick_end(clock())
+
+    def on_start(self):
+        """
+        ループ開始時に呼び出される。サブクラスで計測用の準備を行う。
+        """
+        pass
+
+    def on_tick_start(self, start):
+        """
+        1周の開始時に呼び出される。
+
+        引数
+            start       周の開始時刻(time.perf_counter())
+        """
+        pass
+
+    def on_part_done(self, i, latency):
+        """
+        part の実行後に呼び出される。
+
+        引数
+            i           part の位置
+            latency     処理時間(秒)
+        """
+        pass
+
+    def on_part_deferred(self, i):
+        """
+        part を先送りした時に呼び出される。
+
+        引数
+            i           part の位置
+        """
+        pass
+
+    def on_tick_end(self, end):
+        """
+        1周の終了時に呼び出される。
+
+        引数
+            end         周の終了時刻(time.perf_counter())
+        """
+        pass
+
+    def stop(self):
+        """
+        各 part をシャットダウンし、先送りした part があれば回数を表示する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        super(PriorityVehicle, self).stop()
+        for entry in self.parts:
+            if entry.get('defer_count', 0) > 0:
+                print('scheduler: {} deferred {} times'.format(
+                    entry['part'].__class__.__name__, entry['defer_count']))
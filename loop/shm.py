@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+プロセス間でカメラ画像・推論結果を受け渡す共有メモリモジュール。
+multiprocessing.RawArray 上に確保するため pickle による複写は発生しない。
+書き込み側は1プロセスのみとし、読み込み側は書き込み前後のシーケンス番号を比較して
+書き込み途中の値を読まないようにする(seqlock)。
+"""
+import time
+import ctypes
+import numpy as np
+
+
+class FrameRing:
+    """
+    固定形状の uint8 画像をスロット単位で保持するリングバッファクラス。
+    seq 番目の画像は seq % slots 番目のスロットへ書き込まれ、slots 件後に上書きされる。
+    """
+
+    def __init__(self, ctx, shape, slots=16):
+        """
+        共有メモリを確保する。
+
+        引数
+            ctx         multiprocessing コンテキスト
+            shape       画像1件の形状 (height, width, channel)
+            slots       スロット数
+        戻り値
+            なし
+        """
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.frame_bytes = int(np.prod(self.shape))
+        self.data = ctx.RawArray(ctypes.c_uint8, slots * self.frame_bytes)
+        # スロットごとのシーケンス番号(書き込み中は-1)と撮影時刻
+        self.seqs = ctx.RawArray(ctypes.c_int64, slots)
+        self.stamps = ctx.RawArray(ctypes.c_double, slots)
+        # 最後に書き込みを終えたシーケンス番号
+        self.head = ctx.RawArray(ctypes.c_int64, 1)
+        self.attach()
+        self.seq_view.fill(-1)
+        self.head_view[0] = -1
+
+    def attach(self):
+        """
+        共有メモリの numpy ビューを作成する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        self.frames = np.frombuffer(self.data, dtype=np.uint8).reshape((self.slots,) + self.shape)
+        self.seq_view = np.frombuffer(self.seqs, dtype=np.int64)
+        self.stamp_view = np.frombuffer(self.stamps, dtype=np.float64)
+        self.head_view = np.frombuffer(self.head, dtype=np.int64)
+
+    def __getstate__(self):
+        """
+        子プロセスへ渡す際は numpy ビューを除外する。
+        """
+        state = self.__dict__.copy()
+        for key in ['frames', 'seq_view', 'stamp_view', 'head_view']:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        """
+        子プロセス側で numpy ビューを作成し直す。
+        """
+        self.__dict__.update(state)
+        self.attach()
+
+    def put(self, frame, stamp=None):
+        """
+        画像を次のスロットへ書き込む。書き込み側プロセスのみが呼び出す。
+
+        引数
+            frame       画像(np.ndarray)
+            stamp       撮影時刻(Noneの場合は現在時刻)
+        戻り値
+            書き込んだ画像のシーケンス番号
+        """
+        seq = int(self.head_view[0]) + 1
+        slot = seq % self.slots
+        self.seq_view[slot] = -1
+        self.frames[slot] = frame
+        self.stamp_view[slot] = time.time() if stamp is None else stamp
+        self.seq_view[slot] = seq
+        self.head_view[0] = seq
+        return seq
+
+    def latest_seq(self):
+        """
+        最後に書き込まれた画像のシーケンス番号を返却する。
+
+        引数
+            なし
+        戻り値
+            シーケンス番号(未書き込みの場合は-1)
+        """
+        return int(self.head_view[0])
+
+    def read(self, seq, out):
+        """
+        seq 番目の画像を out へ複写する。
+
+        引数
+            seq         シーケンス番号
+            out         複写先配列
+        戻り値
+            撮影時刻(既に上書きされている、または書き込み中の場合はNone)
+        """
+        slot = seq % self.slots
+        if self.seq_view[slot] != seq:
+            return None
+        stamp = float(self.stamp_view[slot])
+        out[...] = self.frames[slot]
+        if self.seq_view[slot] != seq:
+            return None
+        return stamp
+
+    def wait(self, last_seq, timeout=1.0, interval=0.002):
+        """
+        last_seq より新しい画像が書き込まれるまで待つ。
+
+        引数
+            last_seq    最後に処理したシーケンス番号
+            timeout     最大待ち時間(秒)
+            interval    確認間隔(秒)
+        戻り値
+            最新のシーケンス番号(タイムアウトの場合は last_seq)
+        """
+        deadline = time.time() + timeout
+        seq = self.latest_seq()
+        while seq <= last_seq and time.time() < deadline:
+            time.sleep(interval)
+            seq = self.latest_seq()
+        return seq
+
+
+class SharedValues:
+    """
+    少数の float 値を1プロセスから書き込み、他プロセスから読み込む共有メモリクラス。
+    """
+
+    def __init__(self, ctx, size):
+        """
+        共有メモリを確保する。
+
+        引数
+            ctx         multiprocessing コンテキスト
+            size        値の個数
+        戻り値
+            なし
+        """
+        self.size = size
+        self.data = ctx.RawArray(ctypes.c_double, size)
+        # 書き込み回数(奇数の間は書き込み中)
+        self.version = ctx.RawArray(ctypes.c_int64, 1)
+        self.attach()
+
+    def attach(self):
+        """
+        共有メモリの numpy ビューを作成する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        self.view = np.frombuffer(self.data, dtype=np.float64)
+        self.version_view = np.frombuffer(self.version, dtype=np.int64)
+
+    def __getstate__(self):
+        """
+        子プロセスへ渡す際は numpy ビューを除外する。
+        """
+        state = self.__dict__.copy()
+        state.pop('view', None)
+        state.pop('version_view', None)
+        return state
+
+    def __setstate__(self, state):
+        """
+        子プロセス側で numpy ビューを作成し直す。
+        """
+        self.__dict__.update(state)
+        self.attach()
+
+    def write(self, values):
+        """
+        値を書き込む。書き込み側プロセスのみが呼び出す。
+
+        引数
+            values      値のリスト
+        戻り値
+            なし
+        """
+        self.version_view[0] += 1
+        self.view[:] = values
+        self.version_view[0] += 1
+
+    def read(self, retries=100):
+        """
+        値を読み込む。書き込み途中の場合は読み直す。
+
+        引数
+            retries     最大読み直し回数
+        戻り値
+            値の np.ndarray (読み直し回数を超えた場合は None)
+        """
+        for _ in range(retries):
+            version = int(self.version_view[0])
+            if version % 2 == 0:
+                values = self.view.copy()
+                if int(self.version_view[0]) == version:
+                    return values
+        return None
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+起動処理(モジュール読み込み・part 生成)の区間ごとの所要時間を計測するモジュール。
+"""
+import time
+
+
+class StartupTimer:
+    """
+    mark() を呼び出した区間ごとの所要時間を記録し、起動時間として表示するクラス。
+    """
+
+    def __init__(self, start=None):
+        """
+        引数
+            start   計測開始時刻(time.time()、Noneの場合は現在時刻)
+        戻り値
+            なし
+        """
+        self.start = time.time() if start is None else start
+        self.last = self.start
+        self.marks = []
+
+    def mark(self, label):
+        """
+        前回の mark() から現在までを1区間として記録する。
+
+        引数
+            label   区間名
+        戻り値
+            区間の所要時間(秒)
+        """
+        now = time.time()
+        elapsed = now - self.last
+        self.marks.append((label, elapsed))
+        self.last = now
+        return elapsed
+
+    def report(self, name='startup'):
+        """
+        区間ごとの所要時間と合計を表示する。
+
+        引数
+            name    表示名
+        戻り値
+            なし
+        """
+        print('{}: {:.2f}s ({})'.format(
+            name, self.last - self.start,
+            ', '.join('{} {:.2f}s'.format(label, elapsed) for label, elapsed in self.marks)))
@@ -4,33 +4,74 @@
 Donkey2 準拠の車両の運転やモデルのトレーニングを行うためのスクリプトファイル。
 
 Usage:
-    manage.py (drive) [--model=<model>] [--js] [--chaos]
-    manage.py (train) [--tub=<tub1,tub2,..tubn>]  (--model=<model>) [--base_model=<base_model>] [--no_cache]
+    manage.py (drive) [--model=<model>] [--js] [--chaos] [--instrument]
+    manage.py (train) [--tub=<tub1,tub2,..tubn>]  (--model=<model>) [--base_model=<base_model>] [--no_cache] [--split=<split_path>]
 
 Options:
     -h --help        使い方を表示。
     --tub TUBPATHS   tubファイルが格納されているディレクトリへのパスを指定する。カンマ区切り指定可能。"~/tubs/*"といったワイルドカード指定も可能。
+                     tubarrange.py pack で作成したシャード格納ディレクトリを指定した場合はシャードから直接読み込む。
+                     tubarrange.py --catalog で作成したdataディレクトリを指定した場合はカタログからラベルを読み込む。
     --js             ジョイスティックを使用する。
     --chaos          手動運転中に周期的なランダム操舵を加える。
+    --instrument     part ごとの処理時間、ループ周期のジッタ、デッドライン超過回数を計測する。
+    --no_cache       デコード済み画像キャッシュを使用しない。
+    --split SPLIT    トレーニング/評価データの分割結果ファイル。存在すれば記録済みレコードは前回と同じ側へ振り分け、なければ作成する。
 """
 import os
+import time
+# 起動時間の計測開始時刻(以降のモジュール読み込み時間を含める)
+START_TIME = time.time()
+from functools import partial
+from logging import getLogger
 from docopt import docopt
 
 import donkeycar as dk
-from donkeycar.parts.camera import PiCamera
 from donkeycar.parts.transform import Lambda
-from donkeycar.parts.keras import KerasLinear
-from donkeycar.parts.actuator import PCA9685, PWMSteering, PWMThrottle
-from donkeycar.parts.datastore import TubGroup, TubWriter
-from donkeycar.parts.web_controller import LocalWebController
 from donkeycar.parts.clock import Timestamp
 
-# テレメトリデータ送信クラスのインポート
-from iotf.part import PubTelemetry
-
-def drive(cfg, model_path=None, use_joystick=False, use_chaos=False):
+# カメラ(PiCamera)・Keras(TensorFlow)・アクチュエータ(PCA9685)・Webコントローラ(tornado)・
+# TubGroup(pandas)・テレメトリ(ibmiotf)・別プロセス実行 part・tub 書き込み(PIL)は
+# 読み込みに時間がかかるため、サブコマンド・使用する part に応じて関数内で読み込む
+# Vehicleループ計測クラス、part の優先度のインポート
+from loop.scheduler import PriorityVehicle, CRITICAL, HIGH, BEST_EFFORT
+from loop.instrument import InstrumentedVehicle
+from loop.log import EdgeLogger, start_logging
+from loop.startup import StartupTimer
+# 非同期推論オートパイロットクラスのインポート(TensorFlow は生成時に読み込む)
+from pilot.part import AsyncPilot, LazyPilot, load_pilot
+
+# 起動処理の区間ごとの所要時間
+startup = StartupTimer(START_TIME)
+startup.mark('imports')
+
+def drive(cfg, model_path=None, use_joystick=False, use_chaos=False, use_instrument=False):
     """
     （手動・自動）運転する。
+    build_vehicle() で構築した Vehicle ループを `cfg.DRIVE_LOOP_HZ` で開始する。
+
+    引数
+        cfg             個別車両設定オブジェクト、`config.py`がロードされたオブジェクト。
+        model_path      自動運転時のモデルファイルパスを指定する（デフォルトはNone）。
+        use_joystick    ジョイスティックを使用するかどうかの真偽値（デフォルトはFalse）。
+        use_chaos       手動運転中に周期的なランダム操舵を加えるかどうかの真偽値（デフォルトはFalse）。
+        use_instrument  part ごとの処理時間を計測するかどうかの真偽値（デフォルトはFalse）。
+    """
+    # Vehicle オブジェクトの構築
+    V = build_vehicle(cfg, model_path=model_path, use_joystick=use_joystick,
+                      use_chaos=use_chaos, use_instrument=use_instrument)
+    # 起動時間の表示
+    startup.report()
+
+    # Vehicle ループを開始
+    V.start(rate_hz=cfg.DRIVE_LOOP_HZ,
+            max_loop_count=cfg.MAX_LOOPS)
+
+
+def build_vehicle(cfg, model_path=None, use_joystick=False, use_chaos=False, use_instrument=False,
+                  cam=None, ctr=None, steering_controller=None, throttle_controller=None):
+    """
+    （手動・自動）運転用の Vehicle オブジェクトを構築する。
 
     多くの部品(part)から作業用のロボット車両を構築する。
     各partはVehicleループ内のジョブとして実行され、コンストラクタフラグ `threaded`に応じて 
@@ -45,10 +86,29 @@ def drive(cfg, model_path=None, use_joystick=False, use_chaos=False):
         model_path      自動運転時のモデルファイルパスを指定する（デフォルトはNone）。
         use_joystick    ジョイスティックを使用するかどうかの真偽値（デフォルトはFalse）。
         use_chaos       手動運転中に周期的なランダム操舵を加えるかどうかの真偽値（デフォルトはFalse）。
+        use_instrument  part ごとの処理時間を計測するかどうかの真偽値（デフォルトはFalse）。
+        cam             カメラ part（デフォルトはNone:PiCamera）。replay.py では tub 画像を返却する part を指定する。
+        ctr             コントローラ part（デフォルトはNone:Web/Joystick）。
+        steering_controller  ステアリングサーボの制御オブジェクト（デフォルトはNone:PCA9685）。
+        throttle_controller  スロットルECSの制御オブジェクト（デフォルトはNone:PCA9685）。
+    戻り値
+        V               Vehicle オブジェクト
     """
+    # ログはキューへ投入し、バックグラウンドスレッドでファイルへ書き込む
+    start_logging(cfg.LOG_PATH, level=cfg.LOG_LEVEL)
+    logger = getLogger('drive')
+    startup.mark('logging')
 
     # Vehicle オブジェクトの生成
-    V = dk.vehicle.Vehicle()
+    if use_instrument or cfg.INSTRUMENT:
+        # 計測付き Vehicle オブジェクト(シャットダウン時にサマリを表示・出力)
+        V = InstrumentedVehicle(rate_hz=cfg.DRIVE_LOOP_HZ,
+                                capacity=cfg.INSTRUMENT_CAPACITY,
+                                csv_path=cfg.INSTRUMENT_CSV_PATH,
+                                max_defer=cfg.SCHEDULER_MAX_DEFER)
+    else:
+        # 1周の残り時間が足りない場合は優先度 BEST_EFFORT の part を先送りする Vehicle オブジェクト
+        V = PriorityVehicle(rate_hz=cfg.DRIVE_LOOP_HZ, max_defer=cfg.SCHEDULER_MAX_DEFER)
 
     # Timestamp part の生成
     clock = Timestamp()
@@ -59,29 +119,53 @@ def drive(cfg, model_path=None, use_joystick=False, use_chaos=False):
     #     'timestamp'    現在時刻
     V.add(clock, outputs=['timestamp'])
 
-    # PiCamera part の生成
-    cam = PiCamera(resolution=cfg.CAMERA_RESOLUTION)
-    # 別スレッド実行される PiCamera part をVehicleループへ追加
-    # 入力：
-    #     なし
-    # 出力：
-    #     'cam/image_array'    cfg.CAMERA_RESOLUTION 型式の画像データ
-    V.add(cam, outputs=['cam/image_array'], threaded=True)
-
-    # manage.py デフォルトのジョイスティックpart生成
-    if use_joystick or cfg.USE_JOYSTICK_AS_DEFAULT:
-        #ctr = JoystickController(max_throttle=cfg.JOYSTICK_MAX_THROTTLE,
-        #                         steering_scale=cfg.JOYSTICK_STEERING_SCALE,
-        #                         throttle_axis=cfg.JOYSTICK_THROTTLE_AXIS,
-        #                         auto_record_on_throttle=cfg.AUTO_RECORD_ON_THROTTLE)
-
-        # ジョイスティック part の生成
-        from elecom.part import JoystickController
-        ctr = JoystickController(config_path='elecom/jc-u3912t.yml')
+    # カメラ・オートパイロット・tub書き込みを別プロセスで実行する場合(カメラ part 指定時を除く)
+    use_multiprocess = cfg.DRIVE_MULTIPROCESS and cam is None
+    if use_multiprocess:
+        from donkeycar.parts.camera import PiCamera
+        from loop.process import ProcessCamera, ProcessPilot, ProcessTubWriter, get_context
+        ctx = get_context()
+        # 子プロセスで PiCamera part を生成し、画像を共有メモリのリングバッファへ書き込む
+        cam = ProcessCamera(partial(PiCamera, resolution=cfg.CAMERA_RESOLUTION),
+                            shape=tuple(cfg.CAMERA_RESOLUTION) + (3,),
+                            slots=cfg.SHM_RING_SLOTS, ctx=ctx)
+        # 共有メモリから最新画像を読み込む part をVehicleループへ追加
+        # 入力：
+        #     なし
+        # 出力：
+        #     'cam/image_array'    cfg.CAMERA_RESOLUTION 型式の画像データ
+        #     'cam/seq'            画像のシーケンス番号(共有メモリ上の位置)
+        V.add(cam, outputs=['cam/image_array', 'cam/seq'])
     else:
-        # ステアリング、スロットル、モードなどを管理するWebサーバを作成する
-        # Web Controller part の生成
-        ctr = LocalWebController(use_chaos=use_chaos)
+        # PiCamera part の生成
+        if cam is None:
+            from donkeycar.parts.camera import PiCamera
+            cam = PiCamera(resolution=cfg.CAMERA_RESOLUTION)
+        # 別スレッド実行される PiCamera part をVehicleループへ追加
+        # 入力：
+        #     なし
+        # 出力：
+        #     'cam/image_array'    cfg.CAMERA_RESOLUTION 型式の画像データ
+        V.add(cam, outputs=['cam/image_array'], threaded=True)
+    startup.mark('camera')
+
+    # コントローラ part が指定されていない場合は生成する
+    if ctr is None:
+        # manage.py デフォルトのジョイスティックpart生成
+        if use_joystick or cfg.USE_JOYSTICK_AS_DEFAULT:
+            #ctr = JoystickController(max_throttle=cfg.JOYSTICK_MAX_THROTTLE,
+            #                         steering_scale=cfg.JOYSTICK_STEERING_SCALE,
+            #                         throttle_axis=cfg.JOYSTICK_THROTTLE_AXIS,
+            #                         auto_record_on_throttle=cfg.AUTO_RECORD_ON_THROTTLE)
+
+            # ジョイスティック part の生成
+            from elecom.part import JoystickController
+            ctr = JoystickController(config_path='elecom/jc-u3912t.yml')
+        else:
+            # ステアリング、スロットル、モードなどを管理するWebサーバを作成する
+            # Web Controller part の生成
+            from donkeycar.parts.web_controller import LocalWebController
+            ctr = LocalWebController(use_chaos=use_chaos)
 
     # 別スレッド実行される Web Controller part もしくはジョイスティック part をVehiecleループへ追加
     # 入力：
@@ -95,6 +179,10 @@ def drive(cfg, model_path=None, use_joystick=False, use_chaos=False):
           inputs=['cam/image_array'],
           outputs=['user/angle', 'user/throttle', 'user/mode', 'recording'],
           threaded=True)
+    startup.mark('controller')
+
+    # Userモードは変化した時だけログ出力する
+    mode_log = EdgeLogger(logger, 'mode')
 
     # オートパイロットモジュールを実行すべきかどうかを確認する関数を定義する。
     def pilot_condition(mode):
@@ -108,7 +196,7 @@ def drive(cfg, model_path=None, use_joystick=False, use_chaos=False):
         戻り値
             boolean  オートパイロットモジュールを実行するかどうかの真偽値
         '''
-        print('mode=' + mode)
+        mode_log.update(mode)
         if mode == 'user':
             # 全手動時のみ実行しない
             return False
@@ -128,11 +216,21 @@ def drive(cfg, model_path=None, use_joystick=False, use_chaos=False):
 
     # Userモードでない場合、オートパイロットを実行する
     # CNNベースの線形回帰モデル(オートパイロット) part を生成する。
-    kl = KerasLinear()
-    # 関数driveの引数 model_part 指定がある場合
-    if model_path:
-        # 学習済みモデルファイルを読み込む
-        kl.load(model_path)
+    # 関数driveの引数 model_path 指定がある場合は学習済みモデルファイルを読み込み、
+    # 量子化済み .tflite ファイルがあればそちらを使用する。
+    # cfg.PILOT_DEDUPE が真の場合、直前と同じ画像の推論を省略し前回の推論結果を使用する。
+    if not use_multiprocess:
+        pilot_factory = partial(load_pilot, model_path, use_tflite=cfg.USE_TFLITE,
+                                num_threads=cfg.TFLITE_THREADS, dedupe=cfg.PILOT_DEDUPE)
+        if cfg.PILOT_ASYNC:
+            # 非同期推論の場合は推論スレッドで生成し、TensorFlow の読み込みを待たずにループを開始する
+            kl = AsyncPilot(factory=pilot_factory)
+        elif model_path is None:
+            # モデル未指定(手動運転)の場合は自動運転モードへ切り替えた時点でバックグラウンドスレッドで生成し、
+            # 生成が完了するまでは推論結果なし(経過秒数は無限大)とする
+            kl = LazyPilot(pilot_factory)
+        else:
+            kl = pilot_factory()
 
     # run_condition が真の場合のみ実行されるオートパイロット part をVehicleループへ追加する
     # 入力：
@@ -140,23 +238,53 @@ def drive(cfg, model_path=None, use_joystick=False, use_chaos=False):
     # 出力：
     #     'pilot/angle'        オートパイロットが指定した次に取るべきステアリング値
     #     'pilot/throttle'     オートパイロットが指定した次に取るべきスロットル値
-    V.add(kl,
-          inputs=['cam/image_array'],
-          outputs=['pilot/angle', 'pilot/throttle'],
-          run_condition='run_pilot')
+    #     'pilot/age'          推論に使用した画像を受け取ってからの経過秒数(非同期推論・遅延生成時のみ)
+    if use_multiprocess:
+        # 子プロセスで共有メモリ上の最新画像のみ推論し、ループは推論完了を待たない
+        V.add(ProcessPilot(partial(load_pilot, model_path, use_tflite=cfg.USE_TFLITE,
+                                   num_threads=cfg.TFLITE_THREADS),
+                           cam.ring, ctx=ctx),
+              outputs=['pilot/angle', 'pilot/throttle', 'pilot/age'],
+              run_condition='run_pilot',
+              priority=HIGH)
+    elif cfg.PILOT_ASYNC:
+        # 別スレッドで最新画像のみ推論し、ループは推論完了を待たない
+        V.add(kl,
+              inputs=['cam/image_array'],
+              outputs=['pilot/angle', 'pilot/throttle', 'pilot/age'],
+              threaded=True,
+              run_condition='run_pilot',
+              priority=HIGH)
+    elif isinstance(kl, LazyPilot):
+        # 生成完了までは経過秒数が無限大となり、drive_mode で手動操作値へ切り替える
+        V.add(kl,
+              inputs=['cam/image_array'],
+              outputs=['pilot/angle', 'pilot/throttle', 'pilot/age'],
+              run_condition='run_pilot',
+              priority=HIGH)
+    else:
+        V.add(kl,
+              inputs=['cam/image_array'],
+              outputs=['pilot/angle', 'pilot/throttle'],
+              run_condition='run_pilot',
+              priority=HIGH)
+    startup.mark('pilot')
 
     # 車両にどの値を入力にするかを判別する
     def drive_mode(mode,
                    user_angle, user_throttle,
-                   pilot_angle, pilot_throttle):
+                   pilot_angle, pilot_throttle, pilot_age=None):
         '''
         引数で指定された項目から、車両への入力とするステアリング値、スロットル値を確定する関数。
+        オートパイロットの推論結果が cfg.PILOT_MAX_AGE 秒より古い場合は、
+        ステアリングを手動操作値とし、全自動の場合はスロットルを0にする。
         引数
             mode            Web/Joystickにより手動指定した次に取るべきUserモード(入力なしの場合は前回値のまま)
             user_angle      Web/Joystickにより手動指定した次に取るべきステアリング値
             user_throttle   Web/Joystickにより手動指定した次に取るべきスロットル値
             pilot_angle     オートパイロットが指定した次に取るべきステアリング値
             pilot_throttle  オートパイロットが指定した次に取るべきスロットル値
+            pilot_age       推論に使用した画像を受け取ってからの経過秒数(モデル指定ありの同期推論時はNone)
         戻り値
             angle           車両への入力とするステアリング値
             throttle        車両への入力とするスロットル値
@@ -164,12 +292,21 @@ def drive(cfg, model_path=None, use_joystick=False, use_chaos=False):
         if mode == 'user':
             return user_angle, user_throttle
 
+        # 推論結果が古すぎる場合
+        elif stale_log.update(pilot_age is not None and pilot_age > cfg.PILOT_MAX_AGE):
+            if mode == 'local_angle':
+                return user_angle, user_throttle
+            return user_angle, 0.0
+
         elif mode == 'local_angle':
             return pilot_angle, user_throttle
 
         else:
             return pilot_angle, pilot_throttle
 
+    # 推論結果が古いかどうかは変化した時だけログ出力する
+    stale_log = EdgeLogger(logger, 'pilot stale')
+
     # 車両にどの値を入力にするかを判別する関数を part 化したオブジェクトを生成
     drive_mode_part = Lambda(drive_mode)
 
@@ -180,23 +317,27 @@ def drive(cfg, model_path=None, use_joystick=False, use_chaos=False):
     #     'user/throttle'   Web/Joystickにより手動指定した次に取るべきスロットル値
     #     'pilot/angle'     オートパイロットが指定した次に取るべきステアリング値
     #     'pilot/throttle'  オートパイロットが指定した次に取るべきスロットル値
+    #     'pilot/age'       推論に使用した画像を受け取ってからの経過秒数
     # 戻り値
     #     'angle'           車両への入力とするステアリング値
     #     'throttle'        車両への入力とするスロットル値
     V.add(drive_mode_part,
           inputs=['user/mode', 'user/angle', 'user/throttle',
-                  'pilot/angle', 'pilot/throttle'],
+                  'pilot/angle', 'pilot/throttle', 'pilot/age'],
           outputs=['angle', 'throttle'])
 
+    from donkeycar.parts.actuator import PCA9685, PWMSteering, PWMThrottle
     # 実車両のステアリングサーボを操作するオブジェクトを生成
-    steering_controller = PCA9685(cfg.STEERING_CHANNEL)
+    if steering_controller is None:
+        steering_controller = PCA9685(cfg.STEERING_CHANNEL)
     # 実車両へステアリング値を指示する part を生成
     steering = PWMSteering(controller=steering_controller,
                            left_pulse=cfg.STEERING_LEFT_PWM,
                            right_pulse=cfg.STEERING_RIGHT_PWM) 
 
     # 実車両のスロットルECSを操作するオブジェクトを生成
-    throttle_controller = PCA9685(cfg.THROTTLE_CHANNEL)
+    if throttle_controller is None:
+        throttle_controller = PCA9685(cfg.THROTTLE_CHANNEL)
     # 実車両へスロットル値を指示する part を生成
     throttle = PWMThrottle(controller=throttle_controller,
                            max_pulse=cfg.THROTTLE_FORWARD_PWM,
@@ -208,13 +349,14 @@ def drive(cfg, model_path=None, use_joystick=False, use_chaos=False):
     #     'angle'          車両への入力とするステアリング値
     # 出力：
     #     なし(実車両の操舵へ)
-    V.add(steering, inputs=['angle'])
+    V.add(steering, inputs=['angle'], priority=CRITICAL)
     # 実車両へスロットル値を指示する part を Vehiecle ループへ追加
     # 入力：
     #     'throttle'       車両への入力とするスロットル値
     # 出力：
     #     なし(実車両のスロットル操作へ)
-    V.add(throttle, inputs=['throttle'])
+    V.add(throttle, inputs=['throttle'], priority=CRITICAL)
+    startup.mark('actuators')
 
     # 保存データを tub ディレクトリに追加
     inputs = ['cam/image_array', 'user/angle', 'user/throttle', 'user/mode', 'timestamp']
@@ -226,7 +368,21 @@ def drive(cfg, model_path=None, use_joystick=False, use_chaos=False):
 
     # 単一 tub ディレクトリの場合
     # tub ディレクトリへ書き込む part を生成
-    tub = TubWriter(path=cfg.TUB_PATH, inputs=inputs, types=types)
+    if use_multiprocess:
+        # 子プロセスで共有メモリ上の画像を読み込み書き込む(画像は 'cam/seq' で指定)
+        tub = ProcessTubWriter(cfg.TUB_PATH, inputs, types, cam.ring,
+                               queue_size=cfg.TUB_WRITER_QUEUE_SIZE,
+                               sync_interval=cfg.TUB_WRITER_SYNC_INTERVAL, ctx=ctx)
+        inputs = ['cam/seq'] + inputs[1:]
+    elif cfg.TUB_WRITER_ASYNC:
+        # JPEGエンコード・ファイル書き込みはバックグラウンドスレッドで行う
+        from tubdata.writer import AsyncTubWriter
+        tub = AsyncTubWriter(path=cfg.TUB_PATH, inputs=inputs, types=types,
+                             queue_size=cfg.TUB_WRITER_QUEUE_SIZE,
+                             sync_interval=cfg.TUB_WRITER_SYNC_INTERVAL)
+    else:
+        from donkeycar.parts.datastore import TubWriter
+        tub = TubWriter(path=cfg.TUB_PATH, inputs=inputs, types=types)
     # 'recording'が正であれば tub ディレクトリへ書き込む part を Vehiecle ループへ追加
     # 入力
     #     'cam/image_array'    cfg.CAMERA_RESOLUTION 型式の画像データ
@@ -234,21 +390,38 @@ def drive(cfg, model_path=None, use_joystick=False, use_chaos=False):
     #     'user/throttle'      Web/Joystickにより手動指定した次に取るべきスロットル値
     #     'user/mode'          Web/Joystickにより手動指定した次に取るべきUserモード(入力なしの場合は前回値のまま)
     #     'timestamp'          現在時刻
-    V.add(tub, inputs=inputs, run_condition='recording')
+    # 1周の残り時間が足りない場合は先送りする
+    V.add(tub, inputs=inputs, run_condition='recording', priority=BEST_EFFORT)
+    startup.mark('tub')
 
 
     # テレメトリーデータの送信
-    #tele = PubTelemetry('iotf/emperor.ini', pub_count=20*5)
-    #V.add(tele, inputs=['cam/image_array', 'user/mode', 'user/angle', 'user/throttle',
-    #              'pilot/angle', 'pilot/throttle', 'angle', 'throttle'])
-
-
-    # Vehicle ループを開始
-    V.start(rate_hz=cfg.DRIVE_LOOP_HZ,
-            max_loop_count=cfg.MAX_LOOPS)
-
-
-def train(cfg, tub_names, new_model_path, base_model_path=None):
+    # ループ内ではキューへ投入するのみで、エンコード・送信は送信スレッドで行う
+    if cfg.TELEMETRY:
+        from iotf.part import PubTelemetry
+        from iotf.adaptive import AdaptiveTelemetry
+        adaptive = None
+        if cfg.TELEMETRY_ADAPTIVE:
+            # 回線状況に応じて送信間隔・JPEG品質・縮小率を調整する
+            adaptive = AdaptiveTelemetry(min_count=cfg.TELEMETRY_MIN_PUB_COUNT,
+                                         max_count=cfg.TELEMETRY_MAX_PUB_COUNT,
+                                         count=cfg.TELEMETRY_PUB_COUNT,
+                                         min_quality=cfg.TELEMETRY_JPEG_QUALITY[0],
+                                         max_quality=cfg.TELEMETRY_JPEG_QUALITY[1],
+                                         max_scale=cfg.TELEMETRY_MAX_SCALE,
+                                         target_latency=cfg.TELEMETRY_TARGET_LATENCY,
+                                         wifi_low=cfg.TELEMETRY_WIFI_LOW)
+        tele = PubTelemetry(cfg.TELEMETRY_CONF_PATH, pub_count=cfg.TELEMETRY_PUB_COUNT,
+                            wifi_interval=cfg.TELEMETRY_WIFI_INTERVAL,
+                            queue_size=cfg.TELEMETRY_QUEUE_SIZE, adaptive=adaptive)
+        V.add(tele, inputs=['cam/image_array', 'user/mode', 'user/angle', 'user/throttle',
+                            'pilot/angle', 'pilot/throttle', 'angle', 'throttle'], priority=BEST_EFFORT)
+        startup.mark('telemetry')
+
+    return V
+
+
+def train(cfg, tub_names, new_model_path, base_model_path=None, cache=True, split_path=None):
     """
     引数 tub_names 似て指定されたパスに格納されている tub データを学習データとして
     トレーニングを行い、引数 new_model_path にて指定されたパスへ学習済みモデルファイルを格納する。
@@ -257,6 +430,8 @@ def train(cfg, tub_names, new_model_path, base_model_path=None):
         tub_names          学習データとして使用するtubディレクトリのパスを指定する。
         new_model_path     トレーニング後モデルファイルとして保管するパスを指定する。
         base_model_path    ファインチューニングを行う場合、ベースとなるモデルファイルを指定する。
+        cache              デコード済み画像キャッシュを使用するかどうかの真偽値（デフォルトはTrue）。
+        split_path         トレーニング/評価データの分割結果ファイルのパス（デフォルトはNone:保存しない）。
     戻り値
         なし
     """
@@ -269,6 +444,16 @@ def train(cfg, tub_names, new_model_path, base_model_path=None):
     # トレーニング後モデルファイルとして保管するパスをフルパス化
     new_model_path = os.path.expanduser(new_model_path)
 
+    from donkeycar.parts.keras import KerasLinear
+    from pilot.tflite import export_tflite, get_tflite_path
+    from tubdata.shard import ShardDataset
+    from tubdata.catalog import CatalogDataset
+    from tubdata.dataset import TubGroupDataset
+    from tubdata.cache import ImageCache
+    from tubdata.augment import BatchAugmenter
+    from tubdata.split import SplitIndex
+    startup.mark('train imports')
+
     # トレーニング後モデルファイルとして保管するパスをフルパス化
     kl = KerasLinear()
     # ファインチューニングを行う場合は base_model_path にベースモデルファイルパスが指定されている
@@ -283,19 +468,87 @@ def train(cfg, tub_names, new_model_path, base_model_path=None):
     if not tub_names:
         # config.py 上に指定されたデータファイルパスを使用
         tub_names = os.path.join(cfg.DATA_PATH, '*')
-    # Tub データ群をあらわすオブジェクトを生成
-    tubgroup = TubGroup(tub_names)
-    # トレーニングデータGenerator、評価データGeneratorを生成
-    train_gen, val_gen = tubgroup.get_train_val_gen(X_keys, y_keys,
-                                                    batch_size=cfg.BATCH_SIZE,
-                                                    train_frac=cfg.TRAIN_TEST_SPLIT)
-
-    # 全学習データ件数を取得
-    total_records = len(tubgroup.df)
-    # トレーニングデータ件数の取得
-    total_train = int(total_records * cfg.TRAIN_TEST_SPLIT)
-    # 評価データ件数の取得
-    total_val = total_records - total_train
+    # デコード済み画像キャッシュ(シャード使用時はデコード不要のため使用しない)
+    image_cache = None
+    if cache and not ShardDataset.is_shard_dir(tub_names):
+        image_cache = ImageCache(cfg.CACHE_PATH, cfg.CAMERA_RESOLUTION + (3,),
+                                 max_bytes=cfg.CACHE_MAX_BYTES)
+
+    # シャード格納ディレクトリが指定された場合
+    if ShardDataset.is_shard_dir(tub_names):
+        # シャード群をあらわすオブジェクトを生成(画像はメモリマップで参照)
+        dataset = ShardDataset(tub_names)
+        # トレーニングデータGenerator、評価データGeneratorを生成
+        train_gen, val_gen = dataset.get_train_val_gen(X_keys, y_keys,
+                                                       batch_size=cfg.BATCH_SIZE,
+                                                       train_frac=cfg.TRAIN_TEST_SPLIT,
+                                                       seed=cfg.TRAIN_SPLIT_SEED)
+        # トレーニングデータ件数、評価データ件数の取得
+        total_train = dataset.total_train
+        total_val = dataset.total_val
+    else:
+        dataset = None
+        split = None
+        # カタログ形式のdataディレクトリが指定された場合
+        if CatalogDataset.is_catalog_dir(tub_names):
+            # カタログを1回だけ順に読み込む
+            dataset = CatalogDataset(tub_names, cache=image_cache)
+        else:
+            # Tub データ群をあらわすオブジェクトを生成
+            from donkeycar.parts.datastore import TubGroup
+            tubgroup = TubGroup(tub_names)
+            # キャッシュ、先読みワーカー、分割結果ファイルのいずれかを使用する場合
+            if image_cache is not None or cfg.LOADER_WORKERS > 0 or split_path:
+                # キャッシュ経由、ワーカープロセスで画像を読み込むデータセットを生成
+                dataset = TubGroupDataset(tubgroup, cache=image_cache)
+        # 分割結果ファイルが指定された場合は前回と同じ振り分けを使用し、新規レコードのみ追加で振り分ける
+        if split_path:
+            split = SplitIndex(split_path).assign(dataset,
+                                                  train_frac=cfg.TRAIN_TEST_SPLIT,
+                                                  seed=cfg.TRAIN_SPLIT_SEED,
+                                                  bins=cfg.TRAIN_SPLIT_BINS)
+
+        if dataset is not None:
+            # トレーニングデータGenerator、評価データGeneratorを生成
+            train_gen, val_gen = dataset.get_train_val_gen(X_keys, y_keys,
+                                                           batch_size=cfg.BATCH_SIZE,
+                                                           train_frac=cfg.TRAIN_TEST_SPLIT,
+                                                           seed=cfg.TRAIN_SPLIT_SEED,
+                                                           workers=cfg.LOADER_WORKERS,
+                                                           prefetch=cfg.LOADER_PREFETCH,
+                                                           split=split)
+            # トレーニングデータ件数、評価データ件数の取得
+            total_train = dataset.total_train
+            total_val = dataset.total_val
+        else:
+            # トレーニングデータGenerator、評価データGeneratorを生成
+            train_gen, val_gen = tubgroup.get_train_val_gen(X_keys, y_keys,
+                                                            batch_size=cfg.BATCH_SIZE,
+                                                            train_frac=cfg.TRAIN_TEST_SPLIT)
+
+            # 全学習データ件数を取得
+            total_records = len(tubgroup.df)
+            # トレーニングデータ件数の取得
+            total_train = int(total_records * cfg.TRAIN_TEST_SPLIT)
+            # 評価データ件数の取得
+            total_val = total_records - total_train
+
+    # int8 量子化の値域推定用(データ拡張前のトレーニングデータGenerator)
+    calib_gen = train_gen
+    # トレーニングデータのみバッチ単位でデータ拡張する
+    augmenter = None
+    if cfg.AUGMENT:
+        augmenter = BatchAugmenter(flip_prob=cfg.AUGMENT_FLIP_PROB,
+                                   brightness=cfg.AUGMENT_BRIGHTNESS,
+                                   contrast=cfg.AUGMENT_CONTRAST,
+                                   max_shift=cfg.AUGMENT_MAX_SHIFT,
+                                   seed=cfg.AUGMENT_SEED)
+        train_gen = augmenter.wrap(train_gen, X_keys, y_keys)
+
+    # 起動時間の表示
+    startup.mark('dataset')
+    startup.report()
+
     print('train: %d, validation: %d' % (total_train, total_val))
     # 1epochごとのステップ数の取得
     steps_per_epoch = total_train // cfg.BATCH_SIZE
@@ -308,6 +561,35 @@ def train(cfg, tub_names, new_model_path, base_model_path=None):
              steps=steps_per_epoch,
              train_split=cfg.TRAIN_TEST_SPLIT)
 
+    # 量子化した .tflite ファイルをモデルファイルと並べて作成する
+    if cfg.TFLITE_QUANTIZE:
+        samples = None
+        if cfg.TFLITE_QUANTIZE == 'int8':
+            # 値域推定用の画像を評価データ(ない場合はトレーニングデータ)から取得
+            if total_val > 0:
+                calib_gen = val_gen
+            elif total_train == 0:
+                raise Exception('no sample images for int8 quantization')
+            samples = []
+            # 各バッチは1件以上のため、TFLITE_SAMPLES 回で打ち切る
+            for _ in range(cfg.TFLITE_SAMPLES):
+                X, _ = next(calib_gen)
+                samples.extend(X[0][:cfg.TFLITE_SAMPLES - len(samples)])
+                if len(samples) >= cfg.TFLITE_SAMPLES:
+                    break
+        export_tflite(new_model_path, quantize=cfg.TFLITE_QUANTIZE, samples=samples)
+    elif os.path.exists(get_tflite_path(new_model_path)):
+        # 以前のモデルから作成した .tflite を drive で使用しないよう削除する
+        os.remove(get_tflite_path(new_model_path))
+        print('remove stale tflite model: {}'.format(get_tflite_path(new_model_path)))
+
+    # キャッシュ索引の保存
+    if image_cache is not None:
+        image_cache.close()
+    # データ拡張処理時間の表示
+    if augmenter is not None:
+        augmenter.report()
+
 # 本ファイル自体が実行された場合
 if __name__ == '__main__':
     # 引数処理
@@ -317,7 +599,8 @@ if __name__ == '__main__':
     # 引数として 'drive' が指定された場合
     if args['drive']:
        # 【手動・自動）運転を開始する
-        drive(cfg, model_path=args['--model'], use_joystick=args['--js'], use_chaos=args['--chaos'])
+        drive(cfg, model_path=args['--model'], use_joystick=args['--js'], use_chaos=args['--chaos'],
+              use_instrument=args['--instrument'])
 
     # 引数として 'drive' が指定されず、かわりに'train'が指定された場合
     elif args['train']:
@@ -325,8 +608,9 @@ if __name__ == '__main__':
         new_model_path = args['--model']
         base_model_path = args['--base_model']
         cache = not args['--no_cache']
+        split_path = args['--split']
         # トレーニングを開始する
-        train(cfg, tub, new_model_path, base_model_path)
+        train(cfg, tub, new_model_path, base_model_path, cache=cache, split_path=split_path)
 
 
 
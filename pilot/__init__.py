@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+# TensorFlow Lite 関連を読み込まないよう、各サブモジュール(pilot.part, pilot.tflite)から読み込む
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+オートパイロット part モジュール。
+"""
+import os
+import sys
+import time
+import zlib
+import threading
+import numpy as np
+
+
+def get_default_graph():
+    """
+    TensorFlow 1.x を読み込み済みの場合はデフォルトグラフを返却する。
+    TensorFlow Lite のみ使用する場合は TensorFlow 本体を読み込まない。
+
+    引数
+        なし
+    戻り値
+        tf.Graph オブジェクト(TensorFlow 1.x 未読み込みの場合はNone)
+    """
+    tf = sys.modules.get('tensorflow')
+    if tf is not None and hasattr(tf, 'get_default_graph'):
+        return tf.get_default_graph()
+    return None
+
+
+def create_pilot(factory):
+    """
+    オートパイロットオブジェクトを生成し、所要時間を表示する。
+
+    引数
+        factory     オートパイロットオブジェクトを生成する関数
+    戻り値
+        オートパイロットオブジェクト
+    """
+    start = time.time()
+    pilot = factory()
+    print('pilot loaded in {:.2f}s'.format(time.time() - start))
+    return pilot
+
+
+class AsyncPilot:
+    """
+    オートパイロットの推論を別スレッドで実行する part クラス。
+    Vehicle ループからは最新のカメラ画像を受け取るだけで、推論の完了は待たない。
+    推論スレッドは常に最新の画像のみを処理し、処理中に届いた古い画像は破棄する。
+    ループへは直近の推論結果と、その推論に使用した画像を受け取ってからの経過秒数を返却する。
+    factory を指定した場合はオートパイロットを推論スレッドで生成するため、
+    TensorFlow の読み込み中も Vehicle ループは止まらない。
+    """
+
+    def __init__(self, pilot=None, factory=None):
+        """
+        推論を行うオートパイロットオブジェクトを保持する。
+        TensorFlow 1.x を読み込み済みの場合、モデルのグラフを推論スレッドでも使用するため
+        生成時点のデフォルトグラフを保持する。
+
+        引数
+            pilot   run(img_arr) で (angle, throttle) を返却するオブジェクト(KerasLinear など)
+            factory pilot が None の場合に推論スレッドでオートパイロットを生成する関数
+        戻り値
+            なし
+        """
+        self.pilot = pilot
+        self.factory = factory
+        self.graph = get_default_graph()
+        self.cond = threading.Condition()
+        self.frame = None
+        self.frame_time = None
+        self.angle = 0.0
+        self.throttle = 0.0
+        # 推論結果の元となった画像の受付時刻(未推論の場合はNone)
+        self.pred_time = None
+        self.on = True
+        self.frames = 0
+        self.inferences = 0
+        self.infer_time = 0.0
+
+    def update(self):
+        """
+        推論スレッドの処理。最新の画像が届くまで待ち、推論結果を更新する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        while self.on:
+            if self.pilot is None:
+                self.pilot = create_pilot(self.factory)
+            with self.cond:
+                while self.on and self.frame is None:
+                    self.cond.wait(0.1)
+                frame, frame_time = self.frame, self.frame_time
+                self.frame = None
+            if frame is None:
+                continue
+            start = time.time()
+            if self.graph is not None:
+                with self.graph.as_default():
+                    angle, throttle = self.pilot.run(frame)
+            else:
+                angle, throttle = self.pilot.run(frame)
+            self.infer_time += time.time() - start
+            self.inferences += 1
+            with self.cond:
+                self.angle, self.throttle, self.pred_time = angle, throttle, frame_time
+
+    def run_threaded(self, img_arr):
+        """
+        最新の画像を推論スレッドへ渡し、直近の推論結果を返却する。
+
+        引数
+            img_arr     カメラ画像イメージデータ(np.ndarray)
+        戻り値
+            angle       直近の推論によるステアリング値
+            throttle    直近の推論によるスロットル値
+            age         推論に使用した画像を受け取ってからの経過秒数(未推論の場合は無限大)
+        """
+        now = time.time()
+        with self.cond:
+            if img_arr is not None:
+                self.frame, self.frame_time = img_arr, now
+                self.frames += 1
+                self.cond.notify()
+            angle, throttle, pred_time = self.angle, self.throttle, self.pred_time
+        age = float('inf') if pred_time is None else now - pred_time
+        return angle, throttle, age
+
+    def run(self, img_arr):
+        """
+        スレッド実行しない場合は同期的に推論する。
+
+        引数
+            img_arr     カメラ画像イメージデータ(np.ndarray)
+        戻り値
+            angle       ステアリング値
+            throttle    スロットル値
+            age         経過秒数(常に0.0)
+        """
+        if self.pilot is None:
+            self.pilot = create_pilot(self.factory)
+        angle, throttle = self.pilot.run(img_arr)
+        return angle, throttle, 0.0
+
+    def shutdown(self):
+        """
+        推論スレッドを停止し、推論件数・破棄した画像数・平均推論時間を表示する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        self.on = False
+        with self.cond:
+            self.cond.notify()
+        if self.pilot is not None:
+            self.pilot.shutdown()
+        if self.inferences > 0:
+            print('pilot: {} frames, {} inferences, {} dropped, {:.1f}ms/inference'.format(
+                self.frames, self.inferences, self.frames - self.inferences,
+                1000.0 * self.infer_time / self.inferences))
+
+
+class DedupePilot:
+    """
+    直前と同じ画像の場合に推論を省略し、前回の推論結果を返却する part クラス。
+    threaded 実行のカメラは、次の画像を取得するまで同じ画像を返却し続けるため、
+    画像全体のチェックサムで同一画像かどうかを判定する。
+    """
+
+    def __init__(self, pilot):
+        """
+        推論を行うオートパイロットオブジェクトを保持する。
+
+        引数
+            pilot   run(img_arr) で (angle, throttle) を返却するオブジェクト(KerasLinear など)
+        戻り値
+            なし
+        """
+        self.pilot = pilot
+        self.checksum = None
+        self.outputs = None
+        self.frames = 0
+        self.hits = 0
+
+    def run(self, img_arr):
+        """
+        直前と異なる画像の場合のみ推論する。
+
+        引数
+            img_arr     カメラ画像イメージデータ(np.ndarray)
+        戻り値
+            angle       ステアリング値
+            throttle    スロットル値
+        """
+        self.frames += 1
+        checksum = zlib.crc32(np.ascontiguousarray(img_arr))
+        if self.outputs is not None and checksum == self.checksum:
+            self.hits += 1
+            return self.outputs
+        self.outputs = self.pilot.run(img_arr)
+        self.checksum = checksum
+        return self.outputs
+
+    def shutdown(self):
+        """
+        オートパイロットをシャットダウンし、推論を省略した割合を表示する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        self.pilot.shutdown()
+        if self.frames > 0:
+            print('pilot dedupe: {} frames, {} reused ({:.1f}%)'.format(
+                self.frames, self.hits, 100.0 * self.hits / self.frames))
+
+
+class LazyPilot:
+    """
+    最初に推論する時点でオートパイロットオブジェクトの生成をバックグラウンドスレッドで開始する part クラス。
+    手動運転のみの場合は TensorFlow を読み込まずに Vehicle ループを開始でき、
+    自動運転モードへ切り替えた場合も読み込み完了を待たずにループを継続する。
+    生成が完了するまでは経過秒数に無限大を返却し、drive_mode により手動操作値を使用させる。
+    """
+
+    def __init__(self, factory):
+        """
+        オートパイロットを生成する関数を保持する。
+
+        引数
+            factory     run(img_arr) で (angle, throttle) を返却するオブジェクトを生成する関数
+        戻り値
+            なし
+        """
+        self.factory = factory
+        self.pilot = None
+        self.graph = None
+        self.thread = None
+
+    def load(self):
+        """
+        読み込みスレッドの処理。オートパイロットを生成する。
+        TensorFlow 1.x の場合は Vehicle ループ側でも同じグラフを使用するため保持する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        pilot = create_pilot(self.factory)
+        self.graph = get_default_graph()
+        self.pilot = pilot
+
+    def run(self, img_arr):
+        """
+        生成済みの場合は推論する。未生成の場合は読み込みスレッドを開始し、推論結果なしを返却する。
+
+        引数
+            img_arr     カメラ画像イメージデータ(np.ndarray)
+        戻り値
+            angle       ステアリング値(未生成の場合は0.0)
+            throttle    スロットル値(未生成の場合は0.0)
+            age         推論に使用した画像を受け取ってからの経過秒数(同期推論のため0.0、未生成の場合は無限大)
+        """
+        pilot = self.pilot
+        if pilot is None:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.load, name='pilot loader')
+                self.thread.daemon = True
+                self.thread.start()
+            return 0.0, 0.0, float('inf')
+        if self.graph is not None:
+            with self.graph.as_default():
+                angle, throttle = pilot.run(img_arr)
+        else:
+            angle, throttle = pilot.run(img_arr)
+        return angle, throttle, 0.0
+
+    def shutdown(self):
+        """
+        生成済みの場合はオートパイロットをシャットダウンする。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        if self.pilot is not None:
+            self.pilot.shutdown()
+
+
+def load_pilot(model_path=None, use_tflite=True, num_threads=None, dedupe=False):
+    """
+    モデルファイルを読み込んだオートパイロットオブジェクトを生成する。
+    .tflite ファイルを指定した場合、もしくは use_tflite が真でモデルファイルと並んで
+    モデルファイル以降に作成された .tflite ファイルが存在する場合は TFLitePilot、
+    それ以外は KerasLinear を生成する。
+    別プロセスで生成できるよう、モジュール直下の関数としている。
+
+    引数
+        model_path      モデルファイルパス(Noneの場合は未学習の KerasLinear)
+        use_tflite      モデルファイルと並んだ .tflite ファイルを使用するかどうか
+        num_threads     TensorFlow Lite の推論スレッド数
+        dedupe          直前と同じ画像の推論を省略する DedupePilot でラップするかどうか
+    戻り値
+        run(img_arr) で (angle, throttle) を返却するオブジェクト
+    """
+    from .tflite import TFLitePilot, get_tflite_path, is_tflite_fresh
+    if model_path and use_tflite and not model_path.endswith('.tflite') and \
+            os.path.exists(get_tflite_path(model_path)) and not is_tflite_fresh(model_path):
+        # 再トレーニング後に作り直されていない .tflite は使用しない
+        print('tflite model is older than {}, ignored: {}'.format(
+            model_path, get_tflite_path(model_path)))
+    if model_path and (model_path.endswith('.tflite') or
+                       (use_tflite and is_tflite_fresh(model_path))):
+        # KerasLinear と同じ入出力の TensorFlow Lite オートパイロット
+        pilot = TFLitePilot(num_threads=num_threads)
+        pilot.load(model_path)
+        print('tflite model loaded: {}'.format(get_tflite_path(model_path)))
+    else:
+        # CNNベースの線形回帰モデル(オートパイロット)
+        from donkeycar.parts.keras import KerasLinear
+        pilot = KerasLinear()
+        if model_path:
+            pilot.load(model_path)
+    if dedupe:
+        pilot = DedupePilot(pilot)
+    return pilot
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+量子化済み TensorFlow Lite モデルによるオートパイロットモジュール。
+train 時に Keras モデルファイルから .tflite ファイルを作成し、drive 時に KerasLinear と
+同じ入出力の part として読み込む。
+Raspberry Pi では tflite_runtime パッケージがあればそちらを使用し、TensorFlow 本体を読み込まない。
+"""
+import os
+import numpy as np
+
+# 量子化方式
+QUANTIZE_MODES = ['dynamic', 'float16', 'int8']
+# Keras モデルファイルに対応する .tflite ファイルの拡張子
+TFLITE_EXT = '.tflite'
+
+
+def get_tflite_path(model_path):
+    """
+    Keras モデルファイルパスに対応する .tflite ファイルパスを返却する。
+
+    引数
+        model_path  Keras モデルファイルパス
+    戻り値
+        .tflite ファイルパス
+    """
+    if model_path.endswith(TFLITE_EXT):
+        return model_path
+    return model_path + TFLITE_EXT
+
+
+def is_tflite_fresh(model_path):
+    """
+    Keras モデルファイルに対応する .tflite ファイルが存在し、
+    モデルファイル以降に作成されたものかどうかを判定する。
+
+    引数
+        model_path  Keras モデルファイルパス
+    戻り値
+        boolean     .tflite ファイルが存在し、モデルファイルより古くない場合True
+    """
+    tflite_path = get_tflite_path(model_path)
+    if not os.path.exists(tflite_path):
+        return False
+    if tflite_path == model_path or not os.path.exists(model_path):
+        return True
+    return os.path.getmtime(tflite_path) >= os.path.getmtime(model_path)
+
+
+def export_tflite(model_path, tflite_path=None, quantize='dynamic', samples=None):
+    """
+    Keras モデルファイルを量子化した .tflite ファイルへ変換する。
+
+    引数
+        model_path      Keras モデルファイルパス
+        tflite_path     出力先ファイルパス(Noneの場合は model_path + '.tflite')
+        quantize        量子化方式
+                        'dynamic'   重みのみint8
+                        'float16'   重みをfloat16
+                        'int8'      重み・活性化ともint8(samples 必須、入出力はfloat32のまま)
+        samples         int8 量子化の値域推定に使用する画像配列(N, height, width, channel)
+    戻り値
+        出力した .tflite ファイルパス
+    例外
+        Exception       量子化方式が不正、または int8 で samples がない場合
+    """
+    import tensorflow as tf
+    if quantize not in QUANTIZE_MODES:
+        raise Exception('unknown quantize mode: {}'.format(quantize))
+    if quantize == 'int8' and samples is None:
+        raise Exception('int8 quantization needs sample images')
+    tflite_path = tflite_path or get_tflite_path(model_path)
+
+    if hasattr(tf.lite.TFLiteConverter, 'from_keras_model_file'):
+        # TensorFlow 1.x
+        converter = tf.lite.TFLiteConverter.from_keras_model_file(model_path)
+    else:
+        converter = tf.lite.TFLiteConverter.from_keras_model(tf.keras.models.load_model(model_path))
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantize == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantize == 'int8':
+        def representative_dataset():
+            for sample in samples:
+                yield [sample[np.newaxis].astype(np.float32)]
+        converter.representative_dataset = representative_dataset
+
+    with open(tflite_path, 'wb') as f:
+        f.write(converter.convert())
+    print('tflite model ({}) saved to {}'.format(quantize, tflite_path))
+    return tflite_path
+
+
+def load_interpreter(tflite_path, num_threads=None):
+    """
+    TensorFlow Lite インタプリタを生成する。tflite_runtime がない場合は TensorFlow 本体を使用する。
+
+    引数
+        tflite_path     .tflite ファイルパス
+        num_threads     推論スレッド数(Noneの場合はデフォルト)
+    戻り値
+        Interpreter オブジェクト
+    """
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        from tensorflow.lite import Interpreter
+    if num_threads is None:
+        return Interpreter(model_path=tflite_path)
+    try:
+        return Interpreter(model_path=tflite_path, num_threads=num_threads)
+    except TypeError:
+        # num_threads 未対応の古いバージョン
+        return Interpreter(model_path=tflite_path)
+
+
+class TFLitePilot:
+    """
+    .tflite モデルで推論するオートパイロット part クラス。
+    KerasLinear と同じく画像を受け取り、ステアリング値とスロットル値を返却する。
+    入力テンソルは読み込み時に確保したものを毎回再利用する。
+    """
+
+    def __init__(self, num_threads=None):
+        """
+        インタプリタは load() で生成する。
+
+        引数
+            num_threads     推論スレッド数(Noneの場合はデフォルト)
+        戻り値
+            なし
+        """
+        self.num_threads = num_threads
+        self.interpreter = None
+
+    def load(self, model_path):
+        """
+        .tflite ファイルを読み込む。Keras モデルファイルパスを指定した場合は対応する .tflite を読み込む。
+
+        引数
+            model_path      .tflite ファイルパスまたは Keras モデルファイルパス
+        戻り値
+            なし
+        """
+        self.interpreter = load_interpreter(get_tflite_path(model_path), num_threads=self.num_threads)
+        self.interpreter.allocate_tensors()
+        detail = self.interpreter.get_input_details()[0]
+        self.input_index = detail['index']
+        self.input = np.zeros(detail['shape'], dtype=detail['dtype'])
+        self.input_quant = detail.get('quantization', (0.0, 0))
+        outputs = self.interpreter.get_output_details()
+        # default_linear の出力名(angle_out, throttle_out)で対応付け、なければ定義順
+        angle = [o for o in outputs if 'angle' in o['name']]
+        throttle = [o for o in outputs if 'throttle' in o['name']]
+        if len(angle) == 1 and len(throttle) == 1:
+            outputs = [angle[0], throttle[0]]
+        self.outputs = [(o['index'], o.get('quantization', (0.0, 0))) for o in outputs]
+
+    def run(self, img_arr):
+        """
+        推論する。
+
+        引数
+            img_arr         カメラ画像イメージデータ(np.ndarray)
+        戻り値
+            angle           ステアリング値
+            throttle        スロットル値
+        """
+        scale, zero_point = self.input_quant
+        if self.input.dtype == np.float32 or not scale:
+            self.input[0] = img_arr
+        else:
+            # 入力も量子化されている場合
+            self.input[0] = np.round(img_arr / scale + zero_point)
+        self.interpreter.set_tensor(self.input_index, self.input)
+        self.interpreter.invoke()
+        values = []
+        for index, (scale, zero_point) in self.outputs:
+            value = self.interpreter.get_tensor(index).reshape(-1)[0]
+            if scale:
+                value = (float(value) - zero_point) * scale
+            values.append(float(value))
+        return values[0], values[1]
+
+    def shutdown(self):
+        """
+        何もしない。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        pass
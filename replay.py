@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+実車両(カメラ・PCA9685)なしで manage.py drive と同じ part 構成の Vehicle ループを実行するベンチマーク。
+カメラの代わりに tub データの画像を1周ごとに1件返却し、コントローラは tub に記録された
+手動操作値を返却する。PCA9685 の代わりに出力パルス値を記録する。
+終了時にループ周波数、part ごとの処理時間、オートパイロットと手動操作値(user/angle)の誤差を表示する。
+
+Usage:
+    replay.py [--tub=<tub1,tub2,..tubn>] [--model=<model>] [--mode=<mode>] [--rate=<hz>] [--count=<num>] [--record] [--csv=<csv_path>]
+
+Options:
+    --tub TUBPATHS   画像を読み込む tub ディレクトリ(カンマ区切り、ワイルドカード指定可能)。
+                     tubarrange.py --catalog で作成したdataディレクトリも指定可能。デフォルトは config.py の DATA_PATH 配下。
+    --model MODEL    オートパイロットのモデルファイル。指定しない場合は未学習モデルを使用する。
+    --mode MODE      運転モード('user', 'local_angle', 'local')。[default: local]
+    --rate HZ        ループ周波数。0の場合は待ち合わせなしで実行する。デフォルトは config.py の DRIVE_LOOP_HZ 。
+    --count NUM      ループ回数。tub の先頭からこの件数までの画像のみメモリへ読み込み、不足する場合は繰り返す。[default: 1000]
+    --record         一時ディレクトリへ tub データを書き込む。
+    --csv CSVPATH    part ごとの計測サマリの出力先。
+"""
+import os
+import shutil
+import tempfile
+import numpy as np
+from docopt import docopt
+
+import donkeycar as dk
+
+from loop.replay import TubCamera, ScriptedController, MockPCA9685, SteeringErrorRecorder
+from tubdata.catalog import CatalogDataset
+from tubdata.dataset import TubGroupDataset
+from manage import build_vehicle
+
+# 待ち合わせなしで実行する場合のループ周波数
+FULL_SPEED_HZ = 1000000
+
+
+def load_records(tub_names, count=None):
+    """
+    tub データの先頭から count 件の画像と手動操作値を読み込む。
+
+    引数
+        tub_names   tub ディレクトリのパス
+        count       読み込む件数(Noneの場合はすべて)
+    戻り値
+        images      画像配列(N, height, width, channel)
+        angles      user/angle 配列(N,)
+        throttles   user/throttle 配列(N,)
+    """
+    if CatalogDataset.is_catalog_dir(tub_names):
+        dataset = CatalogDataset(tub_names)
+    else:
+        from donkeycar.parts.datastore import TubGroup
+        dataset = TubGroupDataset(TubGroup(tub_names))
+    if count is None:
+        count = len(dataset)
+    positions = np.arange(min(count, len(dataset)))
+    return dataset.get_batch(positions, ['cam/image_array', 'user/angle', 'user/throttle'])
+
+
+def replay(cfg, tub_names, model_path=None, mode='local', rate_hz=None, count=None,
+           record=False, csv_path=None):
+    """
+    drive() と同じ part 構成の Vehicle ループを tub データで実行する。
+
+    引数
+        cfg         個別車両設定オブジェクト、`config.py`がロードされたオブジェクト。
+        tub_names   画像を読み込む tub ディレクトリのパス
+        model_path  オートパイロットのモデルファイルパス
+        mode        運転モード('user', 'local_angle', 'local')
+        rate_hz     ループ周波数(Noneの場合は cfg.DRIVE_LOOP_HZ、0の場合は待ち合わせなし)
+        count       ループ回数・読み込む画像の件数(Noneの場合は tub の全件)
+        record      一時ディレクトリへ tub データを書き込むかどうか
+        csv_path    part ごとの計測サマリの出力先
+    戻り値
+        なし
+    """
+    images, angles, throttles = load_records(tub_names, count=count)
+    print('{} frames loaded'.format(len(images)))
+
+    # 別プロセス実行は実カメラのみ対象のため、単一プロセスで実行する
+    cfg.DRIVE_MULTIPROCESS = False
+    cfg.INSTRUMENT_CSV_PATH = csv_path
+    if rate_hz is None:
+        rate_hz = cfg.DRIVE_LOOP_HZ
+    elif rate_hz <= 0:
+        # デッドラインがないため BEST_EFFORT の part も先送りしない
+        rate_hz = FULL_SPEED_HZ
+        cfg.SCHEDULER_MAX_DEFER = 0
+    # tub 書き込み part は記録しない場合も生成されるため、常に一時ディレクトリを使用する
+    tub_dir = tempfile.mkdtemp(prefix='replay_')
+    cfg.TUB_PATH = os.path.join(tub_dir, 'tub')
+
+    cam = TubCamera(images)
+    ctr = ScriptedController(cam, angles, throttles, mode=mode, recording=record)
+    steering_controller = MockPCA9685(cfg.STEERING_CHANNEL)
+    throttle_controller = MockPCA9685(cfg.THROTTLE_CHANNEL)
+    V = build_vehicle(cfg, model_path=model_path, use_instrument=True,
+                      cam=cam, ctr=ctr,
+                      steering_controller=steering_controller,
+                      throttle_controller=throttle_controller)
+
+    # オートパイロットの出力と手動操作値の差を集計する part を追加
+    # 入力：
+    #     'pilot/angle'     オートパイロットが指定した次に取るべきステアリング値
+    #     'user/angle'      tub に記録された手動操作によるステアリング値
+    #     'pilot/age'       推論に使用した画像を受け取ってからの経過秒数(古い場合は集計しない)
+    # 出力：
+    #     なし
+    recorder = SteeringErrorRecorder(max_age=cfg.PILOT_MAX_AGE)
+    V.add(recorder, inputs=['pilot/angle', 'user/angle', 'pilot/age'])
+
+    try:
+        V.start(rate_hz=rate_hz, max_loop_count=count or len(images))
+    finally:
+        print('replay: {} frames, {:.1f} loops/sec'.format(cam.frames, cam.get_rate()))
+        steering_controller.report('steering')
+        throttle_controller.report('throttle')
+        recorder.report()
+        shutil.rmtree(tub_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    cfg = dk.load_config()
+
+    model_path = os.path.expanduser(args['--model']) if args['--model'] else None
+    tub_names = args['--tub'] or os.path.join(cfg.DATA_PATH, '*')
+    rate_hz = float(args['--rate']) if args['--rate'] is not None else None
+    count = int(args['--count'])
+
+    replay(cfg, tub_names, model_path=model_path, mode=args['--mode'], rate_hz=rate_hz,
+           count=count, record=args['--record'], csv_path=args['--csv'])
@@ -13,20 +13,46 @@ tubclean 実行後のtubデータを再度番号を振り直すユーティリ
 10. mypilotをダウンロードし、~/mycar/models/mypilot としてコピー
 11. python manage.py drive --model models/mypilot [--js] を実行して自動運転開始
 
+差分モード(--incremental)の場合は 3. は不要で、前回整理したdataディレクトリへ新規・変更レコードのみ追加する。
+tubclean で削除されたレコードはdataディレクトリからも削除する。
+
 
 Usage:
-    tubarrange.py [--tub=<tub1,tub2,..tubn>]  [--data=<>dada_dir] [--debug]
+    tubarrange.py [--tub=<tub1,tub2,..tubn>]  [--data=<>dada_dir] [--copy_mode=<mode>] [--workers=<num>] [--incremental] [--manifest=<path>] [--catalog=<format>] [--processes=<num>] [--debug]
+    tubarrange.py pack [--data=<data_dir>] [--shard=<shard_dir>] [--shard_size=<num>] [--workers=<num>] [--debug]
 
 Options:
-    --tub TUBPATHS   tubファイルが格納されているディレクトリへのパスを指定する。
-    --data DATADIR   整理後データが格納されるディレクトリ。
-    --debug          デバッグモード。
+    --tub TUBPATHS       tubファイルが格納されているディレクトリへのパスを指定する。
+                         カンマ区切り、"~/tubs/*"といったワイルドカード指定で複数指定した場合は、
+                         指定順に連番を振り直して1つのdataディレクトリへ統合する。
+    --data DATADIR       整理後データが格納されるディレクトリ。
+    --copy_mode MODE     イメージファイルの複製方式(auto,reflink,link,copy)。[default: auto]
+    --workers NUM        コピー用スレッド数。[default: 4]
+    --incremental        差分モード。整理済みレコードをスキップし、新規レコードを最終連番の後ろへ追加する。中断後の再開にも使用する。
+    --manifest PATH      差分モードで使用するマニフェストファイルのパス。デフォルトはdataディレクトリ内の .arrange_manifest.jsonl 。
+    --processes NUM      複数tub統合時のtub評価用プロセス数。デフォルトはCPU数。
+    --catalog FORMAT     record_N.json を作成せず、ラベルを1つのカタログファイル(jsonl,csv)へ追記する。
+    --shard SHARDDIR     pack 時のシャード格納ディレクトリ。デフォルトは shards 。
+    --shard_size NUM     pack 時の1シャードあたりの最大レコード件数。[default: 10000]
+    --debug              デバッグモード。
+
+pack を指定した場合は、整理済みのdataディレクトリを画像配列(.npy)とラベル(.npz)の
+シャードファイルへまとめる。python manage.py train --tub <シャード格納ディレクトリ> で
+シャードから直接トレーニングできる。
 """
 import os
 import json
 import shutil
 import docopt
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
 #import donkeycar as dk
+from tubdata.copier import CopyEngine
+from tubdata.manifest import Manifest
+from tubdata.shard import ShardWriter
+from tubdata.catalog import Catalog
+from tubdata.split import expand_tub_paths
 
 class Arranger:
     """
@@ -35,12 +61,17 @@ class Arranger:
     # デフォルトディレクトリ
     DEFAULT_TUB_DIR = 'tub'
     DEFAULT_DATA_DIR = 'data'
+    DEFAULT_SHARD_DIR = 'shards'
     # tubデータ関連の定数
     JSON_PREFIX = 'record_' # JSONファイル接頭文字列
     JSON_SUFFIX = '.json' # JSONファイル接尾文字列
     META_JSON_FILE = 'meta.json' # metaデータJSONファイル
     JPG_SUFFIX = '_cam-image_array_.jpg' # イメージファイル接尾文字列
     JSONKEY_IMAGE = 'cam/image_array' # イメージファイル名を値に持つキー
+    JSONKEY_ANGLE = 'user/angle' # ステアリング値のキー
+    JSONKEY_THROTTLE = 'user/throttle' # スロットル値のキー
+    JSONKEY_MODE = 'user/mode' # 運転モードのキー
+    JSONKEY_TIMESTAMP = 'timestamp' # 時刻のキー
 
     def __init__(self, tub_dir, debug=False):
         """
@@ -84,12 +115,13 @@ class Arranger:
         
         return tub_dir
     
-    def eval_data_dir(self, data_dir):
+    def eval_data_dir(self, data_dir, allow_files=False):
         """
         引数data_dirが指すディレクトリが存在するかどうかを評価する。
 
         引数
-            data_dir  dataディレクトリへのパス
+            data_dir     dataディレクトリへのパス
+            allow_files  既存ファイルがあっても許容するかどうかの真偽値(差分モード)
         戻り値
             data_dir  dataディレクトリへのパス
         例外
@@ -116,7 +148,7 @@ class Arranger:
             #raise Exception (data_dir + ' is not a directory')
         
         files = os.listdir(data_dir)
-        if len(files) > 0:
+        if len(files) > 0 and not allow_files:
             raise Exception(data_dir + ' has ' + str(len(files)) + ' file(s)')
         
         return data_dir
@@ -124,7 +156,8 @@ class Arranger:
     def init(self):
         """
         インスタンス変数を初期化する。
-        tubディレクトリ内のファイルを確認し、連番をキーとした辞書をそれぞれ作成する。
+        tubディレクトリを os.scandir で1回だけ走査し、連番をキーとした辞書をそれぞれ作成する。
+        JSON/JPGの不整合は連番集合の差集合で判定する。
 
         引数
             なし
@@ -133,92 +166,172 @@ class Arranger:
         例外
             Exception tubデータとして不整合がある場合
         """
-        # tub内のjson/jpgファイル名の取得
-        files = os.listdir(self.tub_dir)
         # JSONファイル辞書 {インデックス, ファイル名（非フルパス）}
         self.json_dict = {}
         # JPGファイル辞書 {インデックス, ファイル名（非フルパス）}
         self.jpg_dict = {}
         is_meta_json = False
-        for f in files:
-            path = os.path.join(self.tub_dir, f)
-            if os.path.isfile(path):
-                if f.endswith(self.JSON_SUFFIX) and self.JSON_PREFIX in f:
-                    index =int(f[f.rindex(self.JSON_PREFIX) + len(self.JSON_PREFIX):f.rindex(self.JSON_SUFFIX)])
-                    self.json_dict[index] = f
-                elif f.endswith(self.JPG_SUFFIX):
-                    index =int(f[:f.rindex(self.JPG_SUFFIX)])
-                    self.jpg_dict[index] = f
-                elif f == self.META_JSON_FILE:
-                    is_meta_json = True
-                else:
-                    if self.debug:
-                        print('ignore file: ', path)
+        # tub内のjson/jpgファイル名の取得(ディレクトリエントリの種別のみ参照しstatしない)
+        for entry in os.scandir(self.tub_dir):
+            if not entry.is_file():
+                continue
+            f = entry.name
+            if f.endswith(self.JSON_SUFFIX) and self.JSON_PREFIX in f:
+                index =int(f[f.rindex(self.JSON_PREFIX) + len(self.JSON_PREFIX):f.rindex(self.JSON_SUFFIX)])
+                self.json_dict[index] = f
+            elif f.endswith(self.JPG_SUFFIX):
+                index =int(f[:f.rindex(self.JPG_SUFFIX)])
+                self.jpg_dict[index] = f
+            elif f == self.META_JSON_FILE:
+                is_meta_json = True
+            else:
+                if self.debug:
+                    print('ignore file: ', entry.path)
 
         # 評価
         if not is_meta_json:
             raise Exception('no ' + self.META_JSON_FILE)
-        json_indexes = sorted(list(self.json_dict.keys()))
-        jpg_indexes = sorted(list(self.jpg_dict.keys()))
+        json_indexes = set(self.json_dict.keys())
+        jpg_indexes = set(self.jpg_dict.keys())
         if json_indexes != jpg_indexes:
             if self.debug:
-                for json_index in json_indexes:
-                   if json_index not in jpg_indexes:
-                        print('no match json index: ', json_index)
-                for jpg_index in jpg_indexes:
-                    if jpg_index not in json_indexes:
-                        print('no match jpg index: ', jpg_index)
+                for json_index in sorted(json_indexes - jpg_indexes):
+                    print('no match json index: ', json_index)
+                for jpg_index in sorted(jpg_indexes - json_indexes):
+                    print('no match jpg index: ', jpg_index)
             # 例外を発生
             raise Exception(self.tub_dir + ' is not valid files')
         elif self.debug:
             print(self.tub_dir + ' has normal tub data')
+        # tub側連番リスト(昇順)
+        self.indexes = sorted(json_indexes)
 
-    def execute(self, data_dir):
+    def execute(self, data_dir, copy_mode=CopyEngine.MODE_AUTO, workers=4,
+                incremental=False, manifest_path=None, catalog_format=None):
         """
         tub側データを再整列してdata側へコピーする。
+        同一ファイルシステム上であればイメージファイルはリンクで配置し、
+        それ以外はスレッドプールで並列にコピーする。
+        差分モードの場合は、マニフェストに記録済みのレコードをスキップし、
+        新規レコードを最終連番の後ろへ追加する。tub側から削除されたレコードはdata側からも削除する。
+        カタログ形式を指定した場合は、JSONファイルのかわりにカタログファイルへ追記する。
 
         引数
-            data_dir   data側ディレクトリのパス
+            data_dir       data側ディレクトリのパス
+            copy_mode      イメージファイルの複製方式(auto,reflink,link,copy)
+            workers        コピー用スレッド数
+            incremental    差分モードで実行するかどうかの真偽値
+            manifest_path  マニフェストファイルのパス(デフォルトはdata側ディレクトリ内)
+            catalog_format カタログ形式('jsonl','csv')、Noneの場合はJSONファイルを作成する
         戻り値
             なし
         例外
-            
+            Exception  コピー処理中に例外が発生した場合
         """
-        self.data_dir = self.eval_data_dir(data_dir)
-        indexes = list(self.json_dict.keys()) # tub側連番リスト
-
-        cnt = 0 # data側の連番
-        max_index = max(indexes) # tub側連番最大値
-        for index in range(max_index + 1): # 0～tub側連番最大値までのループ
-            json_file = self.json_dict.get(index) # indexに該当するJSONファイル名
-            jpg_file = self.jpg_dict.get(index) # indexに該当するイメージファイル名
-            if json_file is None or jpg_file is None: # 少なくともどちらかのファイル名がみつからなかった場合
-                if self.debug:
-                    if json_file:
-                        print('ignore json file index=', index)
-                    if jpg_file:
-                        print('ignore jpg file index=', index)
-                continue # 無視
-
-            # コピー元、コピー先各ファイルのフルパス
-            src_json_path = os.path.join(self.tub_dir, json_file)
-            src_jpg_path = os.path.join(self.tub_dir, jpg_file)
-            dest_json_path = os.path.join(self.data_dir, json_file.replace(str(index), str(cnt)))
-            dest_jpg_path = os.path.join(self.data_dir, jpg_file.replace(str(index), str(cnt)))
-
-            # イメージファイルのコピー
-            shutil.copy2(src_jpg_path, dest_jpg_path)
-            if self.debug:
-                print('src:[' + src_jpg_path +  "] dest:[" + dest_jpg_path  + ']')
-            
-            # JSONファイルのコピー
-            self.copy_tub_json_file(src_json_path, index, dest_json_path, cnt)
-            if self.debug:
-                print('src:[' + src_json_path + "] dest:[" + dest_json_path + ']')
-            # data側連番を加算
-            cnt += 1
+        self.open_outputs(data_dir, copy_mode=copy_mode, workers=workers,
+            incremental=incremental, manifest_path=manifest_path,
+            catalog_format=catalog_format)
+        try:
+            # {tub側連番: data側連番} の割当
+            plan = self.plan()
+            # tub側から削除された整理済みレコードをdata側からも削除
+            self.prune()
+            self.submit(plan)
+        finally:
+            # 全コピージョブの完了を待機
+            self.close_outputs()
 
         # meta.json のコピー
+        self.copy_meta_json()
+
+        if self.manifest is not None:
+            print('Done. new records=', self.new_count, ' changed records=', self.changed_count,
+                ' last_index=', self.manifest.last_index())
+        else:
+            print('Done. last_index=', (len(plan)-1))
+        self.engine.report()
+
+    def open_outputs(self, data_dir, copy_mode=CopyEngine.MODE_AUTO, workers=4,
+                     incremental=False, manifest_path=None, catalog_format=None):
+        """
+        data側ディレクトリを評価し、マニフェスト、カタログ、コピーエンジンを準備する。
+
+        引数
+            execute() と同じ
+        戻り値
+            なし
+        """
+        self.data_dir = self.eval_data_dir(data_dir, allow_files=incremental)
+        self.manifest = None
+        if incremental:
+            if manifest_path is None:
+                manifest_path = os.path.join(self.data_dir, Manifest.DEFAULT_FILE)
+            self.manifest = Manifest(os.path.expanduser(manifest_path), debug=self.debug)
+        self.catalog = None
+        if catalog_format is not None:
+            self.catalog = Catalog(self.data_dir, fmt=catalog_format,
+                columns=self.get_meta_inputs(), debug=self.debug)
+            self.catalog.open()
+        self.engine = CopyEngine(self.tub_dir, self.data_dir,
+            mode=copy_mode, workers=workers, debug=self.debug)
+
+    def share_outputs(self, other):
+        """
+        他の Arranger が準備したdata側ディレクトリ、マニフェスト、カタログ、
+        コピーエンジンを共有する(複数tubの統合時に使用)。
+
+        引数
+            other   open_outputs() 済みの Arranger オブジェクト
+        戻り値
+            なし
+        """
+        self.data_dir = other.data_dir
+        self.manifest = other.manifest
+        self.catalog = other.catalog
+        self.engine = other.engine
+
+    def submit(self, plan):
+        """
+        割当に従い、レコード単位のコピージョブを投入する。
+
+        引数
+            plan    {tub側連番: data側連番} 辞書
+        戻り値
+            なし
+        """
+        for index in sorted(plan.keys()): # tub側連番の昇順ループ
+            self.engine.submit(self.arrange_record, index, plan[index])
+
+    def close_outputs(self):
+        """
+        全コピージョブの完了を待機し、カタログ、マニフェストを閉じる。
+
+        引数
+            なし
+        戻り値
+            なし
+        例外
+            Exception  コピー処理中に例外が発生した場合
+        """
+        try:
+            self.engine.close()
+        finally:
+            if self.catalog is not None:
+                self.catalog.close()
+            if self.manifest is not None:
+                self.manifest.close()
+
+    def copy_meta_json(self):
+        """
+        tub側 meta.json をdata側へコピーする。
+
+        引数
+            なし
+        戻り値
+            なし
+        例外
+            Exception  meta.json が存在しない場合
+        """
         src_meta_json_path = os.path.join(self.tub_dir, self.META_JSON_FILE)
         dest_meta_json_path = os.path.join(self.data_dir, self.META_JSON_FILE)
         if not os.path.exists(src_meta_json_path):
@@ -229,8 +342,255 @@ class Arranger:
         else:
             shutil.copy2(src_meta_json_path, dest_meta_json_path)
 
-        print('Done. last_index=', (cnt-1))
+    def plan(self, start=0):
+        """
+        整理対象のtub側連番ごとにdata側連番を割り当てる。
+        差分モードでない場合は start から振り直す。
+        差分モードの場合は、変更のない整理済みレコードを除外し、
+        変更のあったレコードは同じdata側連番へ、新規レコードは新しい連番へ割り当てる。
+
+        引数
+            start   差分モードでない場合の先頭data側連番
+        戻り値
+            plan    {tub側連番: data側連番} 辞書
+        """
+        if self.manifest is None:
+            self.new_count = len(self.indexes)
+            self.changed_count = 0
+            return dict((index, start + cnt) for cnt, index in enumerate(self.indexes))
+
+        plan = {}
+        self.src_stats = {}
+        new_indexes = []
+        for index in self.indexes:
+            src = self.get_src_key(index)
+            size, mtime = self.get_src_stat(index)
+            self.src_stats[index] = (size, mtime)
+            if self.manifest.is_arranged(src, size, mtime):
+                continue
+            dest = self.manifest.get_dest(src)
+            if dest is None:
+                new_indexes.append(index)
+            else:
+                plan[index] = dest
+        # 変更のあったレコード件数、新規レコード件数
+        self.changed_count = len(plan)
+        self.new_count = len(new_indexes)
+        for index, dest in zip(new_indexes, self.manifest.allocate(len(new_indexes))):
+            plan[index] = dest
+        if self.debug:
+            print('skip {} arranged records, arrange {} records'.format(
+                len(self.indexes) - len(plan), len(plan)))
+        return plan
+
+    def get_src_stat(self, index):
+        """
+        マニフェストへ記録するコピー元レコードのサイズと更新時刻を返却する。
+        ラベルのみ編集された場合も検出できるよう、JSONファイルとイメージファイルの両方を参照する。
+
+        引数
+            index   tub側連番
+        戻り値
+            size    JSONファイルとイメージファイルのサイズの合計
+            mtime   JSONファイルとイメージファイルの更新時刻の新しい方
+        """
+        json_stat = os.stat(os.path.join(self.tub_dir, self.json_dict[index]))
+        jpg_stat = os.stat(os.path.join(self.tub_dir, self.jpg_dict[index]))
+        return json_stat.st_size + jpg_stat.st_size, max(json_stat.st_mtime, jpg_stat.st_mtime)
+
+    def prune(self):
+        """
+        差分モードの場合、tub側から削除された(tubclean など)整理済みレコードを
+        data側からも削除し、マニフェストから除外する。
+
+        引数
+            なし
+        戻り値
+            削除したレコード件数
+        """
+        if self.manifest is None:
+            return 0
+        current = set(self.get_src_key(index) for index in self.indexes)
+        removed = [src for src in self.manifest.find(os.path.realpath(self.tub_dir))
+                   if src not in current]
+        for src in removed:
+            dest = self.manifest.get_dest(src)
+            for dest_file in [self.JSON_PREFIX + str(dest) + self.JSON_SUFFIX,
+                              str(dest) + self.JPG_SUFFIX]:
+                dest_path = os.path.join(self.data_dir, dest_file)
+                if os.path.lexists(dest_path):
+                    os.remove(dest_path)
+            if self.catalog is not None:
+                self.catalog.remove(dest)
+            self.manifest.remove(src)
+            if self.debug:
+                print('remove dest index ' + str(dest) + ' deleted from ' + src)
+        if len(removed) > 0:
+            print('removed {} records deleted from {}'.format(len(removed), self.tub_dir))
+        return len(removed)
+
+    def get_src_key(self, index):
+        """
+        マニフェストのキーとするコピー元パスを返却する。
+
+        引数
+            index   tub側連番
+        戻り値
+            コピー元JSONファイルの絶対パス
+        """
+        return os.path.realpath(os.path.join(self.tub_dir, self.json_dict[index]))
+
+    def arrange_record(self, index, cnt):
+        """
+        1レコード分(イメージファイル、JSONファイル)をdata側へコピーする。
+        差分モードの場合は完了後マニフェストへ記録する。
+
+        引数
+            index   tub側連番
+            cnt     data側連番
+        戻り値
+            なし
+        """
+        json_file = self.json_dict[index] # indexに該当するJSONファイル名
+        jpg_file = self.jpg_dict[index] # indexに該当するイメージファイル名
+
+        # コピー元、コピー先各ファイルのフルパス
+        src_json_path = os.path.join(self.tub_dir, json_file)
+        src_jpg_path = os.path.join(self.tub_dir, jpg_file)
+        dest_json_path = os.path.join(self.data_dir, json_file.replace(str(index), str(cnt)))
+        dest_jpg_path = os.path.join(self.data_dir, jpg_file.replace(str(index), str(cnt)))
+
+        # 中断・変更により残っているコピー先ファイルを削除
+        if self.manifest is not None:
+            for dest_path in [dest_jpg_path, dest_json_path]:
+                if os.path.lexists(dest_path):
+                    os.remove(dest_path)
+
+        # イメージファイルのコピー
+        self.engine.transfer(src_jpg_path, dest_jpg_path)
+        if self.debug:
+            print('src:[' + src_jpg_path +  "] dest:[" + dest_jpg_path  + ']')
+
+        # JSONファイルのコピー(カタログ形式の場合はカタログへ追記)
+        if self.catalog is not None:
+            self.append_catalog(src_json_path, index, cnt)
+        else:
+            self.copy_tub_json_file(src_json_path, index, dest_json_path, cnt)
+        if self.debug:
+            print('src:[' + src_json_path + "] dest:[" + dest_json_path + ']')
+
+        if self.manifest is not None:
+            size, mtime = self.src_stats[index]
+            self.manifest.append(self.get_src_key(index), size, mtime, cnt)
+
+    def get_meta_inputs(self):
+        """
+        tub側 meta.json から入力項目名リストを取得する。
+        記載がない場合は manage.py drive で保管している項目とする。
+
+        引数
+            なし
+        戻り値
+            入力項目名リスト
+        """
+        with open(os.path.join(self.tub_dir, self.META_JSON_FILE), 'r') as f:
+            inputs = json.load(f).get('inputs', [])
+        if len(inputs) == 0:
+            inputs = [self.JSONKEY_IMAGE, self.JSONKEY_ANGLE, self.JSONKEY_THROTTLE,
+                      self.JSONKEY_MODE, self.JSONKEY_TIMESTAMP]
+        return inputs
+
+    def append_catalog(self, src_path, org_index, dest_index):
+        """
+        JSONファイル(tubデータ)を読み込み、イメージファイル名を更新してカタログへ追記する。
+
+        引数
+            src_path      元となるJSONファイルのフルパス
+            org_index     元となるJSONファイルの連番
+            dest_index    data側連番
+        戻り値
+            なし
+        例外
+            Exception     元となるJSONファイルにイメージファイル要素が存在しない場合
+        """
+        with open(src_path, 'r') as fr:
+            json_data = json.load(fr)
+        dest_file = json_data.get(self.JSONKEY_IMAGE)
+        if dest_file is None:
+            raise Exception('no cam/image_array in json: ' + src_path)
+        json_data[self.JSONKEY_IMAGE] = dest_file.replace(str(org_index), str(dest_index))
+        self.engine.count_write(self.catalog.append(dest_index, json_data))
+
+    def pack(self, shard_dir, shard_size=10000, workers=4):
+        """
+        tubデータを連番順にシャードファイルへまとめる。
+        JPEGのデコードはスレッドプールで並列に実行する。
+
+        引数
+            shard_dir   シャード格納ディレクトリのパス(Noneの場合はデフォルト)
+            shard_size  1シャードあたりの最大レコード件数
+            workers     デコード用スレッド数
+        戻り値
+            なし
+        例外
+            Exception   レコードが存在しない、もしくは処理中に例外が発生した場合
+        """
+        if shard_dir is None:
+            base_dir = os.path.dirname(os.path.realpath(__file__))
+            shard_dir = os.path.join(base_dir, self.DEFAULT_SHARD_DIR)
+        else:
+            shard_dir = os.path.expanduser(shard_dir)
+        if len(self.indexes) == 0:
+            raise Exception(self.tub_dir + ' has no records')
+
+        # 先頭イメージから画像形状を確定
+        image_shape = self.read_image(self.indexes[0]).shape
+        writer = ShardWriter(shard_dir, len(self.indexes), image_shape,
+            shard_size=shard_size, debug=self.debug)
+        self.engine = CopyEngine(self.tub_dir, shard_dir,
+            mode=CopyEngine.MODE_COPY, workers=workers, debug=self.debug)
+        for position, index in enumerate(self.indexes):
+            self.engine.submit(self.pack_record, writer, position, index)
+        self.engine.close()
+        writer.close()
+
+        print('Done. packed records=', len(self.indexes), ' shards=', len(writer.shards))
+        self.engine.report()
+
+    def read_image(self, index):
+        """
+        tub側連番に該当するイメージファイルを読み込む。
+
+        引数
+            index       tub側連番
+        戻り値
+            uint8 の画像配列
+        """
+        with Image.open(os.path.join(self.tub_dir, self.jpg_dict[index])) as img:
+            return np.asarray(img, dtype=np.uint8)
+
+    def pack_record(self, writer, position, index):
+        """
+        1レコード分をシャードへ書き込む。
 
+        引数
+            writer      ShardWriter オブジェクト
+            position    シャード全体での0始まりのレコード位置
+            index       tub側連番
+        戻り値
+            なし
+        """
+        with open(os.path.join(self.tub_dir, self.json_dict[index]), 'r') as f:
+            json_data = json.load(f)
+        image_arr = self.read_image(index)
+        writer.put(position, image_arr,
+            json_data.get(self.JSONKEY_ANGLE, 0.0),
+            json_data.get(self.JSONKEY_THROTTLE, 0.0),
+            json_data.get(self.JSONKEY_MODE, 'user'),
+            json_data.get(self.JSONKEY_TIMESTAMP, ''))
+        self.engine.count_write(image_arr.nbytes)
+        if self.debug:
+            print('pack index=' + str(index) + ' position=' + str(position))
 
     def copy_tub_json_file(self, src_path, org_index, dest_path, dest_index):
         """
@@ -248,8 +608,9 @@ class Arranger:
             Exception     元となるJSONファイルにイメージファイル要素が存在しない場合
         """
         # 連番が同じ場合はコピーのみ実行
+        # (data側の編集がtub側へ波及しないよう、リンクは使用しない)
         if org_index == dest_index:
-            shutil.copy2(src_path, dest_path)
+            self.engine.transfer(src_path, dest_path, link=False)
             if self.debug:
                 print('copy from ' + src_path + ' to ' + dest_path)
             return
@@ -264,6 +625,97 @@ class Arranger:
                 json.dump(json_data, fw)
                 if self.debug:
                     print('write {} to {}', json.dumps(json_data), dest_path)
+                self.engine.count_write(fw.tell())
+
+
+def load_arranger(tub_dir, debug=False):
+    """
+    tubディレクトリを評価・索引化した Arranger を返却する。
+    プロセスプールから呼び出すためモジュールレベル関数としている。
+
+    引数
+        tub_dir   tubディレクトリへのパス
+        debug     デバッグモード
+    戻り値
+        Arranger オブジェクト
+    """
+    return Arranger(tub_dir, debug=debug)
+
+
+class Merger:
+    """
+    複数のtubデータを1つのdataディレクトリへ連番を振り直して統合するユーティリティクラス。
+    各tubの評価はプロセスプールで並列に行い、tubごとのdata側連番の範囲を
+    事前に確定したうえで、全tubのコピージョブを1つのコピーエンジンへ同時に投入する。
+    """
+
+    def __init__(self, tub_paths, processes=None, debug=False):
+        """
+        各tubディレクトリをプロセスプールで並列に評価する。
+
+        引数
+            tub_paths   tubディレクトリパスのリスト
+            processes   評価用プロセス数(Noneの場合はCPU数)
+            debug       デバッグモード
+        戻り値
+            なし
+        例外
+            Exception   いずれかのtubデータに不整合がある場合
+        """
+        self.debug = debug
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            self.arrangers = list(executor.map(load_arranger,
+                tub_paths, [debug] * len(tub_paths)))
+        if self.debug:
+            for arranger in self.arrangers:
+                print('{}: {} records'.format(arranger.tub_dir, len(arranger.indexes)))
+
+    def execute(self, data_dir, copy_mode=CopyEngine.MODE_AUTO, workers=4,
+                incremental=False, manifest_path=None, catalog_format=None):
+        """
+        全tubのデータを指定順に連番を振り直して1つのdataディレクトリへコピーする。
+        meta.json は先頭のtubのものをコピーする。
+
+        引数
+            Arranger.execute() と同じ
+        戻り値
+            なし
+        例外
+            Exception  コピー処理中に例外が発生した場合
+        """
+        head = self.arrangers[0]
+        head.open_outputs(data_dir, copy_mode=copy_mode, workers=workers,
+            incremental=incremental, manifest_path=manifest_path,
+            catalog_format=catalog_format)
+        total = 0
+        try:
+            # 全tubのdata側連番範囲を事前に確定
+            plans = []
+            for arranger in self.arrangers:
+                arranger.share_outputs(head)
+                plan = arranger.plan(start=total)
+                arranger.prune()
+                plans.append(plan)
+                total += len(plan)
+                if self.debug and len(plan) > 0:
+                    print('{}: dest index {}-{}'.format(arranger.tub_dir,
+                        min(plan.values()), max(plan.values())))
+            # 全tubのコピージョブを投入
+            for arranger, plan in zip(self.arrangers, plans):
+                arranger.submit(plan)
+        finally:
+            head.close_outputs()
+
+        head.copy_meta_json()
+
+        if head.manifest is not None:
+            print('Done. tubs=', len(self.arrangers),
+                ' new records=', sum(a.new_count for a in self.arrangers),
+                ' changed records=', sum(a.changed_count for a in self.arrangers),
+                ' last_index=', head.manifest.last_index())
+        else:
+            print('Done. tubs=', len(self.arrangers), ' last_index=', (total-1))
+        head.engine.report()
 
 
 # 本ファイル自体が実行された場合
@@ -271,7 +723,32 @@ if __name__ == '__main__':
     # 引数情報の収集
     args = docopt.docopt(__doc__)
 
-    # 再整理ユーティリティの初期化
-    arranger = Arranger(args['--tub'], debug=args['--debug'])
-    # dataディレクトリの確定
-    arranger.execute(args['--data'])
\ No newline at end of file
+    # シャード作成の場合
+    if args['pack']:
+        data_dir = args['--data']
+        if data_dir is None:
+            data_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), Arranger.DEFAULT_DATA_DIR)
+        # 整理済みdataディレクトリをtubとして読み込む
+        arranger = Arranger(data_dir, debug=args['--debug'])
+        arranger.pack(args['--shard'],
+            shard_size=int(args['--shard_size']), workers=int(args['--workers']))
+    # 複数tubが指定された場合は統合
+    elif args['--tub'] is not None and len(expand_tub_paths(args['--tub'])) > 1:
+        processes = args['--processes']
+        merger = Merger(expand_tub_paths(args['--tub']),
+            processes=None if processes is None else int(processes), debug=args['--debug'])
+        merger.execute(args['--data'],
+            copy_mode=args['--copy_mode'], workers=int(args['--workers']),
+            incremental=args['--incremental'], manifest_path=args['--manifest'],
+            catalog_format=args['--catalog'])
+    else:
+        # 再整理ユーティリティの初期化(ワイルドカード・カンマ区切りで1件のみ該当した場合は展開後のパス)
+        tub_dir = args['--tub']
+        if tub_dir is not None and len(expand_tub_paths(tub_dir)) == 1:
+            tub_dir = expand_tub_paths(tub_dir)[0]
+        arranger = Arranger(tub_dir, debug=args['--debug'])
+        # dataディレクトリの確定
+        arranger.execute(args['--data'],
+            copy_mode=args['--copy_mode'], workers=int(args['--workers']),
+            incremental=args['--incremental'], manifest_path=args['--manifest'],
+            catalog_format=args['--catalog'])
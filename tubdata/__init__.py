@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+# PIL やデータセット関連を読み込まないよう、各サブモジュール(tubdata.writer など)から読み込む
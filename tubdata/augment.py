@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+トレーニングバッチ全体に対してNumPyのベクトル演算でデータ拡張を行うモジュール。
+画像1件ごとのPythonループは行わず、(B,120,160,3) のバッチ単位で以下を適用する。
+
+* 左右反転(反転した画像は user/angle の符号を反転)
+* 明るさ・コントラストの揺らぎ(int16 固定小数点演算)
+* 上下左右の数ピクセル平行移動(端の画素で埋める)
+"""
+import time
+import numpy as np
+
+
+class BatchAugmenter:
+    """
+    バッチ単位のデータ拡張クラス。乱数シードを指定すると結果は再現可能である。
+    """
+    IMAGE_KEY = 'cam/image_array'
+    ANGLE_KEY = 'user/angle'
+
+    def __init__(self, flip_prob=0.5, brightness=0.2, contrast=0.2, max_shift=4, seed=None):
+        """
+        引数
+            flip_prob   左右反転する確率
+            brightness  明るさの揺らぎ幅(画素値255に対する割合、±)
+            contrast    コントラストの揺らぎ幅(倍率1.0に対する割合、±)
+            max_shift   平行移動の最大ピクセル数(±)
+            seed        乱数シード
+        戻り値
+            なし
+        """
+        self.flip_prob = flip_prob
+        self.brightness = brightness
+        self.contrast = contrast
+        self.max_shift = int(max_shift)
+        self.rng = np.random.RandomState(seed)
+        self.batches = 0
+        self.elapsed = 0.0
+
+    def apply(self, images, angles=None):
+        """
+        バッチにデータ拡張を適用する。引数の配列は変更しない。
+
+        引数
+            images      uint8 の画像バッチ (B,H,W,C)
+            angles      ステアリング値バッチ (B,)、Noneの場合は反転しない
+        戻り値
+            images      拡張後の uint8 画像バッチ
+            angles      拡張後のステアリング値バッチ
+        """
+        start = time.time()
+        images = np.asarray(images)
+        n = images.shape[0]
+
+        # 平行移動(反転・輝度変換の前に新しい配列を作成する)
+        if self.max_shift > 0:
+            images = self.shift(images)
+        else:
+            images = np.array(images, dtype=np.uint8)
+
+        # 左右反転
+        if self.flip_prob > 0:
+            flip = self.rng.rand(n) < self.flip_prob
+            self.flip(images, np.nonzero(flip)[0])
+            if angles is not None:
+                angles = np.where(flip, -np.asarray(angles), angles).astype(np.float32)
+
+        # 明るさ・コントラスト
+        if self.brightness > 0 or self.contrast > 0:
+            images = self.jitter(images)
+
+        self.batches += 1
+        self.elapsed += time.time() - start
+        return images, angles
+
+    def shift(self, images):
+        """
+        画像ごとに異なる量だけ平行移動し、はみ出した領域は端の画素で埋める。
+        移動量(最大 (2*max_shift+1)^2 通り)ごとにまとめてスライスで複写する。
+
+        引数
+            images      uint8 の画像バッチ (B,H,W,C)
+        戻り値
+            平行移動後の uint8 画像バッチ(新しい配列)
+        """
+        n, h, w = images.shape[:3]
+        s = self.max_shift
+        dy = self.rng.randint(-s, s + 1, size=n)
+        dx = self.rng.randint(-s, s + 1, size=n)
+        out = np.empty_like(images)
+        key = (dy + s) * (2 * s + 1) + (dx + s)
+        for k in np.unique(key):
+            g = np.nonzero(key == k)[0]
+            y = int(k // (2 * s + 1)) - s
+            x = int(k % (2 * s + 1)) - s
+            out[g, max(y, 0):h + min(y, 0), max(x, 0):w + min(x, 0)] = \
+                images[g, max(-y, 0):h + min(-y, 0), max(-x, 0):w + min(-x, 0)]
+            # 端の画素で埋める
+            if y > 0:
+                out[g, :y] = out[g, y:y + 1]
+            elif y < 0:
+                out[g, h + y:] = out[g, h + y - 1:h + y]
+            if x > 0:
+                out[g, :, :x] = out[g, :, x:x + 1]
+            elif x < 0:
+                out[g, :, w + x:] = out[g, :, w + x - 1:w + x]
+        return out
+
+    def flip(self, images, targets):
+        """
+        指定した画像を左右反転する(引数の配列を直接変更する)。
+        画素(C バイト)単位の void 型ビューで反転し、チャネル順は維持する。
+
+        引数
+            images      C連続な uint8 の画像バッチ (B,H,W,C)
+            targets     反転する画像の位置の配列
+        戻り値
+            なし
+        """
+        if len(targets) == 0:
+            return
+        pixels = images.view('V' + str(images.shape[3]))
+        pixels[targets] = pixels[targets, :, ::-1]
+
+    def jitter(self, images):
+        """
+        画像ごとに明るさ・コントラストを変える。
+        平均輝度(間引いた画素から推定)を中心にコントラストを変え、明るさを加える演算を
+        int16 の固定小数点(1/64単位)でバッチ一括に行う。
+
+        引数
+            images      uint8 の画像バッチ (B,H,W,C)
+        戻り値
+            変換後の uint8 画像バッチ
+        """
+        n = images.shape[0]
+        shape = (n,) + (1,) * (images.ndim - 1)
+        c = np.round(64 * (1.0 + self.rng.uniform(-self.contrast, self.contrast, size=shape)))
+        b = 255.0 * self.rng.uniform(-self.brightness, self.brightness, size=shape)
+        mean = images.reshape(n, -1)[:, ::61].mean(axis=1).reshape(shape)
+        # (x - mean) * c / 64 + mean + b = x * c / 64 + offset
+        offset = np.round(mean - mean * c / 64.0 + b).astype(np.int16)
+        x = images.astype(np.int16)
+        x *= c.astype(np.int16)
+        x >>= 6
+        x += offset
+        np.clip(x, 0, 255, out=x)
+        return x.astype(np.uint8)
+
+    def wrap(self, gen, X_keys, y_keys):
+        """
+        (X, y) を返却するGeneratorをデータ拡張付きのGeneratorに変換する。
+
+        引数
+            gen         (X, y) を返却するGenerator
+            X_keys      入力データのキーのリスト
+            y_keys      出力データのキーのリスト
+        戻り値
+            データ拡張済みの (X, y) を返却するGenerator
+        """
+        image_pos = X_keys.index(self.IMAGE_KEY)
+        angle_pos = y_keys.index(self.ANGLE_KEY) if self.ANGLE_KEY in y_keys else None
+        for X, y in gen:
+            X = list(X)
+            y = list(y)
+            angles = y[angle_pos] if angle_pos is not None else None
+            X[image_pos], angles = self.apply(X[image_pos], angles)
+            if angle_pos is not None:
+                y[angle_pos] = angles
+            yield X, y
+
+    def report(self):
+        """
+        1バッチあたりの平均処理時間を表示する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        if self.batches > 0:
+            print('augment: {} batches, {:.2f} ms/batch'.format(
+                self.batches, 1000.0 * self.elapsed / self.batches))
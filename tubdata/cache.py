@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+デコード済み画像のディスクキャッシュモジュール。
+JPEGをデコードした uint8 配列を1つのメモリマップファイルへ格納し、
+イメージファイルの絶対パスと更新時刻をキーとした索引をJSONで保存する。
+2エポック目以降やトレーニングの再実行時はJPEGデコードを行わずに画像を取得できる。
+"""
+import os
+import json
+import threading
+import numpy as np
+from PIL import Image
+
+
+def decode_image(path):
+    """
+    イメージファイルを読み込み uint8 配列へデコードする。
+
+    引数
+        path    イメージファイルのパス
+    戻り値
+        uint8 の画像配列
+    """
+    with Image.open(path) as img:
+        return np.asarray(img, dtype=np.uint8)
+
+
+class ImageCache:
+    """
+    デコード済み画像キャッシュクラス。
+    容量(max_bytes)を超える画像は格納せず、都度デコードする。
+    トレーニング/評価データGeneratorのスレッドから同時に呼び出せる。
+    """
+    IMAGES_FILE = 'images.npy'
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, cache_dir, image_shape, max_bytes=2 * 1024 ** 3,
+                 flush_interval=1000, debug=False):
+        """
+        キャッシュファイルを開く。画像形状・容量が既存キャッシュと異なる場合は作り直す。
+
+        引数
+            cache_dir       キャッシュ格納ディレクトリのパス
+            image_shape     画像1件の形状 (height, width, channel)
+            max_bytes       キャッシュファイルの最大バイト数
+            flush_interval  索引を保存する格納件数間隔
+            debug           デバッグモード
+        戻り値
+            なし
+        """
+        self.debug = debug
+        self.cache_dir = os.path.expanduser(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.image_shape = tuple(image_shape)
+        self.capacity = int(max_bytes // int(np.prod(self.image_shape)))
+        self.flush_interval = flush_interval
+        self.images_path = os.path.join(self.cache_dir, self.IMAGES_FILE)
+        self.index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+        self.hits = 0
+        self.misses = 0
+        self.unsaved = 0
+        self.lock = threading.Lock()
+
+        # 索引 {キー: スロット番号}
+        self.slots = {}
+        index = None
+        if os.path.isfile(self.index_path) and os.path.isfile(self.images_path):
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        if index is not None and tuple(index['image_shape']) == self.image_shape \
+                and index['capacity'] == self.capacity:
+            self.slots = index['slots']
+            self.images = np.load(self.images_path, mmap_mode='r+')
+        else:
+            # 未使用領域は疎ファイルとなるため実際のディスク使用量は格納件数分
+            self.images = np.lib.format.open_memmap(self.images_path, mode='w+',
+                dtype=np.uint8, shape=(self.capacity,) + self.image_shape)
+            self.save()
+        if self.debug:
+            print('image cache {}: {}/{} slots used'.format(
+                self.cache_dir, len(self.slots), self.capacity))
+
+    @staticmethod
+    def make_key(path):
+        """
+        イメージファイルの絶対パスと更新時刻からキーを作成する。
+
+        引数
+            path    イメージファイルのパス
+        戻り値
+            キー文字列
+        """
+        path = os.path.abspath(path)
+        return path + ':' + str(os.stat(path).st_mtime)
+
+    def get(self, path):
+        """
+        キャッシュから画像を取得する。存在しない場合はデコードして格納する。
+
+        引数
+            path    イメージファイルのパス
+        戻り値
+            uint8 の画像配列(キャッシュ上の場合はメモリマップのビュー)
+        """
+        key, image_arr = self.lookup(path)
+        if image_arr is not None:
+            return image_arr
+        image_arr = decode_image(path)
+        self.put(key, image_arr)
+        return image_arr
+
+    def lookup(self, path):
+        """
+        キャッシュから画像を取得する。デコードは行わない。
+
+        引数
+            path        イメージファイルのパス
+        戻り値
+            key         キー文字列
+            image_arr   メモリマップ上の画像配列のビュー、存在しない場合None
+        """
+        key = self.make_key(path)
+        slot = self.slots.get(key)
+        if slot is None:
+            self.misses += 1
+            return key, None
+        self.hits += 1
+        return key, self.images[slot]
+
+    def put(self, key, image_arr):
+        """
+        デコード済み画像を格納する。容量超過、形状不一致の場合は格納しない。
+
+        引数
+            key         lookup() が返却したキー文字列
+            image_arr   uint8 の画像配列
+        戻り値
+            なし
+        """
+        if image_arr.shape != self.image_shape:
+            return
+        with self.lock:
+            if key not in self.slots and len(self.slots) < self.capacity:
+                slot = len(self.slots)
+                self.images[slot] = image_arr
+                self.slots[key] = slot
+                self.unsaved += 1
+                if self.unsaved >= self.flush_interval:
+                    self.save()
+
+    def save(self):
+        """
+        画像配列をフラッシュし、索引を保存する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        self.images.flush()
+        # 索引の書き込みは画像書き込みの後に行うため、中断時も索引は常に有効
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'image_shape': list(self.image_shape),
+                       'capacity': self.capacity, 'slots': self.slots}, f)
+        os.replace(tmp_path, self.index_path)
+        self.unsaved = 0
+
+    def close(self):
+        """
+        索引を保存し、ヒット率を表示する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        with self.lock:
+            self.save()
+        total = max(self.hits + self.misses, 1)
+        print('image cache: {} slots used, hit rate {:.1f}% ({}/{})'.format(
+            len(self.slots), 100.0 * self.hits / total, self.hits, total))
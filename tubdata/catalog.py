@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+tubデータのラベルを1ファイルにまとめたカタログモジュール。
+record_N.json を1件ずつ作成するかわりに、追記専用の JSONL もしくは CSV ファイルへ
+1行1レコードで書き込み、data側連番ごとの行先頭バイト位置をオフセット索引ファイルへ記録する。
+
+    catalog.jsonl / catalog.csv   ラベルカタログ
+    catalog.idx                   (data側連番, バイト位置) の int64 ペア列
+"""
+import os
+import io
+import csv
+import json
+import array
+import threading
+from .dataset import RecordDataset
+
+
+class Catalog:
+    """
+    カタログファイルの書き込み・読み込みを行うクラス。
+    追記は複数スレッドから呼び出せる。行の並びは追記順であり、
+    同じ連番が複数回追記された場合は最後の行が有効となる。
+    """
+    FORMAT_JSONL = 'jsonl'
+    FORMAT_CSV = 'csv'
+    FORMATS = [FORMAT_JSONL, FORMAT_CSV]
+    BASE_NAME = 'catalog'
+    INDEX_FILE = 'catalog.idx'
+    INDEX_KEY = '_index'    # data側連番を格納するキー(列名)
+
+    @classmethod
+    def find(cls, data_dir):
+        """
+        ディレクトリ内のカタログ形式を判定する。
+
+        引数
+            data_dir    dataディレクトリのパス
+        戻り値
+            カタログ形式('jsonl','csv')、存在しない場合None
+        """
+        if data_dir is None or ',' in data_dir:
+            return None
+        data_dir = os.path.expanduser(data_dir)
+        for fmt in cls.FORMATS:
+            if os.path.isfile(os.path.join(data_dir, cls.BASE_NAME + '.' + fmt)):
+                return fmt
+        return None
+
+    def __init__(self, data_dir, fmt=FORMAT_JSONL, columns=None, debug=False):
+        """
+        カタログファイルとオフセット索引を読み込む。
+
+        引数
+            data_dir    dataディレクトリのパス
+            fmt         カタログ形式('jsonl','csv')
+            columns     CSV形式の場合の列名リスト(新規作成時のみ使用)
+            debug       デバッグモード
+        戻り値
+            なし
+        例外
+            Exception   不正な形式が指定された場合
+        """
+        if fmt not in self.FORMATS:
+            raise Exception('unknown catalog format: ' + str(fmt))
+        self.debug = debug
+        self.fmt = fmt
+        self.path = os.path.join(data_dir, self.BASE_NAME + '.' + fmt)
+        self.index_path = os.path.join(data_dir, self.INDEX_FILE)
+        self.lock = threading.Lock()
+        self.file = None
+        self.index_file = None
+        self.columns = None
+        if fmt == self.FORMAT_CSV:
+            if os.path.isfile(self.path):
+                with open(self.path, 'r', newline='') as f:
+                    self.columns = next(csv.reader(f))
+            else:
+                self.columns = [self.INDEX_KEY] + list(columns or [])
+        # オフセット索引 {data側連番: バイト位置}
+        self.offsets = {}
+        if os.path.isfile(self.index_path):
+            pairs = array.array('q')
+            with open(self.index_path, 'rb') as f:
+                pairs.frombytes(f.read())
+            for i in range(0, len(pairs) - 1, 2):
+                self.offsets[pairs[i]] = pairs[i + 1]
+
+    def open(self):
+        """
+        追記用にカタログファイルを開く。CSV形式で新規作成の場合はヘッダ行を書き込む。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        is_new = not os.path.isfile(self.path)
+        self.file = open(self.path, 'ab')
+        self.index_file = open(self.index_path, 'ab')
+        if is_new and self.fmt == self.FORMAT_CSV:
+            self.file.write(self.to_line(dict((c, c) for c in self.columns)))
+
+    def to_line(self, record):
+        """
+        レコード辞書をカタログ1行分のバイト列に変換する。
+        """
+        if self.fmt == self.FORMAT_JSONL:
+            return (json.dumps(record) + '\n').encode('utf-8')
+        buf = io.StringIO()
+        csv.writer(buf, lineterminator='\n').writerow(
+            [record.get(c, '') for c in self.columns])
+        return buf.getvalue().encode('utf-8')
+
+    def append(self, index, record):
+        """
+        レコードを1件追記し、オフセット索引を更新する。スレッドセーフ。
+
+        引数
+            index       data側連番
+            record      レコード辞書
+        戻り値
+            size        書き込んだバイト数
+        """
+        record = dict(record)
+        record[self.INDEX_KEY] = index
+        line = self.to_line(record)
+        with self.lock:
+            offset = self.file.tell()
+            self.file.write(line)
+            self.index_file.write(array.array('q', [index, offset]).tobytes())
+            self.offsets[index] = offset
+        return len(line)
+
+    def remove(self, index):
+        """
+        指定連番のレコードを無効にする。オフセット索引へ負のバイト位置を追記し、
+        カタログの既存行は read_all() で読み飛ばされる。スレッドセーフ。
+
+        引数
+            index       data側連番
+        戻り値
+            なし
+        """
+        with self.lock:
+            self.index_file.write(array.array('q', [index, -1]).tobytes())
+            self.offsets[index] = -1
+
+    def close(self):
+        """
+        カタログファイルとオフセット索引をディスクへ同期して閉じる。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        with self.lock:
+            for f in [self.file, self.index_file]:
+                if f is not None:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    f.close()
+            self.file = None
+            self.index_file = None
+
+    def parse_line(self, line):
+        """
+        カタログ1行分の文字列をレコード辞書へ変換する。
+        CSV形式の場合、値はすべて文字列となる。
+        """
+        if self.fmt == self.FORMAT_JSONL:
+            return json.loads(line)
+        return dict(zip(self.columns, next(csv.reader([line]))))
+
+    def get(self, index):
+        """
+        オフセット索引を使って指定連番のレコードを1件読み込む。
+
+        引数
+            index       data側連番
+        戻り値
+            レコード辞書
+        """
+        with open(self.path, 'rb') as f:
+            f.seek(self.offsets[index])
+            return self.parse_line(f.readline().decode('utf-8'))
+
+    def read_all(self):
+        """
+        カタログを先頭から1回だけ順に読み込み、有効なレコードを返却する。
+
+        引数
+            なし
+        戻り値
+            {data側連番: レコード辞書} 辞書
+        """
+        records = {}
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if self.fmt == self.FORMAT_CSV and offset == 0:
+                    offset += len(line)
+                    continue
+                try:
+                    record = self.parse_line(line.decode('utf-8'))
+                except ValueError:
+                    # 書き込み途中で中断された行
+                    if self.debug:
+                        print('ignore broken catalog line at ' + str(offset))
+                    offset += len(line)
+                    continue
+                index = int(record[self.INDEX_KEY])
+                # 同じ連番の古い行は無視
+                if self.offsets.get(index, offset) == offset:
+                    records[index] = record
+                offset += len(line)
+        return records
+
+
+class CatalogDataset(RecordDataset):
+    """
+    カタログ形式のdataディレクトリを読み込み、TubGroup と同じ形式の
+    トレーニング/評価データGeneratorを提供するクラス。
+    ラベルはカタログを1回順に読むだけで取得し、画像はバッチごとにデコードする。
+    """
+
+    @staticmethod
+    def is_catalog_dir(path):
+        """
+        指定パスがカタログ形式のdataディレクトリかどうかを判定する。
+
+        引数
+            path    判定対象パス
+        戻り値
+            boolean カタログファイルが存在する場合True
+        """
+        return Catalog.find(path) is not None
+
+    def __init__(self, data_dir, cache=None, debug=False):
+        """
+        カタログを読み込む。
+
+        引数
+            data_dir    dataディレクトリのパス
+            cache       ImageCache オブジェクト(Noneの場合は都度デコード)
+            debug       デバッグモード
+        戻り値
+            なし
+        """
+        self.data_dir = os.path.expanduser(data_dir)
+        catalog = Catalog(self.data_dir, fmt=Catalog.find(self.data_dir), debug=debug)
+        records = catalog.read_all()
+        self.indexes = sorted(records.keys())
+        image_paths = [os.path.join(self.data_dir, records[i][self.IMAGE_KEY])
+                       for i in self.indexes]
+        labels = dict((key, [records[i][key] for i in self.indexes])
+                      for key in self.LABEL_KEYS
+                      if len(records) > 0 and key in records[self.indexes[0]])
+        super(CatalogDataset, self).__init__(image_paths, labels, cache=cache)
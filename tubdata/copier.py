@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+tubデータのファイルを高速に複製するためのコピーエンジンモジュール。
+コピー元とコピー先が同一ファイルシステム上にある場合は reflink もしくは
+ハードリンクでデータ本体を複製せずに配置し、異なる場合はスレッドプールで
+並列にコピーする。処理件数・バイト数からスループットを集計する。
+"""
+import os
+import time
+import errno
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class CopyEngine:
+    """
+    ファイル複製処理を実行するエンジンクラス。
+    copy() / submit() で投入したジョブはスレッドプール上で実行され、
+    close() で全ジョブの完了を待機する。
+    複数のコピー元ディレクトリで共有する場合、コピー先と異なるファイルシステム上の
+    ファイルはリンクせずにコピーする。
+    """
+    # 複製方式
+    MODE_AUTO = 'auto'          # reflink→ハードリンク→コピーの順に試行
+    MODE_REFLINK = 'reflink'    # reflink(不可の場合はコピー)
+    MODE_LINK = 'link'          # ハードリンク(不可の場合はコピー)
+    MODE_COPY = 'copy'          # 常にコピー
+    MODES = [MODE_AUTO, MODE_REFLINK, MODE_LINK, MODE_COPY]
+
+    # Linux ioctl FICLONE (_IOW(0x94, 9, int))
+    FICLONE = 0x40049409
+
+    def __init__(self, src_dir, dest_dir, mode=MODE_AUTO, workers=4, debug=False):
+        """
+        コピー元・コピー先ディレクトリのファイルシステムを確認し、
+        使用する複製方式を決定する。
+
+        引数
+            src_dir     コピー元ディレクトリのパス
+            dest_dir    コピー先ディレクトリのパス
+            mode        複製方式('auto','reflink','link','copy')
+            workers     コピー用スレッド数
+            debug       デバッグモード
+        戻り値
+            なし
+        例外
+            Exception   不正な複製方式が指定された場合
+        """
+        if mode not in self.MODES:
+            raise Exception('unknown copy mode: ' + str(mode))
+        self.debug = debug
+        self.workers = max(1, int(workers))
+
+        # 同一ファイルシステムでない場合はコピーのみ
+        same_fs = os.stat(src_dir).st_dev == os.stat(dest_dir).st_dev
+        self.use_reflink = same_fs and fcntl is not None and \
+            mode in [self.MODE_AUTO, self.MODE_REFLINK]
+        self.use_link = same_fs and mode in [self.MODE_AUTO, self.MODE_LINK]
+        if self.debug:
+            print('copy engine: same_fs={} reflink={} link={} workers={}'.format(
+                same_fs, self.use_reflink, self.use_link, self.workers))
+
+        self.lock = threading.Lock()
+        # 投入済み未完了ジョブ数の上限(メモリ上にFutureを溜め込まない)
+        self.slots = threading.BoundedSemaphore(self.workers * 4)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.errors = []
+        # 集計値 {方式: 件数}
+        self.counts = {'reflink': 0, 'link': 0, 'copy': 0, 'write': 0}
+        self.total_bytes = 0
+        self.start_time = time.time()
+        self.end_time = None
+
+    def copy(self, src_path, dest_path):
+        """
+        ファイル複製ジョブを投入する。
+
+        引数
+            src_path    コピー元ファイルのパス
+            dest_path   コピー先ファイルのパス
+        戻り値
+            なし
+        """
+        self.submit(self.transfer, src_path, dest_path)
+
+    def submit(self, func, *args):
+        """
+        任意の処理をジョブとして投入する。
+        func は書き込んだバイト数を返却すると集計対象となる。
+        実行中ジョブ数が上限に達している場合は空くまで待機する。
+
+        引数
+            func        実行する関数
+            args        関数へ渡す引数
+        戻り値
+            なし
+        """
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(func, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(self._on_done)
+
+    def _on_done(self, future):
+        """
+        ジョブ完了時のコールバック。例外を記録しスロットを解放する。
+        """
+        self.slots.release()
+        e = future.exception()
+        if e is not None:
+            with self.lock:
+                self.errors.append(e)
+
+    def transfer(self, src_path, dest_path, link=True):
+        """
+        呼び出し元スレッド上でファイルを1件複製する。
+        reflink、ハードリンクの順に試行し、いずれも使用できない場合はコピーする。
+        一度失敗した方式は以降使用しない。
+        link が偽の場合は常にコピーする(編集される可能性のあるJSONファイルなど)。
+
+        引数
+            src_path    コピー元ファイルのパス
+            dest_path   コピー先ファイルのパス
+            link        reflink・ハードリンクを使用するかどうかの真偽値
+        戻り値
+            size        複製したバイト数
+        """
+        size = os.path.getsize(src_path)
+        if not link:
+            shutil.copy2(src_path, dest_path)
+            self._count('copy', size)
+            return size
+        if self.use_reflink:
+            if self._reflink(src_path, dest_path):
+                self._count('reflink', size)
+                return size
+        if self.use_link:
+            try:
+                os.link(src_path, dest_path)
+                self._count('link', size)
+                return size
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    raise
+                # 別ファイルシステム上のファイルの場合はこのファイルのみコピー
+                if e.errno != errno.EXDEV:
+                    # ハードリンク未サポートのファイルシステム
+                    self.use_link = False
+                    if self.debug:
+                        print('hard link disabled: ' + str(e))
+        shutil.copy2(src_path, dest_path)
+        self._count('copy', size)
+        return size
+
+    def _reflink(self, src_path, dest_path):
+        """
+        FICLONE ioctl によりデータブロックを共有したファイルを作成する。
+
+        引数
+            src_path    コピー元ファイルのパス
+            dest_path   コピー先ファイルのパス
+        戻り値
+            boolean     成功した場合True
+        """
+        try:
+            with open(src_path, 'rb') as fr:
+                with open(dest_path, 'wb') as fw:
+                    fcntl.ioctl(fw.fileno(), self.FICLONE, fr.fileno())
+            shutil.copystat(src_path, dest_path)
+            return True
+        except OSError as e:
+            if os.path.exists(dest_path):
+                os.remove(dest_path)
+            # 別ファイルシステム上のファイルの場合はこのファイルのみ無効
+            if e.errno != errno.EXDEV:
+                # reflink 未サポートのファイルシステム
+                self.use_reflink = False
+                if self.debug:
+                    print('reflink disabled: ' + str(e))
+            return False
+
+    def count_write(self, size):
+        """
+        copy() 以外の方法で書き込んだファイルを集計する。
+
+        引数
+            size        書き込んだバイト数
+        戻り値
+            なし
+        """
+        self._count('write', size)
+
+    def _count(self, method, size):
+        with self.lock:
+            self.counts[method] += 1
+            self.total_bytes += size
+
+    def close(self):
+        """
+        投入済みジョブの完了を待機し、スレッドプールを終了する。
+
+        引数
+            なし
+        戻り値
+            なし
+        例外
+            Exception   ジョブ内で例外が発生していた場合、最初の例外
+        """
+        self.executor.shutdown(wait=True)
+        self.end_time = time.time()
+        if len(self.errors) > 0:
+            raise self.errors[0]
+
+    def report(self):
+        """
+        処理件数・スループットを表示する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        end_time = self.end_time if self.end_time is not None else time.time()
+        elapsed = max(end_time - self.start_time, 1e-6)
+        files = sum(self.counts.values())
+        print('copied {} files ({:.1f} MB) in {:.2f} sec: {:.1f} files/sec, {:.2f} MB/sec'.format(
+            files, self.total_bytes / 1048576.0, elapsed,
+            files / elapsed, self.total_bytes / 1048576.0 / elapsed))
+        print('  reflink={reflink} link={link} copy={copy} write={write}'.format(**self.counts))
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+イメージファイルパスとラベル列からトレーニング/評価データGeneratorを
+提供するデータセットモジュール。
+"""
+import numpy as np
+from .cache import decode_image
+from .loader import PrefetchLoader
+
+
+class RecordDataset:
+    """
+    イメージファイルパスのリストとラベル列を保持し、TubGroup と同じ形式の
+    トレーニング/評価データGeneratorを提供する基底クラス。
+    """
+    IMAGE_KEY = 'cam/image_array'
+    LABEL_KEYS = ['user/angle', 'user/throttle']
+
+    def __init__(self, image_paths, labels, cache=None):
+        """
+        引数
+            image_paths     イメージファイルパスのリスト
+            labels          {キー: 値リスト} 辞書(LABEL_KEYS のキーのみ使用)
+            cache           ImageCache オブジェクト(Noneの場合は都度デコード)
+        戻り値
+            なし
+        """
+        self.image_paths = list(image_paths)
+        self.labels = dict((key, np.asarray(labels[key], dtype=np.float32))
+                           for key in self.LABEL_KEYS if key in labels)
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def load_image(self, path):
+        """
+        画像を読み込む。キャッシュが有効な場合はキャッシュ経由で取得する。
+
+        引数
+            path    イメージファイルのパス
+        戻り値
+            uint8 の画像配列
+        """
+        if self.cache is not None:
+            return self.cache.get(path)
+        return decode_image(path)
+
+    def get_image_shape(self):
+        """
+        画像1件の形状を返却する。
+
+        引数
+            なし
+        戻り値
+            (height, width, channel) のタプル
+        """
+        if self.cache is not None:
+            return self.cache.image_shape
+        return decode_image(self.image_paths[0]).shape
+
+    def get_batch(self, positions, keys):
+        """
+        レコード位置リストについて、キーごとの配列を返却する。
+
+        引数
+            positions   レコード位置のリスト
+            keys        tubデータのキーのリスト
+        戻り値
+            配列のリスト
+        """
+        arrs = []
+        for key in keys:
+            if key == self.IMAGE_KEY:
+                arrs.append(np.stack([self.load_image(self.image_paths[i]) for i in positions]))
+            else:
+                arrs.append(self.labels[key][positions])
+        return arrs
+
+    def get_train_val_gen(self, X_keys, y_keys, batch_size=128, train_frac=.8, seed=200,
+                          workers=0, prefetch=4, split=None):
+        """
+        トレーニングデータGenerator、評価データGeneratorを返却する。
+        workers が1以上の場合は、ワーカープロセスで先読みする PrefetchLoader を使用する。
+        split を指定した場合は train_frac によらずその分割結果を使用する。
+
+        引数
+            X_keys      入力データとなるキーのリスト
+            y_keys      出力データとなるキーのリスト
+            batch_size  バッチサイズ
+            train_frac  トレーニングデータの割合
+            seed        分割・シャッフル用乱数シード
+            workers     Generatorごとのデコード用ワーカープロセス数(0の場合は呼び出し元で逐次デコード)
+            prefetch    Generatorごとの先読みバッチ数
+            split       (トレーニング位置配列, 評価位置配列)、Noneの場合はランダムに分割
+        戻り値
+            train_gen   トレーニングデータGenerator
+            val_gen     評価データGenerator
+        """
+        rng = np.random.RandomState(seed)
+        if split is None:
+            order = rng.permutation(len(self))
+            n_train = int(len(self) * train_frac)
+            split = (order[:n_train], order[n_train:])
+        train_positions, val_positions = split
+        self.total_train = len(train_positions)
+        self.total_val = len(val_positions)
+        if workers > 0:
+            train_gen = PrefetchLoader(self, train_positions, X_keys, y_keys,
+                batch_size=batch_size, workers=workers, prefetch=prefetch,
+                rng=rng, name='train loader').generator()
+            val_gen = PrefetchLoader(self, val_positions, X_keys, y_keys,
+                batch_size=batch_size, workers=workers, prefetch=prefetch,
+                rng=rng, name='val loader').generator()
+        else:
+            train_gen = self.batch_gen(train_positions, X_keys, y_keys, batch_size, rng)
+            val_gen = self.batch_gen(val_positions, X_keys, y_keys, batch_size, rng)
+        return train_gen, val_gen
+
+    def batch_gen(self, positions, X_keys, y_keys, batch_size, rng):
+        """
+        レコード位置をエポックごとにシャッフルし (X, y) を返却し続けるGenerator。
+        """
+        while True:
+            positions = rng.permutation(positions)
+            for start in range(0, len(positions), batch_size):
+                batch = positions[start:start + batch_size]
+                yield self.get_batch(batch, X_keys), self.get_batch(batch, y_keys)
+
+
+class TubGroupDataset(RecordDataset):
+    """
+    donkeycar の TubGroup を読み込み済みの DataFrame からデータセットを作成するクラス。
+    TubGroup.df のイメージファイル名は絶対パス化されている。
+    """
+
+    def __init__(self, tubgroup, cache=None):
+        """
+        引数
+            tubgroup    donkeycar.parts.datastore.TubGroup オブジェクト
+            cache       ImageCache オブジェクト(Noneの場合は都度デコード)
+        戻り値
+            なし
+        """
+        df = tubgroup.df
+        labels = dict((key, df[key].values) for key in self.LABEL_KEYS if key in df.columns)
+        super(TubGroupDataset, self).__init__(df[self.IMAGE_KEY].values, labels, cache=cache)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+複数ワーカープロセスでJPEGをデコードし、バッチを先読みするデータローダモジュール。
+バッチ画像はプロセス間共有メモリ上のスロットへ直接書き込まれるため、
+画像配列が pickle されることはない。
+"""
+import time
+import multiprocessing
+import numpy as np
+from .cache import decode_image
+
+
+def load_worker(image_paths, buffers, image_shape, tasks, results):
+    """
+    ワーカープロセスの処理。タスクキューから (スロット番号, [(行, レコード位置), ...]) を受け取り、
+    該当スロットの共有メモリへデコード済み画像を書き込み、結果キューへ通知する。
+    None を受け取ると終了する。
+
+    引数
+        image_paths     イメージファイルパスのリスト
+        buffers         スロットごとの共有メモリ(RawArray)のリスト
+        image_shape     画像1件の形状
+        tasks           タスクキュー
+        results         結果キュー
+    戻り値
+        なし
+    """
+    views = [np.frombuffer(buf, dtype=np.uint8).reshape((-1,) + tuple(image_shape))
+             for buf in buffers]
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slot, items = task
+        try:
+            for row, position in items:
+                views[slot][row] = decode_image(image_paths[position])
+            results.put((slot, None))
+        except Exception as e:
+            results.put((slot, repr(e)))
+
+
+class PrefetchLoader:
+    """
+    ワーカープロセス群でバッチを先読みするローダクラス。
+    同時に処理中のバッチ数は先読み数(共有メモリのスロット数)に制限される。
+    キャッシュが有効な場合、キャッシュ済み画像は呼び出し元プロセスでスロットへ複写し、
+    未キャッシュ画像のみワーカーでデコードしたうえでキャッシュへ格納する。
+    """
+
+    def __init__(self, dataset, positions, X_keys, y_keys, batch_size=128,
+                 workers=2, prefetch=4, rng=None, name='loader', report_interval=30.0):
+        """
+        共有メモリのスロットを確保し、ワーカープロセスを起動する。
+
+        引数
+            dataset         RecordDataset オブジェクト
+            positions       対象レコード位置のリスト
+            X_keys          入力データとなるキーのリスト
+            y_keys          出力データとなるキーのリスト
+            batch_size      バッチサイズ
+            workers         ワーカープロセス数
+            prefetch        先読みバッチ数(スロット数)
+            rng             エポックごとのシャッフル用乱数生成器
+            name            スループット表示用の名前
+            report_interval スループットを表示する間隔(秒)、0以下の場合は表示しない
+        戻り値
+            なし
+        """
+        self.dataset = dataset
+        self.positions = np.asarray(positions)
+        self.X_keys = X_keys
+        self.y_keys = y_keys
+        self.batch_size = batch_size
+        self.rng = rng if rng is not None else np.random.RandomState()
+        self.name = name
+        self.report_interval = report_interval
+        self.image_shape = dataset.get_image_shape()
+
+        # fork 後のTensorFlowとの干渉を避けるため forkserver で起動する
+        try:
+            ctx = multiprocessing.get_context('forkserver')
+        except ValueError:
+            ctx = multiprocessing.get_context()
+        frame_bytes = int(np.prod(self.image_shape))
+        self.prefetch = max(1, prefetch)
+        self.buffers = [ctx.RawArray('B', batch_size * frame_bytes) for _ in range(self.prefetch)]
+        self.views = [np.frombuffer(buf, dtype=np.uint8).reshape((-1,) + self.image_shape)
+                      for buf in self.buffers]
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.processes = [ctx.Process(target=load_worker,
+                                      args=(dataset.image_paths, self.buffers, self.image_shape,
+                                            self.tasks, self.results))
+                          for _ in range(max(1, workers))]
+        for p in self.processes:
+            p.daemon = True
+            p.start()
+
+        # 計測値
+        self.images = 0
+        self.wait_time = 0.0
+        self.start_time = time.time()
+        self.last_report = self.start_time
+
+    def batches(self):
+        """
+        エポックごとにシャッフルしたレコード位置をバッチ単位で無限に返却するGenerator。
+        """
+        while True:
+            order = self.rng.permutation(self.positions)
+            for start in range(0, len(order), self.batch_size):
+                yield order[start:start + self.batch_size]
+
+    def dispatch(self, slot, batch):
+        """
+        1バッチ分の画像をスロットへ準備するようタスクを投入する。
+
+        引数
+            slot        スロット番号
+            batch       レコード位置の配列
+        戻り値
+            misses      ワーカーでデコードする (行, キャッシュキー) のリスト
+        """
+        items = []
+        misses = []
+        cache = self.dataset.cache
+        for row, position in enumerate(batch):
+            if cache is not None:
+                key, image_arr = cache.lookup(self.dataset.image_paths[position])
+                if image_arr is not None:
+                    self.views[slot][row] = image_arr
+                    continue
+                misses.append((row, key))
+            items.append((row, int(position)))
+        self.tasks.put((slot, items))
+        return misses
+
+    def generator(self):
+        """
+        (X, y) を返却し続けるGenerator。
+        スロットは再利用されるため、返却する画像配列はスロットからの複写である。
+        """
+        batches = self.batches()
+        pending = {}
+        try:
+            for slot in range(self.prefetch):
+                batch = next(batches)
+                pending[slot] = (batch, self.dispatch(slot, batch))
+            while True:
+                wait_start = time.time()
+                slot, error = self.results.get()
+                self.wait_time += time.time() - wait_start
+                if error is not None:
+                    raise Exception('loader worker error: ' + error)
+                batch, misses = pending.pop(slot)
+                n = len(batch)
+                images = self.views[slot][:n].copy()
+                for row, key in misses:
+                    self.dataset.cache.put(key, images[row])
+                X = [images if key == self.dataset.IMAGE_KEY
+                     else self.dataset.get_batch(batch, [key])[0] for key in self.X_keys]
+                y = self.dataset.get_batch(batch, self.y_keys)
+
+                # 空いたスロットへ次のバッチを投入
+                next_batch = next(batches)
+                pending[slot] = (next_batch, self.dispatch(slot, next_batch))
+
+                self.images += n
+                self.report()
+                yield X, y
+        finally:
+            self.close()
+
+    def report(self, force=False):
+        """
+        スループット(images/sec)と、バッチ待ち時間の割合を表示する。
+        待ち時間の割合が高い場合はトレーニングが入力律速になっている。
+
+        引数
+            force   表示間隔によらず表示する場合True
+        戻り値
+            なし
+        """
+        now = time.time()
+        if not force and (self.report_interval <= 0 or now - self.last_report < self.report_interval):
+            return
+        elapsed = max(now - self.start_time, 1e-6)
+        print('{}: {:.1f} images/sec, waiting for input {:.1f}% of the time'.format(
+            self.name, self.images / elapsed, 100.0 * self.wait_time / elapsed))
+        self.last_report = now
+
+    def close(self):
+        """
+        ワーカープロセスを終了する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        for _ in self.processes:
+            self.tasks.put(None)
+        for p in self.processes:
+            p.join(timeout=1.0)
+            if p.is_alive():
+                p.terminate()
+        self.processes = []
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+tubarrange の差分整理用マニフェストモジュール。
+整理済みレコードごとにコピー元パス、サイズ、更新時刻、コピー先連番を
+1行1JSONの追記専用ファイルへ記録する。中断された場合も記録済みの行までは
+整理済みとして扱い、次回実行時に残りから再開する。
+コピー元が削除されたレコードは削除済みを示す行を追記して除外する。
+新規レコード用に払い出した連番も予約行として記録し、中断により未整理のまま残った
+予約済み連番のみ次回実行時に再利用する。それ以外の新規レコードは常に最終連番の後ろへ追加する。
+"""
+import os
+import json
+import threading
+
+
+class Manifest:
+    """
+    整理済みレコードを管理するマニフェストクラス。
+    """
+    # dataディレクトリ内のデフォルトファイル名(Tubのレコードとして扱われない名前)
+    DEFAULT_FILE = '.arrange_manifest.jsonl'
+
+    def __init__(self, path, debug=False):
+        """
+        マニフェストファイルが存在する場合は読み込み、追記モードで開く。
+        書き込み途中で中断された不完全な行は無視する。
+
+        引数
+            path    マニフェストファイルのパス
+            debug   デバッグモード
+        戻り値
+            なし
+        """
+        self.path = path
+        self.debug = debug
+        # 整理済みレコード辞書 {コピー元パス: エントリ辞書}
+        self.entries = {}
+        # これまでに予約・使用した最大の連番(削除済みレコードの連番を含む)
+        self.high = -1
+        # 予約行に記録された連番、整理済みとして記録された連番
+        reserved = set()
+        arranged = set()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        if self.debug:
+                            print('ignore broken manifest line: ' + line.strip())
+                        continue
+                    if 'reserved' in entry:
+                        reserved.update(entry['reserved'])
+                        self.high = max([self.high] + entry['reserved'])
+                    elif entry.get('removed'):
+                        self.entries.pop(entry['src'], None)
+                    else:
+                        self.entries[entry['src']] = entry
+                        arranged.add(entry['dest'])
+                        self.high = max(self.high, entry['dest'])
+        if self.debug:
+            print('manifest {} has {} entries'.format(path, len(self.entries)))
+        # 前回以前に予約され、中断により整理されなかった連番
+        self.pending = reserved - arranged
+        if self.debug and len(self.pending) > 0:
+            print('manifest has {} interrupted reservations'.format(len(self.pending)))
+        self.lock = threading.Lock()
+        self.file = open(path, 'a')
+
+    def is_arranged(self, src, size, mtime):
+        """
+        コピー元ファイルが変更されずに整理済みかどうかを判定する。
+
+        引数
+            src     コピー元パス
+            size    コピー元ファイルサイズ
+            mtime   コピー元ファイル更新時刻
+        戻り値
+            boolean 整理済みの場合True
+        """
+        entry = self.entries.get(src)
+        return entry is not None and entry['size'] == size and entry['mtime'] == mtime
+
+    def get_dest(self, src):
+        """
+        コピー元パスに割り当て済みのコピー先連番を返却する。
+
+        引数
+            src     コピー元パス
+        戻り値
+            dest    コピー先連番、未割当の場合None
+        """
+        entry = self.entries.get(src)
+        return None if entry is None else entry['dest']
+
+    def allocate(self, count):
+        """
+        新規レコード用のコピー先連番を count 件払い出し、予約行として記録する。
+        中断により未整理のまま残った予約済み連番を先に使用し、残りは最終連番の後ろへ追加する。
+        prune などで削除されたレコードの連番は再利用しない。
+
+        引数
+            count   払い出す件数
+        戻り値
+            dests   コピー先連番リスト(昇順)
+        """
+        with self.lock:
+            dests = sorted(self.pending)[:count]
+            self.pending.difference_update(dests)
+            while len(dests) < count:
+                self.high += 1
+                dests.append(self.high)
+            if len(dests) > 0:
+                self.file.write(json.dumps({'reserved': dests}) + '\n')
+                self.file.flush()
+        return dests
+
+    def append(self, src, size, mtime, dest):
+        """
+        整理済みレコードを1件記録する。スレッドセーフ。
+
+        引数
+            src     コピー元パス
+            size    コピー元ファイルサイズ
+            mtime   コピー元ファイル更新時刻
+            dest    コピー先連番
+        戻り値
+            なし
+        """
+        entry = {'src': src, 'size': size, 'mtime': mtime, 'dest': dest}
+        line = json.dumps(entry) + '\n'
+        with self.lock:
+            self.entries[src] = entry
+            self.high = max(self.high, dest)
+            self.file.write(line)
+            self.file.flush()
+
+    def remove(self, src):
+        """
+        整理済みレコードを1件除外し、削除済みとして記録する。スレッドセーフ。
+
+        引数
+            src     コピー元パス
+        戻り値
+            なし
+        """
+        with self.lock:
+            entry = self.entries.pop(src, None)
+            line = json.dumps({'src': src, 'removed': True,
+                               'dest': None if entry is None else entry['dest']}) + '\n'
+            self.file.write(line)
+            self.file.flush()
+
+    def find(self, src_dir):
+        """
+        指定ディレクトリ直下のコピー元パスのうち、整理済みのものを返却する。
+
+        引数
+            src_dir     コピー元ディレクトリの絶対パス
+        戻り値
+            コピー元パスのリスト(昇順)
+        """
+        return sorted(src for src in self.entries if os.path.dirname(src) == src_dir)
+
+    def last_index(self):
+        """
+        記録済みの最終コピー先連番を返却する。
+
+        引数
+            なし
+        戻り値
+            最終コピー先連番、記録がない場合-1
+        """
+        if len(self.entries) == 0:
+            return -1
+        return max(entry['dest'] for entry in self.entries.values())
+
+    def close(self):
+        """
+        マニフェストファイルをディスクへ同期して閉じる。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+整理済みtubデータを少数の大きなシャードファイルへまとめるモジュール。
+シャードごとに以下の2ファイルを作成し、シャード一覧を shards.json に記録する。
+
+    shard_NNNNN_images.npy   uint8 (N,120,160,3) 画像配列(np.load(mmap_mode='r')で読込可能)
+    shard_NNNNN_labels.npz   user/angle, user/throttle, user/mode, timestamp の列指向ラベル
+
+トレーニング時は画像配列をメモリマップし、連続スライスを複数連結したバッチを
+Kerasへ渡す。
+"""
+import os
+import json
+import numpy as np
+
+
+class ShardWriter:
+    """
+    シャードファイルを作成するクラス。
+    put() はレコード位置ごとに書き込み先が独立しているため、複数スレッドから呼び出せる。
+    """
+    INDEX_FILE = 'shards.json'  # シャード一覧ファイル名
+    IMAGES_SUFFIX = '_images.npy'
+    LABELS_SUFFIX = '_labels.npz'
+
+    def __init__(self, shard_dir, count, image_shape, shard_size=10000, debug=False):
+        """
+        全シャードの画像配列をメモリマップファイルとして確保する。
+
+        引数
+            shard_dir    シャード格納ディレクトリのパス
+            count        全レコード件数
+            image_shape  画像1件の形状 (height, width, channel)
+            shard_size   1シャードあたりの最大レコード件数
+            debug        デバッグモード
+        戻り値
+            なし
+        例外
+            Exception    シャード格納ディレクトリが空でない場合
+        """
+        self.debug = debug
+        self.shard_dir = shard_dir
+        os.makedirs(shard_dir, exist_ok=True)
+        if len(os.listdir(shard_dir)) > 0:
+            raise Exception(shard_dir + ' is not empty')
+        self.count = count
+        self.image_shape = tuple(image_shape)
+        self.shard_size = shard_size
+        self.shards = []
+        for start in range(0, count, shard_size):
+            n = min(shard_size, count - start)
+            name = 'shard_{:05d}'.format(len(self.shards))
+            images = np.lib.format.open_memmap(
+                os.path.join(shard_dir, name + self.IMAGES_SUFFIX),
+                mode='w+', dtype=np.uint8, shape=(n,) + self.image_shape)
+            self.shards.append({
+                'name': name,
+                'start': start,
+                'count': n,
+                'images': images,
+                'angle': np.zeros(n, dtype=np.float32),
+                'throttle': np.zeros(n, dtype=np.float32),
+                'mode': [None] * n,
+                'timestamp': [None] * n,
+            })
+            if self.debug:
+                print('allocate {} records={}'.format(name, n))
+
+    def put(self, position, image_arr, angle, throttle, mode, timestamp):
+        """
+        position 番目のレコードを書き込む。
+
+        引数
+            position    全体での0始まりのレコード位置
+            image_arr   画像データ(image_shape 形状の uint8 配列)
+            angle       user/angle 値
+            throttle    user/throttle 値
+            mode        user/mode 値
+            timestamp   timestamp 値
+        戻り値
+            なし
+        例外
+            Exception   画像形状が一致しない場合
+        """
+        if image_arr.shape != self.image_shape:
+            raise Exception('image shape {} != {} at {}'.format(
+                image_arr.shape, self.image_shape, position))
+        shard = self.shards[position // self.shard_size]
+        i = position - shard['start']
+        shard['images'][i] = image_arr
+        shard['angle'][i] = angle
+        shard['throttle'][i] = throttle
+        shard['mode'][i] = mode
+        shard['timestamp'][i] = timestamp
+
+    def close(self):
+        """
+        画像配列をフラッシュし、ラベルファイルとシャード一覧ファイルを書き込む。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        index = {'image_shape': list(self.image_shape), 'count': self.count, 'shards': []}
+        for shard in self.shards:
+            shard['images'].flush()
+            del shard['images']
+            np.savez(os.path.join(self.shard_dir, shard['name'] + self.LABELS_SUFFIX),
+                angle=shard['angle'], throttle=shard['throttle'],
+                mode=np.array([str(m) for m in shard['mode']]),
+                timestamp=np.array([str(t) for t in shard['timestamp']]))
+            index['shards'].append({'name': shard['name'], 'count': shard['count']})
+        with open(os.path.join(self.shard_dir, self.INDEX_FILE), 'w') as f:
+            json.dump(index, f)
+        if self.debug:
+            print('write {} shards to {}'.format(len(self.shards), self.shard_dir))
+
+
+class ShardDataset:
+    """
+    シャードファイル群を読み込み、TubGroup と同じ形式の
+    トレーニング/評価データGeneratorを提供するクラス。
+    """
+    # tubデータのキーとラベル列名の対応
+    COLUMNS = {
+        'user/angle': 'angle',
+        'user/throttle': 'throttle',
+        'user/mode': 'mode',
+        'timestamp': 'timestamp',
+    }
+    IMAGE_KEY = 'cam/image_array'
+
+    @staticmethod
+    def is_shard_dir(path):
+        """
+        指定パスがシャード格納ディレクトリかどうかを判定する。
+
+        引数
+            path    判定対象パス(カンマ区切り指定の場合はFalse)
+        戻り値
+            boolean シャード一覧ファイルが存在する場合True
+        """
+        if path is None or ',' in path:
+            return False
+        return os.path.isfile(os.path.join(os.path.expanduser(path), ShardWriter.INDEX_FILE))
+
+    def __init__(self, shard_dir):
+        """
+        シャード一覧を読み込み、画像配列をメモリマップで開く。
+
+        引数
+            shard_dir   シャード格納ディレクトリのパス
+        戻り値
+            なし
+        """
+        self.shard_dir = os.path.expanduser(shard_dir)
+        with open(os.path.join(self.shard_dir, ShardWriter.INDEX_FILE), 'r') as f:
+            index = json.load(f)
+        self.image_shape = tuple(index['image_shape'])
+        self.shards = []
+        for entry in index['shards']:
+            path = os.path.join(self.shard_dir, entry['name'])
+            labels = np.load(path + ShardWriter.LABELS_SUFFIX)
+            shard = dict((column, labels[column]) for column in self.COLUMNS.values())
+            shard[self.IMAGE_KEY] = np.load(path + ShardWriter.IMAGES_SUFFIX, mmap_mode='r')
+            shard['count'] = entry['count']
+            self.shards.append(shard)
+
+    def __len__(self):
+        return sum(shard['count'] for shard in self.shards)
+
+    def get_slice(self, shard_no, start, end, keys):
+        """
+        指定シャードの連続範囲について、キーごとの配列(ビュー)を返却する。
+
+        引数
+            shard_no    シャード番号
+            start       開始位置
+            end         終了位置(含まない)
+            keys        tubデータのキーのリスト
+        戻り値
+            配列のリスト
+        """
+        shard = self.shards[shard_no]
+        return [shard[key if key == self.IMAGE_KEY else self.COLUMNS[key]][start:end]
+                for key in keys]
+
+    def get_blocks(self, block_size):
+        """
+        シャードを block_size 件ごとの連続ブロックに分割する。
+
+        引数
+            block_size  ブロックあたりの件数
+        戻り値
+            (シャード番号, 開始位置, 終了位置) のリスト
+        """
+        blocks = []
+        for shard_no, shard in enumerate(self.shards):
+            for start in range(0, shard['count'], block_size):
+                blocks.append((shard_no, start, min(start + block_size, shard['count'])))
+        return blocks
+
+    def get_train_val_gen(self, X_keys, y_keys, batch_size=128, train_frac=.8, seed=200, mix=8):
+        """
+        トレーニングデータGenerator、評価データGeneratorを返却する。
+        シャードを batch_size / mix 件の連続ブロックに分割し、分割はブロック単位で行う。
+        各バッチはランダムに選んだ mix 個のブロックを連結するため、
+        メモリマップ上は連続読み込みのまま、1バッチに複数の走行区間のデータが混ざる。
+
+        引数
+            X_keys      入力データとなるキーのリスト
+            y_keys      出力データとなるキーのリスト
+            batch_size  バッチサイズ
+            train_frac  トレーニングデータの割合
+            seed        分割・シャッフル用乱数シード
+            mix         1バッチを構成するブロック数
+        戻り値
+            train_gen   トレーニングデータGenerator
+            val_gen     評価データGenerator
+        """
+        blocks = self.get_blocks(max(batch_size // mix, 1))
+        order = np.random.RandomState(seed).permutation(len(blocks))
+        n_train = int(len(blocks) * train_frac)
+        if len(blocks) > 1:
+            # トレーニング・評価とも1ブロック以上とする
+            n_train = min(max(n_train, 1), len(blocks) - 1)
+        else:
+            n_train = len(blocks)
+        train_blocks = [blocks[i] for i in order[:n_train]]
+        val_blocks = [blocks[i] for i in order[n_train:]]
+        self.total_train = sum(end - start for _, start, end in train_blocks)
+        self.total_val = sum(end - start for _, start, end in val_blocks)
+        # 評価データの読み込みがトレーニングデータの順序に影響しないよう、乱数生成器を分ける
+        train_gen = self.batch_gen(train_blocks, X_keys, y_keys, batch_size,
+                                   np.random.RandomState(seed + 1))
+        val_gen = self.batch_gen(val_blocks, X_keys, y_keys, batch_size,
+                                 np.random.RandomState(seed + 2))
+        return train_gen, val_gen
+
+    def get_batch(self, blocks, keys):
+        """
+        ブロックリストについて、キーごとに連結した配列を返却する。
+        ブロックが1つの場合はコピーせずビューを返却する。
+
+        引数
+            blocks      (シャード番号, 開始位置, 終了位置) のリスト
+            keys        tubデータのキーのリスト
+        戻り値
+            配列のリスト
+        """
+        slices = [self.get_slice(shard_no, start, end, keys) for shard_no, start, end in blocks]
+        if len(slices) == 1:
+            return slices[0]
+        return [np.concatenate([arrs[i] for arrs in slices]) for i in range(len(keys))]
+
+    def batch_gen(self, blocks, X_keys, y_keys, batch_size, rng=None):
+        """
+        ブロックリストをエポックごとにシャッフルして巡回し、
+        batch_size 件以上になるまでブロックを集めた (X, y) を返却し続けるGenerator。
+
+        引数
+            blocks      (シャード番号, 開始位置, 終了位置) のリスト
+            X_keys      入力データとなるキーのリスト
+            y_keys      出力データとなるキーのリスト
+            batch_size  バッチサイズ
+            rng         エポックごとのシャッフルに使用する乱数生成器(Noneの場合は順番どおり)
+        戻り値
+            (X, y)      配列リストのタプル
+        例外
+            Exception   ブロックがない場合
+        """
+        if len(blocks) == 0:
+            raise Exception('no records to generate batches')
+        # 全件が batch_size 未満の場合は全件で1バッチとする
+        batch_size = min(batch_size, sum(end - start for _, start, end in blocks))
+        batch = []
+        count = 0
+        while True:
+            order = range(len(blocks)) if rng is None else rng.permutation(len(blocks))
+            for i in order:
+                shard_no, start, end = blocks[i]
+                batch.append(blocks[i])
+                count += end - start
+                if count >= batch_size:
+                    yield self.get_batch(batch, X_keys), self.get_batch(batch, y_keys)
+                    batch = []
+                    count = 0
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+トレーニング/評価データの分割結果をファイルへ保存・再利用するモジュール。
+分割結果はレコードID(イメージファイルの絶対パス)のリストとして保存し、
+ラベルは毎回tubデータから読み込む。
+前回の分割結果にないレコードはIDのハッシュ値で振り分けるため、
+tubを追加しても既存レコードの振り分けは変わらない。
+"""
+import os
+import glob
+import json
+import zlib
+import numpy as np
+from .dataset import RecordDataset
+
+
+def expand_tub_paths(tub_paths):
+    """
+    カンマ区切り、ワイルドカード指定のtubディレクトリパスを展開する。
+
+    引数
+        tub_paths   tubディレクトリパス文字列
+    戻り値
+        tubディレクトリパスのリスト(重複なし)
+    """
+    paths = []
+    for path in tub_paths.split(','):
+        path = os.path.expanduser(path.strip())
+        if len(path) == 0:
+            continue
+        if glob.has_magic(path):
+            matches = [m for m in sorted(glob.glob(path)) if os.path.isdir(m)]
+        else:
+            matches = [path]
+        paths.extend([m for m in matches if m not in paths])
+    return paths
+
+
+class SplitIndex:
+    """
+    分割結果ファイルを作成・読み込みするクラス。
+    """
+    VERSION = 2
+
+    @staticmethod
+    def get_record_ids(dataset):
+        """
+        データセットの各レコードのIDを返却する。
+
+        引数
+            dataset     RecordDataset オブジェクト
+        戻り値
+            レコードID(イメージファイルの絶対パス)のリスト
+        """
+        return [os.path.abspath(str(p)) for p in dataset.image_paths]
+
+    @staticmethod
+    def is_train_id(record_id, train_frac=.8, seed=200):
+        """
+        レコードIDのハッシュ値からトレーニングデータとするかどうかを決定する。
+        同じIDと乱数シードであれば常に同じ結果となる。
+
+        引数
+            record_id   レコードID
+            train_frac  トレーニングデータの割合
+            seed        乱数シード
+        戻り値
+            boolean     トレーニングデータとする場合True
+        """
+        key = '{}:{}'.format(seed, record_id).encode('utf-8')
+        return zlib.crc32(key) / float(2 ** 32) < train_frac
+
+    @staticmethod
+    def split(dataset, train_frac=.8, seed=200, bins=0):
+        """
+        データセットのレコード位置をトレーニング用と評価用に分割する。
+        bins が1以上の場合は user/angle を等幅のビンに分け、ビンごとに同じ割合で分割する。
+
+        引数
+            dataset     RecordDataset オブジェクト
+            train_frac  トレーニングデータの割合
+            seed        乱数シード
+            bins        層化に使用するステアリング値のビン数(0の場合は層化しない)
+        戻り値
+            train       トレーニングデータのレコード位置配列(昇順)
+            val         評価データのレコード位置配列(昇順)
+        """
+        rng = np.random.RandomState(seed)
+        if bins > 0 and RecordDataset.LABEL_KEYS[0] in dataset.labels:
+            angles = dataset.labels[RecordDataset.LABEL_KEYS[0]]
+            edges = np.linspace(-1.0, 1.0, bins + 1)[1:-1]
+            groups = [np.nonzero(np.digitize(angles, edges) == b)[0] for b in range(bins)]
+        else:
+            groups = [np.arange(len(dataset))]
+        train = []
+        val = []
+        for group in groups:
+            group = rng.permutation(group)
+            n_train = int(round(len(group) * train_frac))
+            train.append(group[:n_train])
+            val.append(group[n_train:])
+        return np.sort(np.concatenate(train)), np.sort(np.concatenate(val))
+
+    def __init__(self, path):
+        """
+        引数
+            path    分割結果ファイルのパス
+        戻り値
+            なし
+        """
+        self.path = os.path.expanduser(path)
+
+    def load(self, train_frac=.8, seed=200, bins=0):
+        """
+        分割結果ファイルが有効であればレコードIDごとの振り分けを読み込む。
+
+        引数
+            train_frac  トレーニングデータの割合
+            seed        乱数シード
+            bins        層化に使用するステアリング値のビン数
+        戻り値
+            {レコードID: トレーニングデータの場合True} 辞書、
+            ファイルが存在しない、もしくは分割条件が異なる場合None
+        """
+        if not os.path.isfile(self.path):
+            return None
+        with open(self.path, 'r') as f:
+            index = json.load(f)
+        if index.get('version') != self.VERSION \
+                or index['train_frac'] != train_frac \
+                or index['seed'] != seed or index['bins'] != bins:
+            print('split index ' + self.path + ' is stale, recreate')
+            return None
+        assigned = dict((record_id, True) for record_id in index['train'])
+        assigned.update((record_id, False) for record_id in index['val'])
+        return assigned
+
+    def assign(self, dataset, train_frac=.8, seed=200, bins=0):
+        """
+        データセットのレコード位置をトレーニング用と評価用に分割する。
+        分割結果ファイルに記録済みのレコードは前回と同じ側へ、
+        未記録のレコードはIDのハッシュ値で振り分け、分割結果ファイルを更新する。
+        ファイルが無効な場合は split() で分割し直す。
+
+        引数
+            dataset     RecordDataset オブジェクト
+            train_frac  トレーニングデータの割合
+            seed        乱数シード
+            bins        層化に使用するステアリング値のビン数
+        戻り値
+            train       トレーニングデータのレコード位置配列(昇順)
+            val         評価データのレコード位置配列(昇順)
+        """
+        record_ids = self.get_record_ids(dataset)
+        assigned = self.load(train_frac=train_frac, seed=seed, bins=bins)
+        if assigned is None:
+            train, val = self.split(dataset, train_frac=train_frac, seed=seed, bins=bins)
+            self.save(record_ids, train, val, train_frac=train_frac, seed=seed, bins=bins)
+            return train, val
+
+        train = []
+        val = []
+        added = 0
+        for position, record_id in enumerate(record_ids):
+            is_train = assigned.get(record_id)
+            if is_train is None:
+                is_train = self.is_train_id(record_id, train_frac=train_frac, seed=seed)
+                added += 1
+            (train if is_train else val).append(position)
+        removed = len(assigned) - (len(record_ids) - added)
+        print('use split index {} (added {}, removed {})'.format(self.path, added, removed))
+        train = np.array(train, dtype=np.int64)
+        val = np.array(val, dtype=np.int64)
+        if added > 0 or removed > 0:
+            self.save(record_ids, train, val, train_frac=train_frac, seed=seed, bins=bins)
+        return train, val
+
+    def save(self, record_ids, train, val, train_frac=.8, seed=200, bins=0):
+        """
+        分割結果をレコードIDのリストとしてファイルへ保存する。
+
+        引数
+            record_ids  レコードIDのリスト
+            train       トレーニングデータのレコード位置配列
+            val         評価データのレコード位置配列
+            train_frac  トレーニングデータの割合
+            seed        乱数シード
+            bins        層化に使用するステアリング値のビン数
+        戻り値
+            なし
+        """
+        index = {
+            'version': self.VERSION,
+            'train_frac': train_frac,
+            'seed': seed,
+            'bins': bins,
+            'train': [record_ids[i] for i in train],
+            'val': [record_ids[i] for i in val],
+        }
+        dir_name = os.path.dirname(self.path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.path)
+        print('save split index ' + self.path)
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+tub ディレクトリへの書き込みをバックグラウンドスレッドで行う part モジュール。
+Vehicle ループでは連番を採番してレコードをキューへ投入するだけで、
+JPEGエンコードとファイル書き込みは書き込みスレッドがまとめて行う。
+出力するファイル(meta.json, record_N.json, N_cam-image_array_.jpg)は donkeycar の TubWriter と同じ。
+"""
+import os
+import json
+import time
+import queue
+import threading
+import numpy as np
+from PIL import Image
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+class AsyncTubWriter:
+    """
+    キューを介して tub ディレクトリへレコードを書き込む part クラス。
+    キューが満杯の場合はレコードを破棄し、Vehicle ループを待たせない。
+    破棄したレコードには連番を割り当てないため、tub の連番は欠番にならない。
+    """
+
+    def __init__(self, path, inputs=None, types=None, queue_size=100, batch_size=20,
+                 sync_interval=5.0, report_interval=30.0):
+        """
+        tub ディレクトリを準備し、書き込みスレッドを開始する。
+        donkeycar の Tub.put_record と同じく採番時に連番を1つ進めるため、
+        新規の tub ディレクトリは1から、既存の場合は最終連番の次から書き込む。
+
+        引数
+            path            tub ディレクトリのパス
+            inputs          キーのリスト(新規作成時に必須)
+            types           型のリスト('str','float','int','boolean','image_array')
+            queue_size      キューに保持する最大レコード数
+            batch_size      書き込みスレッドが1回にまとめて書き込む最大レコード数
+            sync_interval   書き込んだファイルをディスクへ同期する間隔(秒)、0以下の場合は同期しない
+            report_interval キュー長・破棄件数をログ出力する間隔(秒)、0以下の場合は出力しない
+        戻り値
+            なし
+        例外
+            Exception       tub ディレクトリが存在せず inputs 指定もない場合
+        """
+        self.path = os.path.expanduser(path)
+        self.meta_path = os.path.join(self.path, 'meta.json')
+        if os.path.exists(self.path):
+            with open(self.meta_path, 'r') as f:
+                self.meta = json.load(f)
+            # 直前に書き込んだ連番
+            self.current_ix = max(self.get_last_ix(), 0)
+        elif inputs:
+            os.makedirs(self.path)
+            self.meta = {'inputs': inputs, 'types': types}
+            with open(self.meta_path, 'w') as f:
+                json.dump(self.meta, f)
+            self.current_ix = 0
+        else:
+            raise Exception('tub path {} does not exist and no inputs/types given'.format(self.path))
+        self.inputs = self.meta['inputs']
+        self.types = self.meta['types']
+
+        self.batch_size = batch_size
+        self.sync_interval = sync_interval
+        self.report_interval = report_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        # 前回の同期以降に書き込んだファイルのパス
+        self.unsynced = []
+        self.max_depth = 0
+        self.write_time = 0.0
+        self.thread = threading.Thread(target=self.write_loop, name='tub writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get_last_ix(self):
+        """
+        tub ディレクトリ内の record_N.json の最大連番を返却する。
+
+        引数
+            なし
+        戻り値
+            最大連番(レコードがない場合は-1)
+        """
+        last = -1
+        for entry in os.scandir(self.path):
+            name = entry.name
+            if name.startswith('record_') and name.endswith('.json'):
+                try:
+                    last = max(last, int(name[len('record_'):-len('.json')]))
+                except ValueError:
+                    continue
+        return last
+
+    def run(self, *args):
+        """
+        連番を採番し、レコードをキューへ投入する。
+        画像はカメラ側で上書きされても影響しないよう複製する。
+
+        引数
+            *args       inputs の順に並んだ値
+        戻り値
+            なし
+        """
+        record = []
+        for key, typ, val in zip(self.inputs, self.types, args):
+            if typ == 'image_array':
+                val = np.array(val, dtype=np.uint8)
+            record.append((key, typ, val))
+        try:
+            self.queue.put_nowait((self.current_ix + 1, record))
+        except queue.Full:
+            self.dropped += 1
+            return
+        self.current_ix += 1
+        self.enqueued += 1
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def write_loop(self):
+        """
+        書き込みスレッドの処理。キューから最大 batch_size 件ずつ取り出して書き込み、
+        sync_interval ごとに書き込んだファイルをディスクへ同期する。None を受け取ると終了する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        last_sync = last_report = time.time()
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            start = time.time()
+            for item in batch:
+                if item is None:
+                    running = False
+                    continue
+                try:
+                    self.write_record(*item)
+                    self.written += 1
+                except Exception:
+                    logger.error('failed to write record %d', item[0], exc_info=True)
+            now = time.time()
+            self.write_time += now - start
+            if self.sync_interval <= 0:
+                self.unsynced = []
+            elif now - last_sync >= self.sync_interval or not running:
+                self.sync()
+                last_sync = time.time()
+            if self.report_interval > 0 and now - last_report >= self.report_interval:
+                logger.info('tub writer: written %d, queue depth %d (max %d), dropped %d',
+                            self.written, self.queue.qsize(), self.max_depth, self.dropped)
+                last_report = now
+
+    def write_record(self, ix, record):
+        """
+        画像ファイルを書き込んだ後に record_N.json を書き込む。
+
+        引数
+            ix          連番
+            record      (キー, 型, 値) のリスト
+        戻り値
+            なし
+        """
+        json_data = {}
+        for key, typ, val in record:
+            if typ == 'image_array':
+                name = '_'.join([str(ix), key, '.jpg']).replace('/', '-')
+                Image.fromarray(val).save(os.path.join(self.path, name))
+                self.unsynced.append(os.path.join(self.path, name))
+                json_data[key] = name
+            elif typ == 'float':
+                json_data[key] = None if val is None else float(val)
+            elif typ == 'int':
+                json_data[key] = None if val is None else int(val)
+            elif typ == 'boolean':
+                json_data[key] = None if val is None else bool(val)
+            else:
+                json_data[key] = val
+        json_path = os.path.join(self.path, 'record_' + str(ix) + '.json')
+        with open(json_path, 'w') as f:
+            json.dump(json_data, f)
+        self.unsynced.append(json_path)
+
+    def sync(self):
+        """
+        前回の同期以降に書き込んだファイルと tub ディレクトリをディスクへ同期する。
+        システム全体を同期する os.sync() と異なり、他のファイルの書き込みは待たない。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        paths = self.unsynced
+        self.unsynced = []
+        for path in paths + [self.path]:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError:
+                logger.warning('failed to sync %s', path, exc_info=True)
+
+    def shutdown(self):
+        """
+        キューに残っているレコードを書き込み、書き込みスレッドを終了する。
+
+        引数
+            なし
+        戻り値
+            なし
+        """
+        self.queue.put(None)
+        self.thread.join()
+        print('tub writer: {} enqueued, {} written, {} dropped, max queue depth {}, {:.1f}ms/record'.format(
+            self.enqueued, self.written, self.dropped, self.max_depth,
+            1000.0 * self.write_time / max(self.written, 1)))